@@ -0,0 +1,100 @@
+'''
+Adaptive sampling of the parameter space, as an alternative to refining the
+whole Cartesian product.
+
+A campaign starts from a coarse product of param_collection.  In each
+round, a scalar result is read from every finished run, and two runs are
+neighbours if they differ in only one numeric parameter and no run lies
+between them along it.  Where the results of two neighbours differ by more
+than a threshold (in dex for positive results, relatively otherwise), a new
+run is placed halfway between them (geometric mean), and the new runs are
+generated with generate_config_files(param_points=...) like an extension of
+the grid.  The largest differences are refined first, until the grid has
+max_runs runs.
+'''
+
+import os
+from math import log10, sqrt
+
+numeric_keys = ('rin', 'rout', 'd2g', 'mdust')
+
+
+def read_scalar_result(iter_dir, fname, column=-1):
+    '''
+    Read column of the last line of iter_dir/fname, or None if the run has
+    not written it.
+    '''
+    try:
+        with open(os.path.join(iter_dir, fname), 'r') as f:
+            lines = [_ for _ in f.readlines()
+                     if len(_.strip()) > 0 and _.strip()[0] not in '!#']
+        return float(lines[-1].split()[column])
+    except (IOError, IndexError, ValueError):
+        return None
+
+
+def result_difference(a, b):
+    if a > 0.0 and b > 0.0:
+        return abs(log10(a / b))
+    return abs(a - b) / max(abs(a), abs(b), 1e-300)
+
+
+def round_value(x):
+    '''
+    Round to the precision of the LUT, so that the points read back from it
+    are the same.
+    '''
+    return float('{0:.2e}'.format(x))
+
+
+def refine_points(lut, results, threshold = 0.3, max_new = None):
+    '''
+    lut maps the run IDs to their parameters (as from load_lut), results
+    maps the run IDs of the finished runs to their scalar results.
+    Return the new points, largest differences first.
+    '''
+    known = set([tuple(sorted(p.items())) for p in lut.values()])
+    candidates = {}
+    for k in numeric_keys:
+        lines = {}
+        for run_id, p in lut.items():
+            rest = tuple(sorted([_ for _ in p.items() if _[0] != k]))
+            lines.setdefault(rest, []).append((p[k], run_id))
+        for rest, line in lines.items():
+            line.sort()
+            for (x0, i0), (x1, i1) in zip(line[:-1], line[1:]):
+                if i0 not in results or i1 not in results:
+                    continue
+                d = result_difference(results[i0], results[i1])
+                if d <= threshold:
+                    continue
+                x = round_value(sqrt(x0 * x1))
+                if x <= x0 or x >= x1:
+                    continue
+                p = dict(rest)
+                p[k] = x
+                s = tuple(sorted(p.items()))
+                if s not in known and d > candidates.get(s, (-1.0,))[0]:
+                    candidates[s] = (d, p)
+    points = [p for d, p in sorted(candidates.values(), reverse=True)]
+    return points if max_new is None else points[:max(0, max_new)]
+
+
+def next_campaign_points(fname_lut, res_dir, result_fname,
+                         result_column = -1,
+                         threshold = 0.3,
+                         max_runs = 1000):
+    '''
+    Read the LUT and the results of the finished runs, and return the points
+    of the next round of the campaign.
+    '''
+    import runtime_model as rm
+    lut = rm.load_lut(fname_lut)
+    results = {}
+    for run_id in lut.keys():
+        r = read_scalar_result(os.path.join(res_dir, 'run_' + run_id),
+                               result_fname, column = result_column)
+        if r is not None:
+            results[run_id] = r
+    return refine_points(lut, results, threshold = threshold,
+                         max_new = max_runs - len(lut))
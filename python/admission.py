@@ -0,0 +1,78 @@
+'''
+Admission control for main_loop: decide whether one more task can be
+started on this host without running out of memory.
+
+The memory a task will need is estimated from its config file: by the peak
+RSS measured for earlier runs with the same max_num_of_cells and mc_conf%nph
+(the footprint key), or, before any such run has finished, by
+    mem_base_mb + mem_per_cell_kb * max_num_of_cells / 1024.
+A task is admitted only if the memory in use, plus what the running tasks
+are still expected to grow by, plus the estimate of the new task, stays
+below max_pvmem of the total memory.  A task is always admitted when no
+task is running, since waiting would not free any memory for it.
+'''
+
+footprint_keys = ('a_disk_iter_params%max_num_of_cells', 'mc_conf%nph')
+
+
+def footprint_key(values):
+    return tuple([values.get(k, None) for k in footprint_keys])
+
+
+def new_footprint_history():
+    return {}
+
+
+def add_footprint(history, key, maxrss_kb):
+    '''
+    Record the measured peak RSS of a finished run.
+    '''
+    mb = maxrss_kb / 1024.0
+    if mb > history.get(key, 0.0):
+        history[key] = mb
+    return
+
+
+def load_footprint_history(metrics):
+    '''
+    Build the history from the records of load_task_metrics.
+    '''
+    history = new_footprint_history()
+    for m in metrics:
+        if 'footprint' in m and m.get('exitcode', 1) == 0:
+            add_footprint(history, tuple(m['footprint']), m['maxrss_kb'])
+    return history
+
+
+def estimate_task_memory_mb(key, history,
+                            mem_base_mb = 200.0,
+                            mem_per_cell_kb = 50.0,
+                            margin = 1.2):
+    '''
+    Return the estimated memory of a task in MB, and how it was estimated.
+    '''
+    if key in history:
+        return history[key] * margin, 'measured'
+    n_cells = key[0] if key[0] is not None else 10000
+    return mem_base_mb + mem_per_cell_kb * n_cells / 1024.0, 'heuristic'
+
+
+def admit_task(est_mb, running, mem_total_mb, mem_available_mb,
+               max_pvmem = 0.9):
+    '''
+    running is a list of (estimated MB, current RSS MB) of the running tasks.
+    Return (True, '') if the task can be started, otherwise (False, reason);
+    if it is over the limit but started anyway because nothing is running,
+    return (True, reason).
+    '''
+    mem_used_mb = mem_total_mb - mem_available_mb
+    growth_mb = sum([max(0.0, e - r) for e, r in running])
+    projected_mb = mem_used_mb + growth_mb + est_mb
+    limit_mb = mem_total_mb * max_pvmem
+    if projected_mb > limit_mb:
+        return len(running) == 0, ('projected memory {0:.0f} MB (in use {1:.0f}, ' + \
+                       'running tasks growth {2:.0f}, new task {3:.0f}) ' + \
+                       '> limit {4:.0f} MB').format(
+                           projected_mb, mem_used_mb, growth_mb, est_mb,
+                           limit_mb)
+    return True, ''
@@ -0,0 +1,113 @@
+'''
+Feedback control of the number of tasks main_loop runs at once on a host,
+within (min_task, max_task).
+
+Every interval_seconds, the throughput of the host over the interval is
+measured as the CPU time of the runs finished in it per wall second (the
+model-hours completed per wall-hour).  Then the target is
+    lowered by one, if the host is under pressure: load average per core
+        above max_load, memory use above max_pvmem, swap use above
+        max_pswap, or I/O wait above max_iowait;
+    put back, if the last step raised it and the throughput did not rise
+        by min_gain; the target is then held for hold_intervals intervals
+        before trying again;
+    raised by one, if all the slots were in use over the interval;
+    kept otherwise, or if fewer than min_finished runs finished.
+main_loop still reads <host>.maxtasknum, which overrides the target while
+it is not empty.
+'''
+
+
+def new_autoscaler(n_task, min_task, max_task,
+                   interval_seconds = 1800.0,
+                   min_gain = 0.05,
+                   hold_intervals = 4,
+                   min_finished = 2,
+                   max_load = 1.0,
+                   max_pvmem = 0.85,
+                   max_pswap = 0.1,
+                   max_iowait = 0.2):
+    return {'n': max(min_task, min(max_task, n_task)),
+            'min_task': min_task,
+            'max_task': max_task,
+            'interval_seconds': interval_seconds,
+            'min_gain': min_gain,
+            'hold_intervals': hold_intervals,
+            'min_finished': min_finished,
+            'limits': {'load': max_load, 'pvmem': max_pvmem,
+                       'pswap': max_pswap, 'iowait': max_iowait},
+            't_interval': None,
+            't_tick': None,
+            'cpu_seconds': 0.0,
+            'slot_seconds': 0.0,
+            'n_finished': 0,
+            'last': None,
+            'hold': 0}
+
+
+def record_tick(a, t, n_task_running):
+    '''
+    Called on each pass of main_loop with the number of running tasks.
+    '''
+    if a['t_tick'] is not None:
+        a['slot_seconds'] += n_task_running * (t - a['t_tick'])
+    else:
+        a['t_interval'] = t
+    a['t_tick'] = t
+    return
+
+
+def record_finished(a, metrics):
+    '''
+    Called with the record of each successful run (see reap_task).
+    '''
+    a['cpu_seconds'] += metrics['utime_seconds'] + metrics['stime_seconds']
+    a['n_finished'] += 1
+    return
+
+
+def update_target(a, t, check_pressure):
+    '''
+    check_pressure is called at the end of each interval, and returns the
+    load as functions.check_pressure does.  Return the target number of
+    tasks, and the reason if it has just changed, otherwise None.
+    '''
+    if a['t_interval'] is None or t - a['t_interval'] < a['interval_seconds']:
+        return a['n'], None
+    pressure = check_pressure()
+    dt = t - a['t_interval']
+    throughput = a['cpu_seconds'] / dt
+    mean_running = a['slot_seconds'] / dt
+    n_finished = a['n_finished']
+    a['t_interval'] = t
+    a['cpu_seconds'] = a['slot_seconds'] = 0.0
+    a['n_finished'] = 0
+    #
+    n = a['n']
+    over = ['{0:s} {1:.2f} > {2:.2f}'.format(k, pressure[k], v)
+            for k, v in sorted(a['limits'].items())
+            if pressure.get(k) is not None and pressure[k] > v]
+    if len(over) > 0:
+        a['n'] = max(a['min_task'], n - 1)
+        a['hold'] = a['hold_intervals']
+        reason = 'under pressure (' + ', '.join(over) + ')'
+    elif n_finished < a['min_finished']:
+        return n, None
+    elif a['last'] is not None and a['last'][0] < n and \
+            throughput <= a['last'][1] * (1.0 + a['min_gain']):
+        a['n'] = a['last'][0]
+        a['hold'] = a['hold_intervals']
+        reason = ('throughput {0:.2f} with {1:d} tasks is no better than ' + \
+                  '{2:.2f} with {3:d}').format(throughput, n,
+                                              a['last'][1], a['last'][0])
+    elif a['hold'] > 0:
+        a['hold'] -= 1
+        reason = None
+    elif mean_running >= n - 0.5:
+        a['n'] = min(a['max_task'], n + 1)
+        reason = 'throughput {0:.2f} with {1:d} tasks, trying one more'.format(
+            throughput, n)
+    else:
+        reason = None
+    a['last'] = (n, throughput)
+    return a['n'], (reason if a['n'] != n else None)
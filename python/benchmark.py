@@ -0,0 +1,284 @@
+'''
+Benchmarks of the orchestration layer itself, runnable on one Linux box:
+    template        update_a_template and generate_a_config_file, per call
+    generate        generate_config_files on synthetic grids of 10^2 to
+                    max_points points, serial and with n_workers processes
+    claim_file      latency of a claim from the task file (open_and_lock_file,
+                    check_task_todo, update_task_file) with n_workers local
+                    workers claiming concurrently
+    claim_db        the same with the task database (task_queue.claim_tasks)
+    main_loop       the time of one pass of main_loop, running tasks that
+                    exit at once
+The results are written as JSON, with the version of the code, so that
+they can be compared between versions:
+    python benchmark.py result.json [max_points [n_workers]]
+'''
+
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import time
+
+template_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            '..', 'template')
+
+
+def load_benchmark_templates():
+    import main as M
+    from functions import load_templates
+    return load_templates(template_dir, M.templates_info), M.section_keys
+
+
+def synthetic_param_collection(n_points):
+    return {'sptype': ['G'], 'mdust': [1e-4], 'd2g': [1e-2], 'rout': [4e2],
+            'rin': [10**(-1.0 + 3.0 * i / n_points) for i in xrange(n_points)]}
+
+
+def latency_stats(t):
+    '''
+    Summary of a list of durations in seconds.
+    '''
+    t = sorted(t)
+    n = len(t)
+    if n == 0:
+        return {'n': 0}
+    return {'n': n,
+            'mean_ms': 1e3 * sum(t) / n,
+            'p50_ms': 1e3 * t[n // 2],
+            'p95_ms': 1e3 * t[min(n - 1, int(n * 0.95))],
+            'max_ms': 1e3 * t[-1]}
+
+
+def bench_template(n_calls = 2000):
+    from functions import update_a_template, generate_a_config_file
+    templates, section_keys = load_benchmark_templates()
+    data = list(templates['disk']['data'])
+    t0 = time.time()
+    for i in xrange(n_calls):
+        update_a_template(data, 'a_disk%andrews_gas%rin',
+                          '{0:.4e}'.format(1.0 + i))
+    t_update = (time.time() - t0) / n_calls
+    generate_a_config_file(templates, section_keys = section_keys)
+    n = max(1, n_calls // 10)
+    t0 = time.time()
+    for i in xrange(n):
+        generate_a_config_file(templates, rin = 1.0 + 1e-3 * i,
+                               dump_dir = '/d/', dump_sub_dir = 'run/',
+                               iter_dir = '/r/run/',
+                               section_keys = section_keys)
+    t_generate = (time.time() - t0) / n
+    return [{'name': 'template', 'params': {'n_calls': n_calls},
+             'update_a_template_us': 1e6 * t_update,
+             'generate_a_config_file_us': 1e6 * t_generate}]
+
+
+def bench_generate(work_dir, max_points = 100000, n_workers = 4):
+    from functions import generate_config_files
+    templates, section_keys = load_benchmark_templates()
+    results = []
+    n_points = 100
+    while n_points <= max_points:
+        for n_proc in sorted(set([1, n_workers])):
+            d = os.path.join(work_dir, 'generate')
+            os.makedirs(d)
+            t0 = time.time()
+            generate_config_files(templates,
+                                  base_dir = work_dir,
+                                  storage_dir = 'dump/',
+                                  res_dir = 'res/',
+                                  config_dir = d,
+                                  section_keys = section_keys,
+                                  param_collection =
+                                      synthetic_param_collection(n_points),
+                                  lut_fname = 'LUT.dat',
+                                  n_proc = n_proc,
+                                  fname_task = os.path.join(d, 'tasks'),
+                                  executable = '/bin/true')
+            t = time.time() - t0
+            shutil.rmtree(d)
+            results.append({'name': 'generate',
+                            'params': {'n_points': n_points,
+                                       'n_proc': n_proc},
+                            'seconds': t,
+                            'points_per_second': n_points / t})
+        n_points *= 10
+    return results
+
+
+def _claim_file_worker(fname_task, q):
+    from functions import open_and_lock_file, unlock_file, \
+                          check_task_todo, update_task_file
+    t = []
+    n_locked = 0
+    while True:
+        # The latency of a claim includes its waits for the lock.
+        t0 = time.time()
+        while True:
+            sfopen, f = open_and_lock_file(fname_task)
+            if sfopen == 'success':
+                break
+            n_locked += 1
+            time.sleep(0.001)
+        s_task = check_task_todo(f)
+        if s_task != 'FINISHED':
+            update_task_file(f)
+        unlock_file(fname_task)
+        f.close()
+        if s_task == 'FINISHED':
+            break
+        t.append(time.time() - t0)
+    q.put((t, n_locked))
+    return
+
+
+def _claim_db_worker(fname_db, rank, q):
+    import task_queue as tq
+    conn = tq.open_task_db(fname_db)
+    t = []
+    while True:
+        t0 = time.time()
+        claimed = tq.claim_tasks(conn, 'bench{0:d}'.format(rank), n = 1)
+        if len(claimed) == 0:
+            break
+        t.append(time.time() - t0)
+    q.put((t, 0))
+    return
+
+
+def bench_claim(work_dir, n_tasks = 10000, n_workers = 4):
+    '''
+    n_workers processes claim the n_tasks tasks, one at a time.
+    '''
+    import task_queue as tq
+    from multiprocessing import Process, Queue
+    lines = ['/bin/true /conf/conf_run_{0:06d}.dat\n'.format(i)
+             for i in xrange(n_tasks)]
+    fname_task = os.path.join(work_dir, 'tasks')
+    with open(fname_task, 'w') as f:
+        f.writelines(lines)
+    fname_db = os.path.join(work_dir, 'tasks.sqlite')
+    tq.add_tasks(tq.open_task_db(fname_db), lines)
+    results = []
+    for name, target, args in [
+            ('claim_file', _claim_file_worker, lambda i, q: (fname_task, q)),
+            ('claim_db', _claim_db_worker, lambda i, q: (fname_db, i, q))]:
+        q = Queue()
+        p_s = [Process(target = target, args = args(i, q))
+               for i in xrange(n_workers)]
+        t0 = time.time()
+        for p in p_s:
+            p.start()
+        r = [q.get() for p in p_s]
+        t = time.time() - t0
+        for p in p_s:
+            p.join()
+        latencies = sum([_[0] for _ in r], [])
+        result = {'name': name,
+                  'params': {'n_tasks': n_tasks, 'n_workers': n_workers},
+                  'claims_per_second': len(latencies) / t,
+                  'lock_retries': sum([_[1] for _ in r])}
+        result.update(latency_stats(latencies))
+        results.append(result)
+    return results
+
+
+def bench_main_loop(work_dir, n_tasks = 200, max_task = 8):
+    '''
+    Run n_tasks tasks of /bin/true through main_loop without any waiting,
+    and count its passes.
+    '''
+    import functions
+    templates, section_keys = load_benchmark_templates()
+    d = os.path.join(work_dir, 'main_loop')
+    log_dir = os.path.join(d, 'log')
+    os.makedirs(log_dir)
+    fname_task = os.path.join(d, 'tasks')
+    functions.generate_config_files(templates,
+        base_dir = d, storage_dir = 'dump/', res_dir = 'res/',
+        config_dir = d, section_keys = section_keys,
+        param_collection = synthetic_param_collection(n_tasks),
+        lut_fname = 'LUT.dat', fname_task = fname_task,
+        executable = '/bin/true')
+    n_ticks = [0]
+    check_system_resource = functions.check_system_resource
+    def counting_check_system_resource():
+        n_ticks[0] += 1
+        return check_system_resource()
+    functions.check_system_resource = counting_check_system_resource
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        t0 = time.time()
+        functions.main_loop(host_name = 'bench', max_task = max_task,
+                            max_pcpu = 1.01, log_dir = log_dir,
+                            t_wait_seconds = 0, t_wait_seconds_long = 0,
+                            max_task_fname = os.path.join(d, 'maxtasknum'),
+                            fname_task = fname_task,
+                            stdout_flush_seconds = 0)
+        t = time.time() - t0
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        functions.check_system_resource = check_system_resource
+    return [{'name': 'main_loop',
+             'params': {'n_tasks': n_tasks, 'max_task': max_task},
+             'seconds': t,
+             'ticks': n_ticks[0],
+             'ms_per_tick': 1e3 * t / max(1, n_ticks[0]),
+             'ms_per_task': 1e3 * t / n_tasks}]
+
+
+def code_version():
+    import subprocess
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd = os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(fname_out, max_points = 100000, n_workers = 4):
+    work_dir = tempfile.mkdtemp(prefix = 'rac_bench_')
+    results = []
+    try:
+        for name, f in [
+                ('template', lambda d: bench_template()),
+                ('generate', lambda d: bench_generate(d, max_points,
+                                                      n_workers)),
+                ('claim', lambda d: bench_claim(d, n_workers = n_workers)),
+                ('main_loop', lambda d: bench_main_loop(d))]:
+            d = os.path.join(work_dir, name)
+            os.makedirs(d)
+            print 'Running the {0:s} benchmark...'.format(name)
+            results.extend(f(d))
+            shutil.rmtree(d)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    report = {'version': code_version(),
+              'host': socket.gethostname(),
+              'python': sys.version.split()[0],
+              'n_cpu': os.sysconf('SC_NPROCESSORS_ONLN'),
+              'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+              'results': results}
+    with open(fname_out, 'w') as f:
+        json.dump(report, f, indent=1, sort_keys=True)
+    return report
+
+
+if __name__ == '__main__':
+    usage = 'Usage: python benchmark.py result.json [max_points [n_workers]]'
+    if len(sys.argv) < 2 or len(sys.argv) > 4:
+        print usage
+        sys.exit(1)
+    report = run_benchmarks(sys.argv[1],
+        max_points = int(sys.argv[2]) if len(sys.argv) > 2 else 100000,
+        n_workers = int(sys.argv[3]) if len(sys.argv) > 3 else 4)
+    for r in report['results']:
+        print r['name'], json.dumps(r['params'], sort_keys=True), \
+              json.dumps(dict([(k, v) for k, v in r.items()
+                               if k not in ('name', 'params')]),
+                         sort_keys=True)
@@ -0,0 +1,158 @@
+'''
+Give each task main_loop launches its own set of cores, so that concurrent
+tasks do not oversubscribe the cores with their OpenMP/BLAS threads, and do
+not migrate between cores and NUMA nodes.
+
+A core pool holds the online CPUs of the host, grouped by NUMA node.  Each
+task gets cores_per_task free cores, from one node if one has enough free,
+and the process is pinned to them before it starts (sched_setaffinity from
+the child, so that every thread it creates inherits the mask; libc and the
+mask are prepared in the parent, so that the child only makes the call).  The
+thread-count variables in thread_env_vars are set to the number of cores.
+The cores go back to the pool when the task is reaped.  A pool dividing
+the cores evenly follows the changes of max_task (resize_core_pool); a task
+that finds too few free cores runs unpinned.
+'''
+
+import os
+
+thread_env_vars = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS',
+                   'MKL_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS',
+                   'NUMEXPR_NUM_THREADS')
+
+
+def parse_cpu_list(s):
+    '''
+    Parse a list of CPUs as in /sys, e.g. '0-3,8-11'.
+    '''
+    cpus = []
+    for r in s.strip().split(','):
+        if len(r) == 0:
+            continue
+        if '-' in r:
+            a, b = r.split('-')
+            cpus.extend(range(int(a), int(b) + 1))
+        else:
+            cpus.append(int(r))
+    return cpus
+
+
+def read_cpu_list(fname):
+    try:
+        with open(fname, 'r') as f:
+            return parse_cpu_list(f.read())
+    except (IOError, ValueError):
+        return None
+
+
+def numa_nodes():
+    '''
+    Return the lists of the online CPUs of each NUMA node.
+    '''
+    import glob
+    online = read_cpu_list('/sys/devices/system/cpu/online')
+    if online is None:
+        online = range(os.sysconf('SC_NPROCESSORS_ONLN'))
+    nodes = []
+    for fname in sorted(glob.glob('/sys/devices/system/node/node*/cpulist')):
+        cpus = [_ for _ in (read_cpu_list(fname) or []) if _ in online]
+        if len(cpus) > 0:
+            nodes.append(cpus)
+    if len(nodes) == 0:
+        nodes = [online]
+    return nodes
+
+
+def new_core_pool(cores_per_task, max_task=None, nodes=None):
+    '''
+    With cores_per_task = 0, the cores are divided evenly between max_task
+    tasks.  nodes are the lists of the CPUs of each NUMA node, those of
+    this host by default.
+    '''
+    if nodes is None:
+        nodes = numa_nodes()
+    pool = {'nodes': nodes,
+            'n_cpu': sum([len(_) for _ in nodes]),
+            'free': set(sum(nodes, [])),
+            'auto': cores_per_task == 0,
+            'cores_per_task': cores_per_task}
+    if pool['auto']:
+        resize_core_pool(pool, max_task)
+    else:
+        pool['cores_per_task'] = min(cores_per_task, pool['n_cpu'])
+    return pool
+
+
+def resize_core_pool(pool, max_task):
+    '''
+    Divide the cores evenly between max_task tasks again, if the pool was
+    made with cores_per_task = 0.  The running tasks keep their cores.
+    Return True if the number of cores per task has changed.
+    '''
+    if not pool['auto']:
+        return False
+    n = max(1, pool['n_cpu'] // max(1, max_task))
+    changed = (n != pool['cores_per_task'])
+    pool['cores_per_task'] = n
+    return changed
+
+
+def allocate_cores(pool):
+    '''
+    Return the cores of a new task, or None if not enough are free.
+    '''
+    n = pool['cores_per_task']
+    free = [[c for c in node if c in pool['free']] for node in pool['nodes']]
+    fits = [_ for _ in free if len(_) >= n]
+    if len(fits) > 0:
+        # The fullest node that has room, to keep the others whole.
+        cores = min(fits, key=len)[:n]
+    elif sum([len(_) for _ in free]) >= n:
+        cores = sum(sorted(free, key=len, reverse=True), [])[:n]
+    else:
+        return None
+    pool['free'].difference_update(cores)
+    return cores
+
+
+def release_cores(pool, cores):
+    if cores is not None:
+        pool['free'].update(cores)
+    return
+
+
+def thread_env(cores):
+    '''
+    The environment of a task pinned to cores.
+    '''
+    env = dict(os.environ)
+    for k in thread_env_vars:
+        env[k] = str(len(cores))
+    return env
+
+
+_libc = None
+
+
+def affinity_setter(cores):
+    '''
+    Return a function that pins the calling process to cores, for the
+    preexec_fn of Popen.  It only makes the system call: find_library runs
+    ldconfig, which must not happen between fork and exec.
+    '''
+    global _libc
+    import ctypes
+    import ctypes.util
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    n_bytes = max(128, (max(cores) // 8 + 1 + 7) // 8 * 8)
+    mask = (ctypes.c_ubyte * n_bytes)()
+    for c in cores:
+        mask[c // 8] |= 1 << (c % 8)
+    sched_setaffinity = _libc.sched_setaffinity
+    size = ctypes.c_size_t(n_bytes)
+    get_errno = ctypes.get_errno
+    def set_affinity():
+        if sched_setaffinity(0, size, mask) != 0:
+            raise OSError(get_errno(), 'sched_setaffinity failed')
+    return set_affinity
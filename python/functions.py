@@ -1,7 +1,20 @@
 import datetime
+import glob
 import time
 import os
 import physical_constants as phy
+import task_queue as tq
+import ledger as lg
+import stdout_capture as sc
+import admission as ad
+import result_cache as rc
+import scratch_staging as ss
+import input_cache as ic
+import result_store as rs
+import status_server as st
+import autoscale as asc
+import cpu_affinity as ca
+import scheduling as sch
 from math import exp, sqrt
 
 spectral_to_temperature = \
@@ -36,35 +49,161 @@ spectral_to_mass = \
 
 
 def load_templates(template_directory, info):
+    '''
+    Load each template once and index it.
+    The loaded lines are kept as a tuple so that they are never modified in
+    place; rendering a config file always works on a copy.
+    '''
     for k in info.keys():
         info[k]['data'] = \
-            load_a_template(os.path.join(template_directory,
-                                         info[k]['fname']))
+            tuple(load_a_template(os.path.join(template_directory,
+                                               info[k]['fname'])))
+        info[k]['index'] = index_a_template(info[k]['data'])
         #print info[k]['data']
     return info
 
 
+def template_declares(templates, key):
+    '''
+    Whether key is assigned in one of the loaded templates, which is taken
+    as the evidence that the solver reads it.
+    '''
+    return len([_ for _ in templates.values() if key in _['index']]) > 0
+
+
 def load_a_template(fname):
     with open(fname, 'r') as f:
         return f.readlines()
 
 
-def update_config_info(templates, info, config_key, comment=''):
+def index_a_template(template):
+    '''
+    Return a dict mapping each key to the number of the first line in which
+    it is assigned, so that a key can be located without scanning.
+    '''
+    index = {}
+    for i, t in enumerate(template):
+        s = t.split()
+        if len(s) == 0:
+            continue
+        if s[0] not in index:
+            index[s[0]] = i
+    return index
+
+
+def format_config_value(value):
+    '''
+    Format a python value as a Fortran namelist value.
+    Return None if the type is not supported.
+    '''
+    if type(value) == float:
+        return '{0:.4e}'.format(value)
+    elif type(value) == int:
+        return '{0:d}'.format(value)
+    elif type(value) == str:
+        return '\'{0:s}\''.format(value)
+    elif type(value) == bool:
+        return '.true.' if value else '.false.'
+    elif type(value) in (list, tuple):
+        s = [format_config_value(_) for _ in value]
+        return None if None in s else '  '.join(s)
+    else:
+        return None
+
+
+def render_a_template(section, info, comment=''):
+    '''
+    Apply the key-value pairs in info to a copy of a loaded template section
+    and return the new list of lines.  The section itself is not changed.
+    Keys not found in the template are inserted at the top of the section,
+    just after the namelist header, as update_a_template does.
+    '''
+    data = list(section['data'])
+    index = section['index']
+    missing = []
     for k in info.keys():
-        if type(info[k]) == float:
-            update_a_template(templates[config_key]['data'],
-                k, '{0:.4e}'.format(info[k]), comment=comment)
-        elif type(info[k]) == int:
-            update_a_template(templates[config_key]['data'],
-                k, '{0:d}'.format(info[k]), comment=comment)
-        elif type(info[k]) == str:
-            update_a_template(templates[config_key]['data'],
-                k, '\'{0:s}\''.format(info[k]), comment=comment)
-        elif type(info[k]) == bool:
-            update_a_template(templates[config_key]['data'],
-                k, '.true.' if info[k] else '.false.', comment=comment)
+        v = format_config_value(info[k])
+        if v is None:
+            continue
+        c = '  ' + k + ' = ' + v + comment + '\n'
+        i = index.get(k)
+        if i is None:
+            missing.append(c)
         else:
-            pass
+            data[i] = c
+    if len(missing) > 0:
+        missing.reverse()
+        data[1:1] = missing
+    return data
+
+
+def parse_config_value(s):
+    '''
+    Convert a Fortran namelist value to a python value.  Values that are
+    not a number, a logical or a quoted string are returned as strings.
+    '''
+    s = s.strip()
+    if s.lower() in ('.true.', 't'):
+        return True
+    if s.lower() in ('.false.', 'f'):
+        return False
+    if len(s) >= 2 and s[0] == s[-1] and s[0] in '\'"':
+        return s[1:-1]
+    try:
+        return int(s)
+    except ValueError:
+        pass
+    try:
+        return float(s.replace('D', 'e').replace('d', 'e'))
+    except ValueError:
+        return s
+
+
+def read_config_values(fname, keys=None):
+    '''
+    Return a dict of the values assigned in a config file, optionally only
+    for the given keys.  The first assignment of a key is used.
+    '''
+    return parse_config_lines(load_file_lines(fname), keys=keys)
+
+
+def parse_config_lines(lines, keys=None):
+    values = {}
+    for line in lines:
+        s = line.split('=', 1)
+        if len(s) != 2:
+            continue
+        k = s[0].strip()
+        if len(k) == 0 or k[0] in '!&' or ' ' in k:
+            continue
+        if k in values or (keys is not None and k not in keys):
+            continue
+        v = s[1]
+        if '!' in v and v.strip()[0] not in '\'"':
+            v = v[:v.index('!')]
+        elif '!' in v:
+            q = v.strip()[0]
+            i = v.find(q, v.index(q)+1)
+            v = v[:i+1]
+        values[k] = parse_config_value(v)
+    return values
+
+
+def run_output_dirs(values):
+    '''
+    Return the iteration files directory and the dump directory of a run,
+    from the values of its config file.
+    '''
+    return (values['a_disk_iter_params%iter_files_dir'],
+            os.path.join(values['a_disk_iter_params%dump_common_dir'],
+                         values['a_disk_iter_params%dump_sub_dir_out']))
+
+
+def task_config_fname(s_task):
+    '''
+    The config file of a task is the last word of its command line.
+    '''
+    return s_task.split()[-1]
 
 
 def update_a_template(template, key, new_value, comment=''):
@@ -74,6 +213,8 @@ def update_a_template(template, key, new_value, comment=''):
           key = value,
     then replace value with new_value.
     Note that a key never contains space.
+    This changes the template in place; use render_a_template on a loaded
+    template section to get an updated copy instead.
     '''
     c = '  ' + key + ' = ' + new_value + comment + '\n'
     not_found = True
@@ -101,16 +242,11 @@ def generate_a_config_file(templates,
                            dist = 100.0,
                            dump_dir = None,
                            dump_sub_dir = None,
+                           dump_sub_dir_in = None,
                            iter_dir = None,
                            section_keys = None,
                            ):
     #
-    def template_to_str(template):
-        s = ''
-        for k in section_keys:
-            s += ''.join(template[k]['data'])
-        return s
-    #
     tw_hya_UV_lumi = 7.0e29 # erg s-1, from 900 to 2000 Angstrom
     UV_range = (900.0, 2000.0)
     #
@@ -149,25 +285,542 @@ def generate_a_config_file(templates,
         'a_disk_iter_params%iter_files_dir': iter_dir,
         'a_disk_iter_params%dust2gas_mass_ratio_deflt': d2g,
     }
+    if dump_sub_dir_in is not None:
+        # Warm start from the dump of another run.
+        iter_info['a_disk_iter_params%dump_sub_dir_in'] = dump_sub_dir_in
     rt_info = {
         'raytracing_conf%dist': dist,
     }
     mc_info = {
         'mc_conf%use_blackbody_star': \
             tw_hya_UV_lumi > \
-            calc_star_lumi_bb_CGS(spectral_to_temperature[star_type],
-                                 spectral_to_radius[star_type],
-                                 UV_range[0]*1e-8, UV_range[1]*1e-8),
+            calc_star_lumi_bb_CGS_cached(spectral_to_temperature[star_type],
+                                         spectral_to_radius[star_type],
+                                         UV_range[0]*1e-8, UV_range[1]*1e-8),
         'mc_conf%TdustMax': max(2e3, est_Tdust(spectral_to_temperature[star_type],
                                      spectral_to_radius[star_type], rin) * 2.0)
     }
     #
-    update_config_info(templates, disk_info, 'disk', comment=comment)
-    update_config_info(templates, grid_info, 'grid', comment=comment)
-    update_config_info(templates, iter_info, 'iter', comment=comment)
-    update_config_info(templates, rt_info,   'rt',   comment=comment)
-    update_config_info(templates, mc_info,   'mc',   comment=comment)
-    return template_to_str(templates)
+    section_info = {
+        'disk': disk_info,
+        'grid': grid_info,
+        'iter': iter_info,
+        'rt':   rt_info,
+        'mc':   mc_info,
+    }
+    #
+    s = ''
+    for k in section_keys:
+        if k in section_info:
+            s += ''.join(render_a_template(templates[k], section_info[k],
+                                           comment=comment))
+        else:
+            s += ''.join(templates[k]['data'])
+    return s
+
+
+def named_product(**items):
+    from itertools import product, starmap
+    from collections import namedtuple
+    Product = namedtuple('Product', items.keys())
+    return starmap(Product, product(*items.values()))
+
+
+def grid_points(param_collection, param_points=None):
+    '''
+    The parameters of the grid points, as dicts: those of the Cartesian
+    product of param_collection, or param_points if it is given.
+    '''
+    if param_points is not None:
+        return (dict(_) for _ in param_points)
+    return (_._asdict() for _ in named_product(**param_collection))
+
+
+def grid_run_id(p):
+    '''
+    A run ID that only depends on the parameters of the grid point, so that
+    it does not change when the grid is extended.
+    '''
+    import hashlib
+    s = ','.join(['{0:s}={1!r}'.format(k, p[k]) for k in sorted(p.keys())])
+    return hashlib.sha1(s).hexdigest()[:12]
+
+
+def render_a_grid_point(templates, run_id, p,
+                        base_dir = None,
+                        storage_dir = None,
+                        res_dir = None,
+                        section_keys = None,
+                        warm_start_runs = None):
+    '''
+    Render the config file of the grid point run_id with parameters p.
+    If warm_start_runs is given (see warm_start.py), the run starts from the
+    dump of the nearest finished run, if any.
+    Return the config file name, its content, and the line for the LUT.
+    '''
+    sub_dir = 'run_' + run_id
+    #
+    dump_sub_dir_in = None
+    if warm_start_runs is not None:
+        import warm_start as ws
+        neighbour = ws.nearest_run(warm_start_runs, p, exclude = run_id)
+        if neighbour is not None:
+            dump_sub_dir_in = 'run_' + neighbour + '/'
+    #
+    cf = generate_a_config_file(templates,
+          rin = p['rin'],
+          rout = p['rout'],
+          d2g = p['d2g'],
+          dust_mass = p['mdust'],
+          star_type = p['sptype'],
+          dump_dir = os.path.join(base_dir, storage_dir),
+          dump_sub_dir = sub_dir + '/',
+          dump_sub_dir_in = dump_sub_dir_in,
+          iter_dir = os.path.join(base_dir, res_dir, sub_dir + '/'),
+          section_keys = section_keys,
+          )
+    #
+    return 'conf_' + sub_dir + '.dat', cf, grid_point_lut_line(run_id, p)
+
+
+def grid_point_lut_line(run_id, p):
+    return run_id + ': ' + \
+        ('rin = {0:.2e}, rout = {1:.2e}, d2g = {2:.2e}, ' + \
+         'mdust = {3:.2e}, spectralType = {4:s}').\
+        format(p['rin'], p['rout'], p['d2g'], p['mdust'], p['sptype'])
+
+
+# A lazy task carries the parameters of its grid point instead of the name
+# of a config file:
+#     executable lazy:<run_id> rin=... rout=... d2g=... mdust=... sptype=...
+# Its config file is rendered by the worker that claims it.
+lazy_task_tag = 'lazy:'
+
+
+def lazy_task_line(executable, run_id, p):
+    return executable + ' ' + lazy_task_tag + run_id + ' ' + \
+           ' '.join(['{0:s}={1!r}'.format(k, p[k]) for k in sorted(p.keys())])
+
+
+def parse_lazy_task(s_task):
+    '''
+    Return (executable, run_id, p) of a lazy task, or None for other tasks.
+    The values of p have the types they had in lazy_task_line.
+    '''
+    import ast
+    s = s_task.split()
+    if len(s) < 2 or not s[1].startswith(lazy_task_tag):
+        return None
+    p = {}
+    for kv in s[2:]:
+        k, v = kv.split('=', 1)
+        p[k] = ast.literal_eval(v)
+    return s[0], s[1][len(lazy_task_tag):], p
+
+
+def render_lazy_task(s_task, lazy_render, line_tasks=None):
+    '''
+    Render the config file of a lazy task into lazy_render['local_dir'].
+    lazy_render also holds the templates and the arguments of
+    render_a_grid_point.  The config files of lazy line tasks are derived
+    from the config file of their parent run with line_tasks.
+    Return the command line to run and the config file name.
+    '''
+    executable, run_id, p = parse_lazy_task(s_task)
+    parent_id, slug = (run_id.split('.', 1) + [None])[:2]
+    cf_fname, cf, lut_line = render_a_grid_point(
+        lazy_render['templates'], parent_id, p,
+        base_dir = lazy_render['base_dir'],
+        storage_dir = lazy_render['storage_dir'],
+        res_dir = lazy_render['res_dir'],
+        section_keys = lazy_render['section_keys'],
+        warm_start_runs = lazy_render.get('warm_start_runs'))
+    if slug is not None:
+        line_name = [_ for _ in line_tasks.keys() if line_slug(_) == slug][0]
+        cf_fname = 'conf_run_' + run_id + '.dat'
+        cf = render_a_line_config(cf, line_name, line_tasks[line_name])
+    if not os.path.exists(lazy_render['local_dir']):
+        os.makedirs(lazy_render['local_dir'])
+    fname = os.path.join(lazy_render['local_dir'], cf_fname)
+    with open(fname, 'w') as f:
+        f.write(cf)
+    return executable + ' ' + fname, fname
+
+
+def discard_lazy_config(fname_config, lazy_render, failed=False):
+    '''
+    Remove the rendered config file of a lazy task, keeping a copy in
+    lazy_render['archive_dir'] if the task failed.
+    '''
+    import shutil
+    if failed:
+        if not os.path.exists(lazy_render['archive_dir']):
+            os.makedirs(lazy_render['archive_dir'])
+        shutil.copy2(fname_config, lazy_render['archive_dir'])
+    os.remove(fname_config)
+    return
+
+
+# Line tasks only do the ray tracing of one line, from the data dump of a
+# finished run (their parent).  These are the iteration_configure values that
+# switch off the other stages; the raytracing_configure values of each line
+# are given to main_loop in line_tasks.  The dump of the parent is given in
+# a_disk_iter_params%dump_sub_dir_in, which is not in the iteration template
+# shipped here: add it there once the solver is known to read it.
+line_task_iter_info = {
+    'a_disk_iter_params%n_iter': 0,
+    'a_disk_iter_params%do_vertical_struct': False,
+    'a_disk_iter_params%redo_montecarlo': False,
+    'a_disk_iter_params%do_continuum_transfer': False,
+    'a_disk_iter_params%do_line_transfer': True,
+}
+
+
+def line_slug(line_name):
+    '''
+    'CO (6-5)' -> 'CO_6-5'
+    '''
+    import re
+    return re.sub(r'[^A-Za-z0-9+-]+', '_', line_name).strip('_')
+
+
+def line_run_id(run_id, line_name):
+    return run_id + '.' + line_slug(line_name)
+
+
+def is_line_task(s_task):
+    import runtime_model as rm
+    key = rm.lut_key_of_task(s_task)
+    return key is not None and '.' in key
+
+
+def split_config_sections(lines):
+    '''
+    Split the lines of a config file into its namelists.
+    '''
+    sections = []
+    for line in lines:
+        if line.strip().startswith('&') or len(sections) == 0:
+            sections.append([])
+        sections[-1].append(line)
+    return sections
+
+
+def render_a_config(cf, info, comment=''):
+    '''
+    Apply the key-value pairs in info to the content of a whole config file.
+    A key missing from the file is inserted into the namelist assigning
+    other keys with the same prefix (e.g. a_disk_iter_params).
+    '''
+    s = ''
+    for lines in split_config_sections(cf.splitlines(True)):
+        section = {'data': lines, 'index': index_a_template(lines)}
+        prefixes = set([k.split('%')[0] for k in section['index'].keys()])
+        s += ''.join(render_a_template(section,
+            dict([(k, v) for k, v in info.items()
+                  if k.split('%')[0] in prefixes]), comment=comment))
+    return s
+
+
+def render_a_line_config(cf, line_name, line_info):
+    '''
+    Derive the config file of a line task from the config file cf of its
+    parent run.  The line task reads the dump of the parent and writes its
+    outputs into sub directories of those of the parent named after the
+    line.
+    '''
+    keys = ('a_disk_iter_params%dump_sub_dir_out',
+            'a_disk_iter_params%iter_files_dir')
+    values = parse_config_lines(cf.splitlines(), keys=keys)
+    slug = line_slug(line_name) + '/'
+    info = dict(line_task_iter_info)
+    info.update({
+        'a_disk_iter_params%dump_sub_dir_in': values[keys[0]],
+        'a_disk_iter_params%dump_sub_dir_out':
+            os.path.join(values[keys[0]], slug),
+        'a_disk_iter_params%iter_files_dir':
+            os.path.join(values[keys[1]], slug),
+    })
+    info.update(line_info)
+    return render_a_config(cf, info, comment='  ! GeneratedAutomatically')
+
+
+def line_tasks_of_run(s_task, fname_config, line_tasks):
+    '''
+    Return the task lines of the line tasks of the finished run s_task, whose
+    config file is fname_config.  For a lazy run they are lazy tasks as
+    well; otherwise their config files are written next to fname_config.
+    '''
+    lazy = parse_lazy_task(s_task)
+    if lazy is not None:
+        executable, run_id, p = lazy
+        return [lazy_task_line(executable, line_run_id(run_id, _), p)
+                for _ in sorted(line_tasks.keys())]
+    import runtime_model as rm
+    executable = ' '.join(s_task.split()[:-1])
+    run_id = rm.lut_key_of_task(s_task)
+    cf = ''.join(load_file_lines(fname_config))
+    tasks = []
+    for line_name in sorted(line_tasks.keys()):
+        fname = os.path.join(os.path.dirname(fname_config), 'conf_run_' +
+                             line_run_id(run_id, line_name) + '.dat')
+        with open(fname, 'w') as f:
+            f.write(render_a_line_config(cf, line_name, line_tasks[line_name]))
+        tasks.append(executable + ' ' + fname)
+    return tasks
+
+
+def _grid_point_id(i, p, stable_run_ids):
+    if stable_run_ids:
+        return grid_run_id(p)
+    return '{0:03d}'.format(i+1)
+
+
+def _render_config_worker(rank, n_proc, q, templates, param_collection,
+                          param_points, kwargs, stable_run_ids, existing,
+                          lazy, render_always):
+    '''
+    Render every n_proc-th grid point, starting from rank, and put the
+    results into the queue q.  The state of the star luminosity cache of
+    this worker is put at the end, then a None; only the parent process
+    writes to the cache file.
+    '''
+    import traceback
+    star_lumi_cache['fname'] = None
+    star_lumi_cache['hits'] = star_lumi_cache['misses'] = 0
+    try:
+        for i, p in enumerate(grid_points(param_collection, param_points)):
+            if i % n_proc != rank:
+                continue
+            run_id = _grid_point_id(i, p, stable_run_ids)
+            action = existing.get(run_id, 'new')
+            if action == 'skip':
+                q.put((i+1, None, None, None, None, action))
+                continue
+            if lazy and not render_always:
+                q.put((i+1, 'conf_run_' + run_id + '.dat', None,
+                       grid_point_lut_line(run_id, p), p, action))
+                continue
+            q.put((i+1,) + render_a_grid_point(templates, run_id, p,
+                                               **kwargs) + (p, action))
+        q.put((0, None, None, None, star_lumi_cache_state(), 'stats'))
+    except Exception:
+        q.put((0, None, None, traceback.format_exc(), None, 'error'))
+    q.put(None)
+    return
+
+
+def existing_grid_points(config_dir, lut_fname, known_tasks):
+    '''
+    Compare the runs already in the LUT with the tasks known to have been
+    queued or run (known_tasks), for extending a grid.
+    Return a dict from run ID to 'skip' for the runs that are known, and to
+    'requeue' for the runs in the LUT whose tasks have been lost.
+    '''
+    import runtime_model as rm
+    known_ids = set([rm.lut_key_of_task(_) for _ in known_tasks])
+    existing = {}
+    for run_id in rm.load_lut(os.path.join(config_dir, lut_fname)).keys():
+        existing[run_id] = 'skip' if run_id in known_ids else 'requeue'
+    return existing
+
+
+def known_task_lines(log_dir, fname_task = None, fname_task_db = None):
+    '''
+    The tasks that are queued, or have been claimed or run by any host.
+    '''
+    known = set(lg.open_ledger(log_dir, 'extend',
+        fname_finished_all = os.path.join(log_dir, 'finished.all'))['state'])
+    known.update([_.strip() for _ in
+                  load_file_lines(os.path.join(log_dir, 'finished.all'))])
+    if fname_task_db is not None:
+        known.update([str(_[0]) for _ in
+            tq.open_task_db(fname_task_db).execute('SELECT task FROM tasks')])
+    elif fname_task is not None:
+        known.update([_.strip() for _ in load_file_lines(fname_task)])
+    return known
+
+
+def append_to_task_file(fname_task, lines, t_wait_seconds=1):
+    '''
+    Append lines to the task file while holding its lock, so that the
+    workers can consume the task file while it is still being written.
+    '''
+    while True:
+        sfopen, f = open_and_lock_file(fname_task)
+        if sfopen == 'success':
+            break
+        time.sleep(t_wait_seconds)
+    try:
+        f.seek(0, 2)
+        f.writelines(lines)
+    finally:
+        f.close()
+        unlock_file(fname_task)
+    return
+
+
+def prepend_to_task_file(fname_task, lines, t_wait_seconds=1):
+    '''
+    Put lines back at the head of the task file while holding its lock,
+    e.g. the tasks a worker has claimed but cannot start.
+    '''
+    while True:
+        sfopen, f = open_and_lock_file(fname_task)
+        if sfopen == 'success':
+            break
+        time.sleep(t_wait_seconds)
+    try:
+        s = f.readlines()
+        f.seek(0)
+        f.truncate()
+        f.writelines(lines + s)
+    finally:
+        f.close()
+        unlock_file(fname_task)
+    return
+
+
+def give_back_tasks(pending, fname_task, task_db, ledger, lazy_render):
+    '''
+    Return claimed tasks that will not be started here to the queue, so
+    that the other hosts can take them.  pending is a list of
+    (task_id, s_task, fname_config), fname_config being None for a lazy
+    task that has not been rendered yet.
+    '''
+    if len(pending) == 0:
+        return
+    if task_db is not None:
+        tq.release_tasks(task_db, [_[0] for _ in pending])
+    else:
+        prepend_to_task_file(fname_task, [_[1] + '\n' for _ in pending])
+    lg.append_events(ledger, 'released', [_[1] for _ in pending])
+    for task_id, s_task, fname_config in pending:
+        if fname_config is not None and parse_lazy_task(s_task) is not None:
+            discard_lazy_config(fname_config, lazy_render)
+    return
+
+
+def sort_task_file(fname_task, priorities, t_wait_seconds=1):
+    '''
+    Reorder the tasks left in the task file by decreasing priority, which
+    is given as a dict from task line to priority.
+    '''
+    while True:
+        sfopen, f = open_and_lock_file(fname_task)
+        if sfopen == 'success':
+            break
+        time.sleep(t_wait_seconds)
+    try:
+        s = f.readlines()
+        s.sort(key=lambda t: -priorities.get(t.strip(), 0.0))
+        f.seek(0)
+        f.truncate()
+        f.writelines(s)
+    finally:
+        f.close()
+        unlock_file(fname_task)
+    return
+
+
+def requeue_orphaned_tasks(fname_task, ledger, lease_seconds, own=False,
+                           stale_seconds=600, log_file=None):
+    '''
+    Put the orphaned tasks of the ledger (see ledger.orphaned_tasks) back
+    at the end of the task file.  Return a list of (task, host).
+    '''
+    if len(lg.orphaned_tasks(ledger, lease_seconds, own=own)) == 0:
+        return []
+    sfopen, f = open_and_lock_file(fname_task, stale_seconds = stale_seconds,
+                                   log_file = log_file)
+    if sfopen != 'success':
+        # Try again next time.
+        return []
+    try:
+        # Another worker may have requeued them in the meantime.
+        lg.update_ledger(ledger)
+        orphans = lg.orphaned_tasks(ledger, lease_seconds, own=own)
+        f.seek(0, 2)
+        f.writelines([_[0] + '\n' for _ in orphans])
+        lg.append_events(ledger, 'requeued', [_[0] for _ in orphans])
+    finally:
+        f.close()
+        unlock_file(fname_task)
+    return orphans
+
+
+def generation_in_progress(fname_generating, stale_seconds=600,
+                           log_file=None):
+    '''
+    Whether the master is still generating the tasks.  A marker file that
+    has not been touched for stale_seconds is ignored (and left for
+    become_master to find).
+    '''
+    try:
+        age = time.time() - os.path.getmtime(fname_generating)
+    except OSError:
+        return False
+    if age <= stale_seconds:
+        return True
+    if log_file is not None:
+        log_event(log_file, 'Ignoring ' + fname_generating + \
+                  ', not touched for {0:.0f} seconds.'.format(age))
+    return False
+
+
+def start_heartbeat(fname, interval_seconds=60):
+    '''
+    Touch fname every interval_seconds from a thread, until stop_heartbeat.
+    '''
+    import threading
+    stop = threading.Event()
+    def beat():
+        while not stop.wait(interval_seconds):
+            try:
+                os.utime(fname, None)
+            except OSError:
+                pass
+    thread = threading.Thread(target = beat)
+    thread.daemon = True
+    thread.start()
+    return {'stop': stop, 'thread': thread}
+
+
+def start_lease_heartbeat(ledger, host_name, lease_seconds,
+                          fname_task_db=None):
+    '''
+    Renew the lease of host_name every lease_seconds / 4 from a thread, until
+    stop_heartbeat, so that it does not expire while the main loop is busy,
+    e.g. copying results.  The thread has its own task database connection.
+    '''
+    import threading
+    import sqlite3
+    stop = threading.Event()
+    def beat():
+        conn = None
+        while True:
+            try:
+                lg.renew_lease(ledger)
+                if fname_task_db is not None:
+                    if conn is None:
+                        conn = tq.open_task_db(fname_task_db)
+                    tq.renew_leases(conn, host_name, lease_seconds)
+            except (IOError, OSError, sqlite3.Error):
+                pass
+            if stop.wait(lease_seconds / 4.0):
+                break
+        if conn is not None:
+            conn.close()
+    thread = threading.Thread(target = beat)
+    thread.daemon = True
+    thread.start()
+    return {'stop': stop, 'thread': thread}
+
+
+def stop_heartbeat(heartbeat):
+    heartbeat['stop'].set()
+    heartbeat['thread'].join()
+    return
 
 
 def generate_config_files(templates,
@@ -178,50 +831,235 @@ def generate_config_files(templates,
                           section_keys = None,
                           param_collection = None,
                           lut_fname = None,
+                          n_proc = 1,
+                          queue_size = 64,
+                          fname_task = None,
+                          fname_task_db = None,
+                          executable = None,
+                          task_batch_size = 16,
+                          heartbeat_seconds = 60,
+                          priority_fn = None,
+                          result_cache = None,
+                          stable_run_ids = False,
+                          existing = None,
+                          lazy = False,
+                          warm_start_runs = None,
+                          param_points = None,
+                          log_dir = None,
                           ):
+    '''
+    Write one config file for each point of the Cartesian product of
+    param_collection, or of the list of points param_points if it is given
+    (see adaptive_sampling.py), and the LUT file.
+    With n_proc > 1 the grid points are rendered by n_proc processes and
+    passed to this process through a queue of size queue_size to be written.
+    The files written are the same in both cases.
+    If fname_task is given, the task lines are appended to it in batches of
+    task_batch_size as the config files are written, in the order of the
+    runs, and the file fname_task + '.generating' exists until all of them
+    are written; it is touched every heartbeat_seconds, so that the workers
+    do not take it as stale however long a batch takes.  If fname_task_db is given
+    instead, the tasks are added to that task database in the same way.
+    If priority_fn is given, priority_fn(p) is the priority of the task of
+    the grid point with parameters p (e.g. its expected run time; see
+    runtime_model.py).  It is stored in the task database.  In the task
+    file, each batch is appended by decreasing priority, and the whole file
+    is reordered once all the tasks are written; the tasks claimed before
+    that are only ordered within their batch.  When a grid is extended, the
+    tasks already in the file get their priorities from their parameters in
+    the LUT (rin, rout, d2g, mdust and sptype, see runtime_model.load_lut).
+    If result_cache is given (see result_cache.py), the outputs of a grid
+    point whose config is already in the cache are restored from it and no
+    task is queued for it.  If log_dir is also given, its task is recorded
+    there as finished (see ledger.py), by the host result_cache.
+    With stable_run_ids, the runs are named by grid_run_id instead of by
+    their position in the grid.  To extend a grid, pass as existing the
+    result of existing_grid_points: the runs marked 'skip' are left alone,
+    the runs marked 'requeue' are queued again, and only the new runs are
+    added to the LUT, which is appended to instead of rewritten.
+    With lazy, no config file is written: the tasks are lazy tasks carrying
+    the parameters of the grid points, rendered by the workers when they
+    claim them (see render_lazy_task).
+    If warm_start_runs is given, each run starts from the dump of the
+    nearest finished run, if any (see warm_start.py).
+    Return the names of the config files that still have to be run.
+    '''
+    if existing is None:
+        existing = {}
+    elif not stable_run_ids:
+        raise ValueError('A grid can only be extended with stable_run_ids.')
+    kwargs = {'base_dir': base_dir,
+              'storage_dir': storage_dir,
+              'res_dir': res_dir,
+              'section_keys': section_keys,
+              'warm_start_runs': warm_start_runs}
     #
-    from itertools import product, starmap
-    from collections import namedtuple
-    def named_product(**items):
-        Product = namedtuple('Product', items.keys())
-        return starmap(Product, product(*items.values()))
-    #
-    counter = 0
     dstamp = datetime.datetime.now().strftime('%Y-%m-%d-%H:%M:%S')
-    info_this = [dstamp]
     cfiles = []
+    task_lines = []
+    task_priorities = {}
+    tasks_restored = []
     #
-    for p in named_product(**param_collection):
-        p = p._asdict()
-        counter += 1
-        sub_dir = 'run_{0:03d}'.format(counter)
-        #
-        cf = generate_a_config_file(templates,
-              rin = p['rin'],
-              rout = p['rout'],
-              d2g = p['d2g'],
-              dust_mass = p['mdust'],
-              star_type = p['sptype'],
-              dump_dir = os.path.join(base_dir, storage_dir),
-              dump_sub_dir = sub_dir + '/',
-              iter_dir = os.path.join(base_dir, res_dir, sub_dir + '/'),
-              section_keys = section_keys,
-              )
-        #
-        info_this.append( \
-            '{0:03d}: '.format(counter) + \
-            ('rin = {0:.2e}, rout = {1:.2e}, d2g = {2:.2e}, ' + \
-             'mdust = {3:.2e}, spectralType = {4:s}').\
-            format(p['rin'], p['rout'], p['d2g'], p['mdust'], p['sptype']))
-        #
-        cf_fname = 'conf_' + sub_dir + '.dat'
-        cfiles.append(cf_fname)
-        #
-        with open(os.path.join(config_dir, cf_fname), 'w') as f:
-              f.writelines(cf)
+    fname_queue = fname_task_db if fname_task_db is not None else fname_task
+    if fname_queue is not None:
+        fname_generating = fname_queue + '.generating'
+        with open(fname_generating, 'w') as f:
+            pass
+    if fname_task_db is not None:
+        task_db = tq.open_task_db(fname_task_db)
+    elif fname_task is not None and len(existing) == 0:
+        with open(fname_task, 'w') as f:
+            pass
+    #
+    if len(existing) == 0:
+        f_lut = open(os.path.join(config_dir, lut_fname), 'w')
+        f_lut.write(dstamp)
+    else:
+        f_lut = open(os.path.join(config_dir, lut_fname), 'a')
     #
-    with open(os.path.join(config_dir, lut_fname), 'w') as f:
-          f.writelines('\n'.join(info_this))
+    def write_config_file(cf_fname, cf):
+        if not lazy:
+            with open(os.path.join(config_dir, cf_fname), 'w') as f:
+                  f.writelines(cf)
+        if result_cache is None:
+            return False
+        iter_dir, dump_dir = run_output_dirs(
+            parse_config_lines(cf.splitlines(), keys=rc.path_keys))
+        return rc.restore_result(result_cache, rc.config_hash(cf),
+                                 iter_dir, dump_dir)
+    #
+    def flush_tasks():
+        if fname_task_db is not None:
+            tq.add_tasks(task_db, task_lines)
+        else:
+            append_to_task_file(fname_task, [_[0] for _ in
+                sorted(task_lines, key=lambda t: -t[1])])
+        del task_lines[:]
+    #
+    def emit(cf_fname, lut_line, p, reused):
+        if lut_line is not None:
+            f_lut.write('\n' + lut_line)
+        if not reused:
+            cfiles.append(cf_fname)
+        if fname_queue is not None:
+            if lazy:
+                run_id = cf_fname[len('conf_run_'):-len('.dat')]
+                s_task = lazy_task_line(executable, run_id, p)
+            else:
+                s_task = executable + ' ' + os.path.join(config_dir, cf_fname)
+            if reused:
+                tasks_restored.append(s_task)
+                return
+            priority = 0.0
+            if priority_fn is not None:
+                priority = priority_fn(p)
+                if fname_task_db is None:
+                    task_priorities[s_task] = priority
+            task_lines.append((s_task + '\n', priority))
+            if len(task_lines) >= task_batch_size:
+                flush_tasks()
+    #
+    if fname_queue is not None:
+        heartbeat = start_heartbeat(fname_generating, heartbeat_seconds)
+    try:
+        if n_proc <= 1:
+            for i, p in enumerate(grid_points(param_collection,
+                                              param_points)):
+                run_id = _grid_point_id(i, p, stable_run_ids)
+                action = existing.get(run_id, 'new')
+                if action == 'skip':
+                    continue
+                if lazy and result_cache is None:
+                    emit('conf_run_' + run_id + '.dat',
+                         grid_point_lut_line(run_id, p)
+                             if action == 'new' else None, p, False)
+                    continue
+                cf_fname, cf, lut_line = \
+                    render_a_grid_point(templates, run_id, p, **kwargs)
+                reused = write_config_file(cf_fname, cf)
+                emit(cf_fname, lut_line if action == 'new' else None,
+                     p, reused)
+        else:
+            from multiprocessing import Process, Queue
+            q = Queue(queue_size)
+            p_s = [Process(target = _render_config_worker,
+                           args = (i, n_proc, q, templates,
+                                   param_collection, param_points, kwargs,
+                                   stable_run_ids, existing, lazy,
+                                   result_cache is not None))
+                   for i in xrange(n_proc)]
+            for _p in p_s:
+                _p.start()
+            #
+            # Config files are written as they come; the LUT and task lines
+            # are emitted in the order of the runs.
+            pending = {}
+            next_counter = 1
+            n_running = n_proc
+            try:
+                while n_running > 0:
+                    r = q.get()
+                    if r is None:
+                        n_running -= 1
+                        continue
+                    counter, cf_fname, cf, lut_line, p, action = r
+                    if action == 'stats':
+                        merge_star_lumi_cache(p)
+                        continue
+                    if action == 'error':
+                        raise RuntimeError('Failed to render the config ' + \
+                                           'files:\n' + lut_line)
+                    if action == 'skip':
+                        pending[counter] = None
+                    elif cf is None:
+                        # Lazy: only the LUT line was rendered.
+                        pending[counter] = (cf_fname,
+                            lut_line if action == 'new' else None, p, False)
+                    else:
+                        reused = write_config_file(cf_fname, cf)
+                        pending[counter] = (cf_fname,
+                            lut_line if action == 'new' else None, p, reused)
+                    while next_counter in pending:
+                        r = pending.pop(next_counter)
+                        if r is not None:
+                            emit(*r)
+                        next_counter += 1
+            finally:
+                for _p in p_s:
+                    if _p.is_alive():
+                        _p.terminate()
+                    _p.join()
+        #
+        if len(task_lines) > 0:
+            flush_tasks()
+        if len(task_priorities) > 0:
+            if len(existing) > 0:
+                # The tasks queued before the extension are sorted with the
+                # new ones, from their parameters in the LUT.
+                import runtime_model as rm
+                f_lut.flush()
+                lut = rm.load_lut(os.path.join(config_dir, lut_fname))
+                for line in load_file_lines(fname_task):
+                    s_task = line.strip()
+                    key = rm.lut_key_of_task(s_task)
+                    if s_task not in task_priorities and key in lut:
+                        task_priorities[s_task] = priority_fn(lut[key])
+            sort_task_file(fname_task, task_priorities)
+        if log_dir is not None and len(tasks_restored) > 0:
+            if not os.path.exists(log_dir):
+                os.makedirs(log_dir)
+            log_finished_all = os.path.join(log_dir, 'finished.all')
+            ledger = lg.open_ledger(log_dir, 'result_cache',
+                                    fname_finished_all = log_finished_all)
+            lg.append_events(ledger, 'finished', tasks_restored)
+            lg.write_ledger_views(ledger,
+                os.path.join(log_dir, 'running.all'), log_finished_all,
+                force = True)
+    finally:
+        f_lut.close()
+        if fname_queue is not None:
+            stop_heartbeat(heartbeat)
+            os.remove(fname_generating)
     return cfiles
 
 
@@ -231,6 +1069,35 @@ def check_system_resource():
             psutil.virtual_memory().percent*0.01)
 
 
+def check_memory_mb():
+    '''
+    Return the total and the available memory of this host in MB.
+    '''
+    import psutil
+    vm = psutil.virtual_memory()
+    return vm.total / 1048576.0, vm.available / 1048576.0
+
+
+def check_pressure():
+    '''
+    Return the load average per core, the fractions of memory and swap in
+    use, and the fraction of CPU time in I/O wait since the last call.
+    '''
+    import psutil
+    return {'load': os.getloadavg()[0] / psutil.cpu_count(),
+            'pvmem': psutil.virtual_memory().percent*0.01,
+            'pswap': psutil.swap_memory().percent*0.01,
+            'iowait': getattr(psutil.cpu_times_percent(), 'iowait', 0.0)*0.01}
+
+
+def check_process_rss_mb(pid):
+    import psutil
+    try:
+        return psutil.Process(pid).memory_info().rss / 1048576.0
+    except Exception:
+        return 0.0
+
+
 def _open_and_lock_file(fname):
     import fcntl
     try:
@@ -250,19 +1117,98 @@ def _unlock_file(f):
     return
 
 
-def open_and_lock_file(fname):
-    import time
-    fname_tmp =fname + '_tmp{0:06d}'.format(int(time.time())%1000000)
-    fname_lock = fname + '.lockfile'
-    if os.path.exists(fname_lock):
-        return 'locked', None
+def create_lock_file(fname_lock):
+    '''
+    Create fname_lock, holding the host name, the pid and the time, unless
+    it already exists.  Linking makes this atomic, also on NFS.
+    Return True if the lock has been taken.
+    '''
+    import socket
+    host = socket.gethostname()
+    fname_tmp = fname_lock + '.' + host + '.{0:d}'.format(os.getpid())
     with open(fname_tmp, 'w') as f:
-        pass
-    os.link(fname_tmp, fname_lock)
-    os.remove(fname_tmp)
+        f.write('{0:s} {1:d} {2:.3f}\n'.format(host, os.getpid(), time.time()))
+    try:
+        os.link(fname_tmp, fname_lock)
+        return True
+    except OSError:
+        return False
+    finally:
+        os.remove(fname_tmp)
+
+
+def stale_lock_reason(fname_lock, stale_seconds=600):
+    '''
+    Return why the lock file is stale: it is older than stale_seconds, or
+    its owner was a process on this host that is gone.  Return None if it
+    is not stale or does not exist.
+    '''
+    import errno
+    import socket
+    try:
+        age = time.time() - os.path.getmtime(fname_lock)
+    except OSError:
+        return None
+    owner = ''.join(load_file_lines(fname_lock)).strip()
+    s = owner.split()
+    if len(s) >= 2 and s[0] == socket.gethostname():
+        try:
+            os.kill(int(s[1]), 0)
+        except OSError as e:
+            if e.errno == errno.ESRCH:
+                return 'its owner ' + owner + ' is gone'
+        except ValueError:
+            pass
+    if age > stale_seconds:
+        return 'held for {0:.0f} seconds by '.format(age) + \
+               (owner if len(owner) > 0 else 'an unknown owner')
+    return None
+
+
+def break_stale_lock(fname_lock, stale_seconds=600):
+    '''
+    Remove fname_lock if it is stale.  Return the reason, or None if the
+    lock has not been broken.
+    '''
+    reason = stale_lock_reason(fname_lock, stale_seconds)
+    if reason is None:
+        return None
+    owner = load_file_lines(fname_lock)
+    fname_broken = fname_lock + '.broken{0:d}'.format(os.getpid())
+    try:
+        os.rename(fname_lock, fname_broken)
+    except OSError:
+        return None
+    if load_file_lines(fname_broken) != owner:
+        # Broken and taken again by another process in the meantime.
+        try:
+            os.link(fname_broken, fname_lock)
+        except OSError:
+            pass
+        os.remove(fname_broken)
+        return None
+    os.remove(fname_broken)
+    return reason
+
+
+def open_and_lock_file(fname, stale_seconds=600, log_file=None):
+    '''
+    Take the lock fname.lockfile and open fname.  A lock older than
+    stale_seconds, or left by a dead process of this host, is broken, and
+    the reason written to log_file if it is given.
+    '''
+    fname_lock = fname + '.lockfile'
+    if not create_lock_file(fname_lock):
+        reason = break_stale_lock(fname_lock, stale_seconds)
+        if reason is None or not create_lock_file(fname_lock):
+            return 'locked', None
+        if log_file is not None:
+            log_event(log_file, 'Broke the stale lock ' + fname_lock + ': ' + \
+                      reason)
     try:
         f = open(fname, 'r+')
     except Exception:
+        os.remove(fname_lock)
         raise
     return 'success', f
 
@@ -279,33 +1225,40 @@ def check_task_todo(f):
         tasklist = f.readlines()
     except:
         return 'FAILED'
+    tasklist = [_.strip() for _ in tasklist if len(_.strip()) > 0]
     if len(tasklist) == 0:
         return 'FINISHED'
     else:
-        return tasklist[0].strip()
+        return tasklist[0]
 
 
-def update_task_file(f):
+def check_tasks_todo(f, n=1):
+    '''
+    Return the first n tasks in the task file, or 'FAILED'.  Blank lines
+    are skipped.
+    '''
+    try:
+        tasklist = f.readlines()
+    except:
+        return 'FAILED'
+    return [_.strip() for _ in tasklist if len(_.strip()) > 0][:n]
+
+
+def update_task_file(f, n=1):
+    '''
+    Remove the first n tasks from the task file, with the blank lines
+    among them.
+    '''
     f.seek(0)
     s = f.readlines()
     f.seek(0)
     f.truncate()
-    if len(s) > 1:
-        f.writelines(s[1:])
-    return
-
-
-def truncate_stdout_file(f_s, nline=2000, wait_time_seconds=180):
-    while True:
-        for fn in f_s:
-            with open(fn, 'r') as f:
-                s = f.readlines()
-                l = len(s)
-            if l > nline:
-                with open(fn, 'w') as f:
-                    f.writelines(s[-nline:])
-                # print 'Truncating stdout file: ', fn
-        time.sleep(wait_time_seconds)
+    i = 0
+    while i < len(s) and n > 0:
+        if len(s[i].strip()) > 0:
+            n -= 1
+        i += 1
+    f.writelines(s[i:])
     return
 
 
@@ -329,10 +1282,198 @@ def wait_for_interaction():
 
 
 
-def exec_task(s_task, f_out):
+def launch_task(s_task, fname_out, nline=2000, flush_seconds=180,
+                fname_out_full=None, cores=None):
+    '''
+    Start the command s_task without waiting for it.  Only the last nline
+    lines of its stdout are kept in fname_out (see stdout_capture.py).
+    If cores is given, the task is pinned to them, with as many threads
+    (see cpu_affinity.py).  An OSError is raised if it cannot be started.
+    Return a dict describing the running task, to be passed to reap_task.
+    '''
     import subprocess
     print s_task
-    subprocess.call(s_task.split(), stdout=f_out)
+    if cores is None:
+        p = subprocess.Popen(s_task.split(), stdout=subprocess.PIPE)
+    else:
+        p = subprocess.Popen(s_task.split(), stdout=subprocess.PIPE,
+                             env=ca.thread_env(cores),
+                             preexec_fn=ca.affinity_setter(cores))
+    c = sc.start_stdout_capture(p.stdout, fname_out, nline=nline,
+                                flush_seconds=flush_seconds,
+                                fname_full=fname_out_full)
+    return {'task': s_task, 'popen': p, 'pid': p.pid,
+            'stdout': c, 't_start': time.time()}
+
+
+def open_child_wakeup():
+    '''
+    Make wait_for_child_exit return as soon as a child process exits: the
+    SIGCHLD signals are written to a pipe (signal.set_wakeup_fd).
+    Return None if signals cannot be handled here (not the main thread).
+    '''
+    import fcntl
+    import signal
+    r, w = os.pipe()
+    for fd in (r, w):
+        fcntl.fcntl(fd, fcntl.F_SETFL,
+                    fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+    try:
+        handler = signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        fd_old = signal.set_wakeup_fd(w)
+    except ValueError:
+        os.close(r)
+        os.close(w)
+        return None
+    # Restart the system calls interrupted by the signal.
+    signal.siginterrupt(signal.SIGCHLD, False)
+    return {'r': r, 'w': w, 'handler': handler, 'fd_old': fd_old}
+
+
+def wait_for_child_exit(wakeup, seconds):
+    '''
+    Sleep for seconds, or until a child process exits.
+    '''
+    import errno
+    import select
+    if wakeup is None:
+        time.sleep(seconds)
+        return
+    try:
+        select.select([wakeup['r']], [], [], seconds)
+    except select.error as e:
+        if e.args[0] != errno.EINTR:
+            raise
+    try:
+        while len(os.read(wakeup['r'], 512)) > 0:
+            pass
+    except OSError as e:
+        if e.errno != errno.EAGAIN:
+            raise
+    return
+
+
+def close_child_wakeup(wakeup):
+    import signal
+    if wakeup is None:
+        return
+    signal.set_wakeup_fd(wakeup['fd_old'])
+    signal.signal(signal.SIGCHLD, wakeup['handler'])
+    os.close(wakeup['r'])
+    os.close(wakeup['w'])
+    return
+
+
+def reap_task(t):
+    '''
+    Check whether the task t started by launch_task has exited.
+    Return None if it is still running; otherwise return a dict with its
+    exit code, wall time, user and system CPU time, and peak RSS.
+    '''
+    pid, status, ru = os.wait4(t['pid'], os.WNOHANG)
+    if pid == 0:
+        return None
+    t_end = time.time()
+    if os.WIFSIGNALED(status):
+        exitcode = -os.WTERMSIG(status)
+    else:
+        exitcode = os.WEXITSTATUS(status)
+    t['popen'].returncode = exitcode
+    sc.finish_stdout_capture(t['stdout'])
+    return {'task': t['task'],
+            'pid': pid,
+            'exitcode': exitcode,
+            't_start': t['t_start'],
+            't_end': t_end,
+            'wall_seconds': t_end - t['t_start'],
+            'utime_seconds': ru.ru_utime,
+            'stime_seconds': ru.ru_stime,
+            'maxrss_kb': ru.ru_maxrss}
+
+
+def save_task_metrics(fname, metrics):
+    '''
+    Append the metrics of a finished task as one line of JSON.
+    '''
+    import json
+    save_to_log(fname, json.dumps(metrics, sort_keys=True) + '\n')
+    return
+
+
+def load_task_metrics(fname):
+    import json
+    metrics = []
+    for line in load_file_lines(fname):
+        try:
+            metrics.append(json.loads(line))
+        except ValueError:
+            pass
+    return metrics
+
+
+def load_all_task_metrics(log_dir):
+    '''
+    Load the metrics of the finished tasks of all the hosts.
+    '''
+    return sum([load_task_metrics(_) for _ in
+                sorted(glob.glob(os.path.join(log_dir, 'metrics.*')))], [])
+
+
+def update_task_priorities(task_db, fname_lut, log_dir):
+    '''
+    Fit the runtime model to the finished runs and set the priorities of the
+    queued tasks to their expected run times.
+    Return the model, or None if there are not enough finished runs yet.
+    '''
+    import runtime_model as rm
+    lut = rm.load_lut(fname_lut)
+    model = rm.fit_runtime_model(
+        rm.collect_runtime_samples(lut, load_all_task_metrics(log_dir)))
+    if model is None:
+        return None
+    priorities = []
+    for task_id, s_task in tq.queued_tasks(task_db):
+        key = rm.lut_key_of_task(s_task)
+        if key in lut:
+            priorities.append((task_id, rm.predict_runtime(model, lut[key])))
+    tq.set_priorities(task_db, priorities)
+    return model
+
+
+def grid_point_of_config(values):
+    '''
+    The grid parameters of a run, from the values of its config file.
+    '''
+    t = values['a_disk%star_temperature']
+    return {'rin': values['a_disk%andrews_gas%rin'],
+            'rout': values['a_disk%andrews_gas%rout'],
+            'd2g': values['a_disk_iter_params%dust2gas_mass_ratio_deflt'],
+            'mdust': values['a_disk%dustcompo(1)%andrews%Md'],
+            'sptype': min(spectral_to_temperature.keys(),
+                key = lambda k: abs(spectral_to_temperature[k] - t))}
+
+
+def ingest_task_result(result_store, s_task, fname_config):
+    '''
+    Append the row of the successful task s_task to the result store.
+    '''
+    import runtime_model as rm
+    values = read_config_values(fname_config)
+    lazy = parse_lazy_task(s_task)
+    p = lazy[2] if lazy is not None else grid_point_of_config(values)
+    run_id = rm.lut_key_of_task(s_task) or \
+             os.path.splitext(os.path.basename(fname_config))[0]
+    line = run_id.split('.', 1)[1] if '.' in run_id else ''
+    return rs.ingest_run(result_store, run_id, p,
+                         run_output_dirs(values)[0], line = line)
+
+
+def log_event(log_file, s):
+    '''
+    Append the line s to log_file, with the date and time.
+    '''
+    dstamp = datetime.datetime.now().strftime('%Y-%m-%d-%H:%M:%S')
+    save_to_log(log_file, dstamp + ': ' + s + '\n')
     return
 
 
@@ -361,6 +1502,33 @@ def set_self_as_master(working_dir, host):
         f.write(host)
     return
 
+
+def become_master(working_dir, fname_generating=None, stale_seconds=600):
+    '''
+    Take master.lockfile atomically.  If it is already taken but the master
+    died while generating the tasks, i.e. the marker fname_generating has
+    not been touched for stale_seconds, the lock is broken and taken over.
+    Return whether this process is the master, and the reason the lock was
+    broken, if it was.
+    '''
+    f_lock = os.path.join(working_dir, 'master.lockfile')
+    if create_lock_file(f_lock):
+        return True, None
+    if fname_generating is None:
+        return False, None
+    try:
+        age = time.time() - os.path.getmtime(fname_generating)
+    except OSError:
+        return False, None
+    if age <= stale_seconds:
+        return False, None
+    owner = ''.join(load_file_lines(f_lock)).strip()
+    if break_stale_lock(f_lock, stale_seconds = 0) is None or \
+            not create_lock_file(f_lock):
+        return False, None
+    return True, ('the master {0:s} has not written any task ' + \
+                  'for {1:.0f} seconds').format(owner, age)
+
 def master_already_exist(working_dir):
     f_lock = os.path.join(working_dir, 'master.lockfile')
     if os.path.exists(f_lock):
@@ -390,12 +1558,358 @@ def calc_star_lumi_bb_CGS(T_K, R_Rsun, lammin_CGS, lammax_CGS,
            (4.0 * phy.phy_Pi * (R_Rsun*phy.phy_Rsun_CGS)**2)
 
 
+# Cache of calc_star_lumi_bb_CGS.
+# Results for the stars in spectral_to_temperature/spectral_to_radius are
+# always kept, and also saved to 'fname' if it is set; other results are kept
+# in a LRU of at most 'lru_size' entries.
+star_lumi_cache = {
+    'fname': None,
+    'pinned': {},
+    'lru': None,
+    'lru_size': 256,
+    'hits': 0,
+    'misses': 0,
+}
+
+
+def set_star_lumi_cache_file(fname, lru_size=256):
+    '''
+    Use fname as the on-disk store of the star luminosity cache, and load
+    the values already saved in it.
+    Each line of the file is: T_K R_Rsun lammin lammax rtol atol lumi
+    '''
+    from collections import OrderedDict
+    star_lumi_cache['fname'] = fname
+    star_lumi_cache['lru_size'] = lru_size
+    if star_lumi_cache['lru'] is None:
+        star_lumi_cache['lru'] = OrderedDict()
+    for line in load_file_lines(fname):
+        try:
+            v = [float(_) for _ in line.split()]
+        except ValueError:
+            continue
+        if len(v) == 7:
+            star_lumi_cache['pinned'][tuple(v[:6])] = v[6]
+    return
+
+
+def star_lumi_cache_stats():
+    return {'hits': star_lumi_cache['hits'],
+            'misses': star_lumi_cache['misses'],
+            'pinned': len(star_lumi_cache['pinned']),
+            'lru': len(star_lumi_cache['lru'] or {})}
+
+
+def _save_star_lumi(key, v):
+    if star_lumi_cache['fname'] is not None:
+        save_to_log(star_lumi_cache['fname'],
+                    ' '.join([repr(_) for _ in key + (v,)]) + '\n')
+    return
+
+
+def star_lumi_cache_state():
+    '''
+    The counts and the pinned values of the cache of this process, to be
+    merged into the cache of another one with merge_star_lumi_cache.
+    '''
+    return {'hits': star_lumi_cache['hits'],
+            'misses': star_lumi_cache['misses'],
+            'pinned': dict(star_lumi_cache['pinned'])}
+
+
+def merge_star_lumi_cache(state):
+    '''
+    Add the counts of another process, and its pinned values that are new
+    here, which are saved to the cache file.
+    '''
+    star_lumi_cache['hits'] += state['hits']
+    star_lumi_cache['misses'] += state['misses']
+    pinned = star_lumi_cache['pinned']
+    for key, v in state['pinned'].items():
+        if key not in pinned:
+            pinned[key] = v
+            _save_star_lumi(key, v)
+    return
+
+
+def calc_star_lumi_bb_CGS_cached(T_K, R_Rsun, lammin_CGS, lammax_CGS,
+                                 rtol = 1e-4, atol = 1e0):
+    '''
+    Same as calc_star_lumi_bb_CGS, but each distinct set of arguments is
+    only integrated once.
+    '''
+    from collections import OrderedDict
+    key = (float(T_K), float(R_Rsun), float(lammin_CGS), float(lammax_CGS),
+           float(rtol), float(atol))
+    pinned = star_lumi_cache['pinned']
+    if star_lumi_cache['lru'] is None:
+        star_lumi_cache['lru'] = OrderedDict()
+    lru = star_lumi_cache['lru']
+    #
+    if key in pinned:
+        star_lumi_cache['hits'] += 1
+        return pinned[key]
+    if key in lru:
+        star_lumi_cache['hits'] += 1
+        v = lru.pop(key)
+        lru[key] = v
+        return v
+    #
+    star_lumi_cache['misses'] += 1
+    v = calc_star_lumi_bb_CGS(T_K, R_Rsun, lammin_CGS, lammax_CGS,
+                              rtol = rtol, atol = atol)
+    #
+    is_table_star = any(
+        (key[0] == spectral_to_temperature[k] and
+         key[1] == spectral_to_radius[k]) for k in spectral_to_temperature)
+    if is_table_star:
+        pinned[key] = v
+        _save_star_lumi(key, v)
+    else:
+        lru[key] = v
+        while len(lru) > star_lumi_cache['lru_size']:
+            lru.popitem(last=False)
+    return v
+
+
 def est_Tdust(Tstar_K, Rstar_Rsun, R_AU):
     return Tstar_K * sqrt(Rstar_Rsun * phy.phy_Rsun_CGS / (phy.phy_AU2cm * R_AU))
 
 
 
 
+def finish_task(worker, p, reaped, s_task, task_id):
+    '''
+    Wrap up the task s_task, started as p by start_task, which has exited
+    with reaped (from reap_task): copy its results back from the scratch
+    space, record its metrics, add it to the result cache and the result
+    store, and set its state in the task database.  worker holds the
+    settings of main_loop.
+    Return its exit code (-1 if its results could not be copied) and the
+    line tasks to queue after it.
+    '''
+    if p['scratch'] is not None and reaped['exitcode'] == 0:
+        try:
+            ss.sync_run(p['scratch'])
+            ss.remove_run(p['scratch'])
+        except (IOError, OSError) as e:
+            log_event(worker['log_file'], 'Failed to copy the results of ' + \
+                      s_task + ': ' + str(e))
+            reaped['exitcode'] = -1
+    if p['input_config'] is not None:
+        os.remove(p['input_config'])
+    if p['cores'] is not None:
+        ca.release_cores(worker['core_pool'], p['cores'])
+    exitcode = reaped['exitcode']
+    reaped['host'] = worker['host']
+    reaped['footprint'] = p['footprint']
+    save_task_metrics(worker['log_metrics'], reaped)
+    if worker['status'] is not None:
+        st.record_finished(worker['status'], reaped['t_end'], exitcode)
+    if exitcode == 0:
+        ad.add_footprint(worker['footprints'], p['footprint'],
+                         reaped['maxrss_kb'])
+    if exitcode == 0 and worker['autoscaler'] is not None:
+        asc.record_finished(worker['autoscaler'], reaped)
+    if exitcode == 0 and worker['result_cache'] is not None:
+        cf = ''.join(load_file_lines(p['config']))
+        iter_dir, dump_dir = run_output_dirs(
+            parse_config_lines(cf.splitlines(), keys=rc.path_keys))
+        rc.add_result(worker['result_cache'], rc.config_hash(cf),
+                      iter_dir, dump_dir, source = s_task)
+    if exitcode == 0 and worker['result_store'] is not None:
+        try:
+            ingest_task_result(worker['result_store'], s_task, p['config'])
+        except (IOError, OSError) as e:
+            log_event(worker['log_file'], 'Failed to ingest ' + s_task + \
+                      ': ' + str(e))
+    lines = []
+    if exitcode == 0 and worker['line_tasks'] is not None and \
+            not is_line_task(s_task):
+        lines = line_tasks_of_run(s_task, p['config'], worker['line_tasks'])
+    if parse_lazy_task(s_task) is not None:
+        discard_lazy_config(p['config'], worker['lazy_render'],
+                            failed = (exitcode != 0))
+    if task_id is not None:
+        tq.set_task_state(worker['task_db'], task_id,
+                          'done' if exitcode == 0 else 'failed',
+                          exitcode = exitcode)
+    return exitcode, lines
+
+
+def start_task(worker, task_id, s_task, s_exec, fname_config, cores=None):
+    '''
+    Start s_task, which runs s_exec on the config file fname_config: stage
+    it in the scratch space, let it read the cached inputs, and launch it,
+    pinned to cores if they are given.  worker holds the settings of
+    main_loop.
+    Return the running task (from launch_task), or None if it could not be
+    started, in which case it is recorded as failed.
+    '''
+    log_file = worker['log_file']
+    worker['i_task'] += 1
+    i_task = worker['i_task']
+    fname_stdout = os.path.join(worker['log_dir'],
+                   'stdout.' + worker['host'] + \
+                   '.{0:03d}'.format(i_task))
+    #
+    print 'Running task {0:5d}'.format(i_task)
+    #
+    stage = None
+    if worker['scratch_dir'] is not None:
+        try:
+            stage = ss.stage_run(fname_config, worker['scratch_dir'])
+            s_exec = ' '.join(s_exec.split()[:-1] + [stage['config']])
+        except (IOError, OSError) as e:
+            log_event(log_file, 'Failed to stage ' + s_task + \
+                      ', running it in place: ' + str(e))
+    fname_input_config = None
+    if worker['input_cache'] is not None:
+        try:
+            fname_run = task_config_fname(s_exec)
+            cf = ic.rewrite_input_dirs(worker['input_cache'],
+                                       ''.join(load_file_lines(fname_run)))
+            if stage is None:
+                # Do not change the shared config file.
+                fname_run = fname_input_config = os.path.join(
+                    worker['input_cache_dir'], os.path.basename(fname_run))
+            with open(fname_run, 'w') as f:
+                f.write(cf)
+            s_exec = ' '.join(s_exec.split()[:-1] + [fname_run])
+        except (IOError, OSError) as e:
+            if fname_input_config is not None and \
+                    os.path.exists(fname_input_config):
+                os.remove(fname_input_config)
+            fname_input_config = None
+            log_event(log_file, 'Failed to cache the inputs of ' + s_task + \
+                      ', running it with the shared inputs: ' + str(e))
+    try:
+        p = launch_task(s_exec, fname_stdout,
+                        nline = worker['stdout_nline'],
+                        flush_seconds = worker['stdout_flush_seconds'],
+                        fname_out_full = (fname_stdout + '.gz'
+                            if worker['stdout_full_gzip'] else None),
+                        cores = cores)
+    except OSError as e:
+        if stage is not None:
+            ss.remove_run(stage)
+        if fname_input_config is not None:
+            os.remove(fname_input_config)
+        if parse_lazy_task(s_task) is not None:
+            discard_lazy_config(fname_config, worker['lazy_render'],
+                                failed = True)
+        if task_id is not None:
+            tq.set_task_state(worker['task_db'], task_id, 'failed')
+        log_event(log_file, 'Failed to start ' + s_task + ': ' + str(e))
+        return None
+    p['cores'] = cores
+    p['config'] = fname_config
+    p['scratch'] = stage
+    p['input_config'] = fname_input_config
+    lg.append_events(worker['ledger'], 'started', [s_task])
+    if task_id is not None:
+        tq.set_task_state(worker['task_db'], task_id, 'running')
+    #
+    dstamp = datetime.datetime.now().strftime('%Y-%m-%d-%H:%M:%S')
+    #
+    save_to_log(log_file, dstamp + ': ' + s_task + '\n')
+    save_to_log(worker['log_status'], dstamp + ': ' + worker['host'] + ': ' + \
+                s_task + '\n')
+    return p
+
+
+def claim_tasks(worker, sched, n):
+    '''
+    Claim up to n tasks from the task file or the task database of worker,
+    and render the lazy ones.  Return a list of dicts with the task_id,
+    task line, exec command, config file and footprint key of each task, or
+    a sleep to end the pass with (see scheduling.py), or None if the task
+    file cannot be read.
+    A task that cannot be prepared is recorded as failed, unless the error
+    is an IOError or OSError: the whole batch is then given back, until
+    that has happened max_refusals times to the same task.
+    '''
+    log_file = worker['log_file']
+    task_db = worker['task_db']
+    if task_db is not None:
+        claimed = tq.claim_tasks(task_db, worker['host'], n = n,
+                                 lease_seconds = worker['lease_seconds'])
+        lg.append_events(worker['ledger'], 'claimed', [_[1] for _ in claimed])
+    else:
+        fname_task = worker['fname_task']
+        sfopen, f = open_and_lock_file(fname_task,
+            stale_seconds = worker['stale_lock_seconds'], log_file = log_file)
+        #
+        if sfopen != 'success':
+            print 'Faile to open the task file:'
+            print fname_task
+            print 'Will retry in {0:d} seconds.'.format(sched['t_wait_seconds'])
+            return 'locked', sched['t_wait_seconds'], False
+        #
+        s_tasks = check_tasks_todo(f, n = n)
+        if s_tasks == 'FAILED':
+            unlock_file(fname_task)
+            f.close()
+            print 'Cannot read the task file!'
+            return None
+        if len(s_tasks) > 0:
+            update_task_file(f, n = len(s_tasks))
+        unlock_file(fname_task)
+        f.close()
+        claimed = [(None, _) for _ in s_tasks]
+    #
+    n_refused = sched['n_refused']
+    max_refusals = sched['max_refusals']
+    lazy_render = worker['lazy_render']
+    tasks = []
+    for i, (task_id, s_task) in enumerate(claimed):
+        fname_config = None
+        try:
+            if parse_lazy_task(s_task) is not None:
+                s_exec, fname_config = render_lazy_task(s_task,
+                    lazy_render, line_tasks = worker['line_tasks'])
+            else:
+                s_exec, fname_config = s_task, task_config_fname(s_task)
+            key = ad.footprint_key(read_config_values(fname_config,
+                                                      ad.footprint_keys))
+        except Exception as e:
+            n_refused[s_task] = n_refused.get(s_task, 0) + 1
+            if isinstance(e, (IOError, OSError)) and \
+                    (max_refusals is None or n_refused[s_task] < max_refusals):
+                # Maybe a file system hiccup: give the whole batch back and
+                # try again later.
+                log_event(log_file, 'Failed to prepare ' + s_task + \
+                          ', giving back the claimed tasks: ' + str(e))
+                give_back_tasks(
+                    [(_['task_id'], _['task'], _['config']) for _ in tasks] + \
+                    [(task_id, s_task, fname_config)] + \
+                    [(_[0], _[1], None) for _ in claimed[i+1:]],
+                    worker['fname_task'], task_db, worker['ledger'],
+                    lazy_render)
+                return 'given back', sched['t_wait_seconds_long'], True
+            # The task line itself is broken: the task fails, the rest of
+            # the batch goes on.
+            del n_refused[s_task]
+            if fname_config is not None and \
+                    parse_lazy_task(s_task) is not None and \
+                    os.path.exists(fname_config):
+                discard_lazy_config(fname_config, lazy_render, failed = True)
+            worker['failed'].append(s_task)
+            if task_id is not None:
+                tq.set_task_state(task_db, task_id, 'failed')
+            log_event(log_file, 'Failed to prepare ' + s_task + ': ' + str(e))
+            continue
+        tasks.append({'task_id': task_id,
+                      'task': s_task,
+                      'exec': s_exec,
+                      'config': fname_config,
+                      'footprint': key})
+    if len(claimed) > 0 and len(tasks) == 0:
+        # All of them failed; there may be more.
+        return 'launch', sched['t_wait_seconds'], True
+    return tasks
+
+
 def main_loop(host_name = 'moria',
               max_task = 4,
               max_pcpu = 0.6,
@@ -403,10 +1917,108 @@ def main_loop(host_name = 'moria',
               t_wait_seconds = 10,
               t_wait_seconds_long = 60,
               max_task_fname = None,
-              fname_task = None):
+              fname_task = None,
+              fname_task_db = None,
+              t_write_views_seconds = 60,
+              max_ledger_lines = 10000,
+              stdout_nline = 2000,
+              stdout_flush_seconds = 180,
+              stdout_full_gzip = False,
+              max_pvmem = 0.9,
+              mem_base_mb = 200.0,
+              mem_per_cell_kb = 50.0,
+              max_refusals = 1000,
+              fname_lut = None,
+              t_reprioritize_seconds = 3600,
+              result_cache_dir = None,
+              result_cache_max_gb = 500.0,
+              lazy_render = None,
+              line_tasks = None,
+              lease_seconds = 600,
+              stale_lock_seconds = 600,
+              scratch_dir = None,
+              scratch_max_gb = 50.0,
+              input_cache_dir = None,
+              result_store_dir = None,
+              result_store_columns = None,
+              status_port = None,
+              status_count_seconds = 30,
+              status_bind = '127.0.0.1',
+              max_task_bounds = None,
+              autoscale_seconds = 1800,
+              cores_per_task = None,
+              wake_on_exit = True):
+    '''
+    Keep running tasks on this host until there is no task left.
+    Tasks are taken from the plain text task file fname_task, or from the
+    task database fname_task_db if it is given (see task_queue.py), in
+    which case all the free slots are filled with one claim.
+    The states of the tasks of all the hosts are kept in the ledger
+    (see ledger.py); running.all and finished.all are rewritten from it at
+    most every t_write_views_seconds.
+    The tasks are started directly with Popen; the wall time, CPU time and
+    peak memory of each finished task are appended to metrics.<host>.
+    A task that cannot be started (e.g. its executable is missing) is
+    recorded as failed, as if it had exited with an error.
+    Only the last stdout_nline lines of the stdout of each task are kept in
+    its stdout file; with stdout_full_gzip the whole stdout is also saved to
+    the same file name with .gz appended.
+    A task is only started if its estimated memory fits below max_pvmem of
+    the memory of this host (see admission.py); otherwise the reason is
+    written to log.<host>.  It is started anyway when no task is running,
+    and recorded as failed once it has been refused max_refusals times.
+    With the task database and fname_lut given, the priorities of the queued
+    tasks are updated from the runtime model fitted to the finished runs
+    every t_reprioritize_seconds (see runtime_model.py).
+    If result_cache_dir is given, the outputs of each successful run are
+    added to the result cache there (see result_cache.py).
+    Lazy tasks (see lazy_task_line) are rendered when they are claimed, with
+    the templates and directories in lazy_render, into the node-local
+    directory lazy_render['local_dir'].  The rendered config file is
+    removed when the run is over, and copied to lazy_render['archive_dir']
+    if the run failed.
+    line_tasks maps the names of the lines to model to their
+    raytracing_configure values.  When a run finishes successfully, one line
+    task for each of them is queued, which only does the ray tracing of that
+    line from the data dump of the run (see render_a_line_config).
+    This host holds a lease on its tasks, renewed every lease_seconds / 4
+    from a thread (in the task database, or as lease.<host> in the ledger),
+    so that it holds while results are copied.  The tasks of
+    a host whose lease has expired are put back in the queue, as are those
+    left running by this host when main_loop starts.  Lock files older than
+    stale_lock_seconds are broken.
+    If scratch_dir is given, each run writes its dump and iteration files
+    into node-local scratch_dir, and they are copied to the shared
+    directories once it has succeeded (see scratch_staging.py).  A run that
+    cannot be staged (e.g. the scratch space is full) runs in place.  The
+    scratch space is kept below scratch_max_gb.
+    If input_cache_dir is given, the runs read their input files from
+    copies in that host-local directory (see input_cache.py).
+    If result_store_dir is given, the parameters of each successful run and
+    its outputs in result_store_columns are appended to the result store
+    there (see result_store.py).
+    If status_port is given, the status of this host is served as JSON on
+    that port (any free port if 0) of the address status_bind ('' for all
+    the interfaces), with the queue depth counted at most every
+    status_count_seconds (see status_server.py).
+    If max_task_bounds = (min, max) is given, the number of tasks run at
+    once starts at max_task and is adjusted every autoscale_seconds from the
+    throughput and the load of this host (see autoscale.py).  A number in
+    max_task_fname overrides it.
+    If cores_per_task is given, each task is pinned to that many cores of
+    its own, with its thread counts set to match; 0 divides the cores of
+    this host evenly between max_task tasks, as max_task changes (see
+    cpu_affinity.py).  A task is started unpinned when too few cores are
+    free.
+    All the free slots are filled on each pass; the tasks claimed that
+    cannot be started yet are given back to the head of the task file or
+    to the task database, for any host to take.  These decisions are made
+    by scheduling.schedule_pass, which the simulator shares.  With wake_on_exit, the
+    waits of t_wait_seconds and t_wait_seconds_long end as soon as a task
+    exits, so that its slot is filled again at once.
+    '''
     import time
     import subprocess
-    from multiprocessing import Process, Manager
     #
     log_file = os.path.join(log_dir, 'log.' + host_name)
     log_running = os.path.join(log_dir, 'running.' + host_name)
@@ -415,138 +2027,268 @@ def main_loop(host_name = 'moria',
     log_finished_all = os.path.join(log_dir, 'finished.all')
     log_error = os.path.join(log_dir, 'error_exit.all')
     log_status = os.path.join(log_dir, 'workers.status')
+    log_metrics = os.path.join(log_dir, 'metrics.' + host_name)
     #
-    manager = Manager()
+    task_db = None
+    if fname_task_db is not None:
+        task_db = tq.open_task_db(fname_task_db)
+    #
+    ledger = lg.open_ledger(log_dir, host_name,
+                            fname_finished_all = log_finished_all)
+    #
+    footprints = ad.load_footprint_history(load_all_task_metrics(log_dir))
+    result_cache = input_cache = result_store = None
+    autoscaler = core_pool = status = None
+    if result_cache_dir is not None:
+        result_cache = rc.open_result_cache(result_cache_dir,
+                                            max_gb = result_cache_max_gb)
+    t_reprioritized = time.time()
+    t_requeued = 0.0
+    if input_cache_dir is not None:
+        input_cache = ic.open_input_cache(input_cache_dir)
+    if result_store_dir is not None:
+        result_store = rs.open_result_store(result_store_dir,
+                                            result_store_columns or {})
+    if max_task_bounds is not None:
+        autoscaler = asc.new_autoscaler(max_task, max_task_bounds[0],
+                                        max_task_bounds[1],
+                                        interval_seconds = autoscale_seconds)
+    if cores_per_task is not None:
+        core_pool = ca.new_core_pool(cores_per_task, max_task)
+    wakeup = open_child_wakeup() if wake_on_exit else None
+    #
+    if fname_task_db is not None:
+        requeued = [(_[1], _[2])
+                    for _ in tq.requeue_expired(task_db, host = host_name)]
+        lg.append_events(ledger, 'requeued', [_[0] for _ in requeued])
+    else:
+        requeued = requeue_orphaned_tasks(fname_task, ledger, lease_seconds,
+                                          own = True,
+                                          stale_seconds = stale_lock_seconds,
+                                          log_file = log_file)
+    for s_task, host in requeued:
+        log_event(log_file, 'Requeued ' + s_task + \
+                  ', left running on ' + host)
     #
     p_s = []
-    f_stdout_s = []
-    fname_stdout_s = manager.list()
     tasks_running = []
+    tasks_running_saved = None
+    task_ids_running = []
     #
-    i_task = 0
-    no_task_left = False
-    n_task_running = 0
-    p_clean_stdout = Process(target = truncate_stdout_file, args=(fname_stdout_s,))
-    p_clean_stdout.start()
+    if status_port is not None:
+        status = st.new_status(host_name)
+        st.start_status_server(status, log_dir, port = status_port,
+                               bind = status_bind)
+        t_counted = 0.0
+        n_queued = None
+    worker = {'host': host_name,
+              'log_dir': log_dir,
+              'log_file': log_file,
+              'log_status': log_status,
+              'log_metrics': log_metrics,
+              'fname_task': fname_task,
+              'task_db': task_db,
+              'lease_seconds': lease_seconds,
+              'stale_lock_seconds': stale_lock_seconds,
+              'ledger': ledger,
+              'footprints': footprints,
+              'lazy_render': lazy_render,
+              'line_tasks': line_tasks,
+              'scratch_dir': scratch_dir,
+              'input_cache_dir': input_cache_dir,
+              'input_cache': input_cache,
+              'result_cache': result_cache,
+              'result_store': result_store,
+              'status': status,
+              'autoscaler': autoscaler,
+              'core_pool': core_pool,
+              'stdout_nline': stdout_nline,
+              'stdout_flush_seconds': stdout_flush_seconds,
+              'stdout_full_gzip': stdout_full_gzip,
+              'i_task': 0,
+              'failed': []}
+    sched = sch.new_scheduler(max_task,
+                              max_pcpu = max_pcpu,
+                              t_wait_seconds = t_wait_seconds,
+                              t_wait_seconds_long = t_wait_seconds_long,
+                              max_pvmem = max_pvmem,
+                              mem_base_mb = mem_base_mb,
+                              mem_per_cell_kb = mem_per_cell_kb,
+                              max_refusals = max_refusals,
+                              footprints = footprints,
+                              autoscaler = autoscaler,
+                              core_pool = core_pool)
     #
-    while True:
-        #
-        still_running = [_p.is_alive() for _p in p_s]
-        len_p_s = len(p_s)
-        n_task_running = sum(still_running)
-        _p_s = []
-        _t_r = []
-        _t_f = []
-        _t_e = []
-        for i in xrange(len_p_s):
-            if not still_running[i]:
-                f_stdout_s[i].close()
-                p_s[i].join()
-                _t_f.append(tasks_running[i])
-                if p_s[i].exitcode != 0:
-                    _t_e.append(tasks_running[i])
-            else:
-                _p_s.append(p_s[i])
-                _t_r.append(tasks_running[i])
-        p_s = _p_s
-        tasks_running = _t_r
-        tasks_finished = _t_f
-        tasks_finished_error = _t_e
-        #
-        tasks_finished_all = [_.strip() for _ in load_file_lines(log_finished_all)] \
-                             + tasks_finished
-        tasks_finished_all = list(set(tasks_finished_all))
-        #
-        tasks_running_all = [_.strip() for _ in load_file_lines(log_running_all)] \
-                            + tasks_running
-        tasks_running_all = list(set(tasks_running_all))
-        tasks_running_all = [_ for _ in tasks_running_all if _ not in tasks_finished_all]
-        #
-        tasks_finished.sort()
-        tasks_finished_all.sort()
-        tasks_finished_error.sort()
-        ## !! tasks_running.sort()  # DO NOT sort!!
-        tasks_running_all.sort()
-        #
-        save_to_log(log_running, '\n'.join(tasks_running), mode='w', allow_empty=no_task_left)
-        save_to_log(log_running_all, '\n'.join(tasks_running_all), mode='w', allow_empty=no_task_left)
-        save_to_log(log_finished, '\n'.join(tasks_finished) + \
-                                  ('\n' if len(tasks_finished)>=1 else ''), mode='a')
-        save_to_log(log_finished_all, '\n'.join(tasks_finished_all), mode='w')
-        save_to_log(log_error, '\n'.join(tasks_finished_error), mode='a')
-        #
-        if n_task_running == 0 and no_task_left:
-            break
-        if n_task_running > 0 and no_task_left:
-            # Wait for the running tasks to finish, or for the new task to come in
-            time.sleep(t_wait_seconds_long)
-        #
+    def max_task_override():
         max_task_realtime = load_file_lines(max_task_fname)
         if len(max_task_realtime) > 0:
             try:
-                max_task = int(max_task_realtime[0])
+                return int(max_task_realtime[0])
             except:
                 pass
-        #
-        pcpu, pvmem = check_system_resource()
-        resource_available = (pcpu < max_pcpu and n_task_running < max_task)
-        #
-        if not resource_available:
-            time.sleep(t_wait_seconds_long)
-            continue
-        #
-        sfopen, f = open_and_lock_file(fname_task)
-        #
-        if sfopen != 'success':
-            print 'Faile to open the task file:'
-            print fname_task
-            print 'Will retry in {0:d} seconds.'.format(t_wait_seconds)
-            time.sleep(t_wait_seconds)
-            continue
-        #
-        no_task_left = False
-        s_task = check_task_todo(f)
-        #
-        if s_task == 'FINISHED':
-            unlock_file(fname_task)
-            f.close()
-            no_task_left = True
-            continue
-        if s_task == 'FAILED':
-            unlock_file(fname_task)
-            f.close()
-            print 'Cannot read the task file!'
-            break
-        #
-        update_task_file(f)
-        unlock_file(fname_task)
-        f.close()
-        #
-        i_task += 1
-        fname_stdout = os.path.join(log_dir,
-                       'stdout.' + host_name + \
-                       '.{0:03d}'.format(i_task))
-        f_stdout = open(fname_stdout, 'a')
-        f_stdout_s.append(f_stdout)
-        fname_stdout_s.append(fname_stdout)
-        #
-        p_s.append(Process(target=exec_task, args=(s_task, f_stdout)))
-        tasks_running.append(s_task)
-        #
-        print 'Running task {0:5d}'.format(i_task)
-        #
-        p_s[-1].start()
-        #
-        dstamp = datetime.datetime.now().strftime('%Y-%m-%d-%H:%M:%S')
-        #
-        save_to_log(log_file, dstamp + ': ' + s_task + '\n')
-        save_to_log(log_status, dstamp + ': ' + host_name + ': ' + s_task + '\n')
-        #
-        time.sleep(t_wait_seconds)
+        return None
     #
-    for f in f_stdout_s:
-        f.close()
-    p_clean_stdout.terminate()
+    def start(t, est_mb, cores):
+        p = start_task(worker, t['task_id'], t['task'], t['exec'],
+                       t['config'], cores = cores)
+        if p is None:
+            worker['failed'].append(t['task'])
+            return False
+        p['footprint'] = t['footprint']
+        p['est_mb'] = est_mb
+        p_s.append(p)
+        tasks_running.append(t['task'])
+        task_ids_running.append(t['task_id'])
+        return True
+    #
+    def fail(t):
+        if parse_lazy_task(t['task']) is not None:
+            discard_lazy_config(t['config'], lazy_render, failed = True)
+        worker['failed'].append(t['task'])
+        if t['task_id'] is not None:
+            tq.set_task_state(task_db, t['task_id'], 'failed')
+    #
+    probes = {'now': time.time,
+              'n_running': lambda: len(p_s),
+              'running_mem': lambda: [(_p['est_mb'],
+                                       check_process_rss_mb(_p['pid']))
+                                      for _p in p_s],
+              'pcpu': lambda: pcpu,
+              'memory': check_memory_mb,
+              'pressure': check_pressure,
+              'max_task': max_task_override,
+              'claim': lambda n: claim_tasks(worker, sched, n),
+              'generating': lambda: generation_in_progress(
+                  (fname_task_db or fname_task) + '.generating',
+                  stale_lock_seconds, log_file = log_file),
+              'start': start,
+              'fail': fail,
+              'give_back': lambda ts: give_back_tasks(
+                  [(_['task_id'], _['task'], _['config']) for _ in ts],
+                  fname_task, task_db, ledger, lazy_render),
+              'log': lambda s: log_event(log_file, s)}
+    lease = start_lease_heartbeat(ledger, host_name, lease_seconds,
+                                  fname_task_db = fname_task_db)
+    try:
+        while True:
+            #
+            reaped = [reap_task(_p) for _p in p_s]
+            for i in xrange(len(p_s)):
+                if reaped[i] is None:
+                    sc.flush_stdout_capture(p_s[i]['stdout'])
+            len_p_s = len(p_s)
+            n_task_running = sum([_ is None for _ in reaped])
+            _p_s = []
+            _t_r = []
+            _t_i = []
+            _t_f = []
+            _t_e = []
+            _t_l = []
+            scratched = False
+            for i in xrange(len_p_s):
+                if reaped[i] is not None:
+                    scratched = scratched or p_s[i]['scratch'] is not None
+                    exitcode, lines = finish_task(worker, p_s[i], reaped[i],
+                                                  tasks_running[i],
+                                                  task_ids_running[i])
+                    _t_f.append(tasks_running[i])
+                    if exitcode != 0:
+                        _t_e.append(tasks_running[i])
+                    _t_l.extend(lines)
+                else:
+                    _p_s.append(p_s[i])
+                    _t_r.append(tasks_running[i])
+                    _t_i.append(task_ids_running[i])
+            if scratched:
+                ss.clean_scratch(scratch_dir, max_gb = scratch_max_gb,
+                    active = [_['scratch']['dir'] for _ in _p_s
+                              if _['scratch'] is not None])
+            # The tasks that failed before they could run.
+            _t_f.extend(worker['failed'])
+            _t_e.extend(worker['failed'])
+            del worker['failed'][:]
+            p_s = _p_s
+            tasks_running = _t_r
+            task_ids_running = _t_i
+            tasks_finished = _t_f
+            tasks_finished_error = _t_e
+            #
+            if len(_t_l) > 0:
+                if fname_task_db is not None:
+                    tq.add_tasks(task_db, _t_l)
+                else:
+                    append_to_task_file(fname_task, [_ + '\n' for _ in _t_l])
+                sched['no_task_left'] = False
+                log_event(log_file, 'Queued {0:d} line tasks.'.format(len(_t_l)))
+            #
+            lg.append_events(ledger, 'finished',
+                [_ for _ in tasks_finished if _ not in tasks_finished_error])
+            lg.append_events(ledger, 'failed', tasks_finished_error)
+            lg.update_ledger(ledger)
+            #
+            tasks_finished.sort()
+            tasks_finished_error.sort()
+            ## !! tasks_running.sort()  # DO NOT sort!!
+            #
+            no_task_left = sched['no_task_left']
+            if tasks_running != tasks_running_saved or no_task_left:
+                save_to_log(log_running, '\n'.join(tasks_running), mode='w', allow_empty=no_task_left)
+                tasks_running_saved = list(tasks_running)
+            save_to_log(log_finished, '\n'.join(tasks_finished) + \
+                                      ('\n' if len(tasks_finished)>=1 else ''), mode='a')
+            save_to_log(log_error, '\n'.join(tasks_finished_error) + \
+                                   ('\n' if len(tasks_finished_error)>=1 else ''), mode='a')
+            lg.write_ledger_views(ledger, log_running_all, log_finished_all,
+                                  min_interval_seconds = t_write_views_seconds,
+                                  force = (n_task_running == 0 and no_task_left))
+            lg.compact_ledger(ledger, max_lines = max_ledger_lines)
+            #
+            if time.time() - t_requeued >= lease_seconds / 4.0:
+                t_requeued = time.time()
+                if fname_task_db is not None:
+                    requeued = [(_[1], _[2])
+                                for _ in tq.requeue_expired(task_db)]
+                    lg.append_events(ledger, 'requeued', [_[0] for _ in requeued])
+                else:
+                    requeued = requeue_orphaned_tasks(fname_task, ledger,
+                        lease_seconds, stale_seconds = stale_lock_seconds,
+                        log_file = log_file)
+                for s_task, host in requeued:
+                    log_event(log_file, 'Requeued ' + s_task + \
+                              ', the lease of ' + host + ' has expired')
+                if len(requeued) > 0:
+                    sched['no_task_left'] = False
+            #
+            if fname_task_db is not None and fname_lut is not None and \
+                    time.time() - t_reprioritized >= t_reprioritize_seconds:
+                t_reprioritized = time.time()
+                if update_task_priorities(task_db, fname_lut, log_dir) is not None:
+                    log_event(log_file, 'Task priorities updated.')
+            #
+            pcpu, pvmem = check_system_resource()
+            if status_port is not None:
+                if time.time() - t_counted >= status_count_seconds:
+                    t_counted = time.time()
+                    n_queued = st.count_queued_tasks(fname_task,
+                        task_db if fname_task_db is not None else None)
+                st.publish_status(status,
+                    [(tasks_running[i], p_s[i]['t_start'])
+                     for i in xrange(len(p_s))],
+                    n_queued, ledger, pcpu, pvmem)
+            #
+            sleep = sch.schedule_pass(sched, probes)
+            if sleep is None:
+                break
+            reason, seconds, wakes = sleep
+            if wakes:
+                wait_for_child_exit(wakeup, seconds)
+            else:
+                time.sleep(seconds)
+    finally:
+        stop_heartbeat(lease)
+        close_child_wakeup(wakeup)
+        if status_port is not None:
+            st.stop_status_server(status)
     print 'Tasks finished.'
     return 0
 
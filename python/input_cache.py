@@ -0,0 +1,144 @@
+'''
+A per-host cache of the input files of the solver (chemical network, dust
+opacities, cooling tables, stellar spectrum...), so that they are not read
+over the shared file system by every run.
+
+Each input directory of a config file (input_dir_keys, and the dir of each
+dust mixture) is copied once into cache_dir/<source key>/<signature>/, where
+the signature is a hash of the names, sizes and modification times of the
+files in the source directory: when a source file changes, the signature
+changes and a new copy is made.  Each copy is checked against the SHA-1 of
+its source files while it is made, and against its MANIFEST the first time
+a worker uses it.  The config files are then rewritten to read from the
+copies.
+'''
+
+import hashlib
+import os
+import shutil
+import time
+
+input_dir_keys = ('chemsol_params%chem_files_dir',
+                  'mc_conf%mc_dir_in',
+                  'heating_cooling_config%dir_transition_rates',
+                  'raytracing_conf%dirname_mol_data')
+
+
+def is_input_dir_key(k):
+    return k in input_dir_keys or \
+           (k.startswith('dustmix_info%mix(') and k.endswith(')%dir'))
+
+
+def file_sha1(fname):
+    h = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        while True:
+            b = f.read(1024 * 1024)
+            if len(b) == 0:
+                break
+            h.update(b)
+    return h.hexdigest()
+
+
+def source_signature(src):
+    h = hashlib.sha1()
+    for root, dirs, files in os.walk(src):
+        dirs.sort()
+        for fn in sorted(files):
+            st = os.stat(os.path.join(root, fn))
+            h.update('{0:s}\t{1:d}\t{2:d}\n'.format(
+                os.path.relpath(os.path.join(root, fn), src),
+                st.st_size, int(st.st_mtime)))
+    return h.hexdigest()[:16]
+
+
+def build_version(src, vdir, keep_seconds=86400.0):
+    '''
+    Copy src to vdir, with a MANIFEST of the SHA-1 of the files.  The other
+    copies of src not used for keep_seconds are removed.
+    '''
+    import scratch_staging as ss
+    d_tmp = vdir + '.tmp{0:d}'.format(os.getpid())
+    ss.copy_tree_checked(src, d_tmp)
+    lines = []
+    for root, dirs, files in os.walk(d_tmp):
+        for fn in sorted(files):
+            lines.append(file_sha1(os.path.join(root, fn)) + '  ' +
+                         os.path.relpath(os.path.join(root, fn), d_tmp) + '\n')
+    with open(os.path.join(d_tmp, 'MANIFEST'), 'w') as f:
+        f.writelines(lines)
+    try:
+        os.rename(d_tmp, vdir)
+    except OSError:
+        # Made by another worker in the meantime.
+        shutil.rmtree(d_tmp, ignore_errors=True)
+    d_src = os.path.dirname(vdir)
+    for name in os.listdir(d_src):
+        d = os.path.join(d_src, name)
+        if d != vdir and time.time() - os.path.getmtime(d) > keep_seconds:
+            shutil.rmtree(d, ignore_errors=True)
+    return
+
+
+def verify_version(vdir):
+    try:
+        with open(os.path.join(vdir, 'MANIFEST'), 'r') as f:
+            lines = f.readlines()
+        for line in lines:
+            h, fn = line.rstrip('\n').split('  ', 1)
+            if file_sha1(os.path.join(vdir, fn)) != h:
+                return False
+    except (IOError, OSError, ValueError):
+        return False
+    return True
+
+
+def open_input_cache(cache_dir, check_seconds=600.0):
+    '''
+    The sources are checked for changes at most every check_seconds.
+    '''
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    return {'dir': cache_dir, 'check_seconds': check_seconds, 'dirs': {}}
+
+
+def cached_input_dir(cache, src):
+    '''
+    Return the cached copy of the directory src, making it if needed, or
+    None if src does not exist.
+    '''
+    src = os.path.abspath(src)
+    if not os.path.isdir(src):
+        return None
+    t = time.time()
+    vdir, t_checked = cache['dirs'].get(src, (None, 0.0))
+    if t - t_checked < cache['check_seconds']:
+        return vdir
+    v = os.path.join(cache['dir'], hashlib.sha1(src).hexdigest()[:12],
+                     source_signature(src))
+    if v != vdir:
+        # Verify a copy made by another worker once, before using it.
+        if os.path.isdir(v) and not verify_version(v):
+            shutil.rmtree(v, ignore_errors=True)
+        if not os.path.isdir(v):
+            if not os.path.exists(os.path.dirname(v)):
+                os.makedirs(os.path.dirname(v))
+            build_version(src, v)
+    os.utime(v, None)
+    cache['dirs'][src] = (v + '/', t)
+    return v + '/'
+
+
+def rewrite_input_dirs(cache, cf):
+    '''
+    Return the content of the config file cf with its input directories
+    replaced by their cached copies.
+    '''
+    from functions import parse_config_lines, render_a_config
+    info = {}
+    for k, v in parse_config_lines(cf.splitlines()).items():
+        if is_input_dir_key(k) and type(v) == str and len(v) > 0:
+            d = cached_input_dir(cache, v)
+            if d is not None:
+                info[k] = d
+    return render_a_config(cf, info, comment = '  ! Cached')
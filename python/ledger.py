@@ -0,0 +1,214 @@
+'''
+An append-only ledger of task events, shared by all the workers through the
+log directory.
+
+Each host appends to its own file, events.<host>, one line per event:
+    time<TAB>host<TAB>event<TAB>task
+where event is one of claimed, started, finished, failed, released
+(claimed but given back to the queue without being started), requeued (put
+back in the queue because its host is gone).
+Each worker keeps the sets of running and finished tasks in memory, and
+only reads what has been appended to the ledger files since its last update.
+The files running.all and finished.all are views derived from these sets,
+written from time to time.
+
+Each worker also holds a lease, the file lease.<host>, which it renews by
+rewriting it.  The tasks running on a host whose lease is older than
+lease_seconds are taken as orphaned (see orphaned_tasks).
+'''
+
+import glob
+import os
+import time
+
+ledger_events = ('claimed', 'started', 'finished', 'failed', 'released',
+                 'requeued')
+
+
+def open_ledger(log_dir, host, fname_finished_all=None):
+    '''
+    Load the ledger of all the hosts in log_dir.  The tasks listed in
+    fname_finished_all, if given, are also taken as finished, so that a
+    campaign started without the ledger can be continued.
+    '''
+    ledger = {
+        'log_dir': log_dir,
+        'host': host,
+        'fname': os.path.join(log_dir, 'events.' + host),
+        'offsets': {},
+        'state': {},
+        'running': set(),
+        'hosts': {},
+        'finished': set(),
+        'failed': set(),
+        'n_lines_own': 0,
+        'changed': True,
+        't_views': 0.0,
+    }
+    if fname_finished_all is not None and os.path.exists(fname_finished_all):
+        with open(fname_finished_all, 'r') as f:
+            for line in f:
+                if len(line.strip()) > 0:
+                    ledger['finished'].add(line.strip())
+    update_ledger(ledger)
+    return ledger
+
+
+def _apply_event(ledger, event, task, host):
+    ledger['state'][task] = event
+    if event in ('claimed', 'started'):
+        if task not in ledger['finished']:
+            ledger['running'].add(task)
+            ledger['hosts'][task] = host
+    elif event in ('released', 'requeued'):
+        ledger['running'].discard(task)
+    elif event in ('finished', 'failed'):
+        ledger['running'].discard(task)
+        ledger['finished'].add(task)
+        if event == 'failed':
+            ledger['failed'].add(task)
+    ledger['changed'] = True
+    return
+
+
+def append_events(ledger, event, tasks, host=None):
+    '''
+    Record event for each of the tasks, in the ledger file of this host.
+    '''
+    if event not in ledger_events:
+        raise ValueError('Unknown event: ' + event)
+    if len(tasks) == 0:
+        return
+    t = '{0:.3f}'.format(time.time())
+    lines = [t + '\t' + (host or ledger['host']) + '\t' + event + '\t' + \
+             _.strip() + '\n' for _ in tasks]
+    with open(ledger['fname'], 'a') as f:
+        f.write(''.join(lines))
+    for _ in tasks:
+        _apply_event(ledger, event, _.strip(), host or ledger['host'])
+    ledger['n_lines_own'] += len(lines)
+    st = os.stat(ledger['fname'])
+    ledger['offsets'][ledger['fname']] = (st.st_ino, st.st_size)
+    return
+
+
+def update_ledger(ledger):
+    '''
+    Read the events appended to all the ledger files since the last update.
+    A file that has been replaced (compacted) is read again from the start.
+    '''
+    for fname in glob.glob(os.path.join(ledger['log_dir'], 'events.*')):
+        ino, offset = ledger['offsets'].get(fname, (None, 0))
+        try:
+            st = os.stat(fname)
+        except OSError:
+            continue
+        if st.st_ino != ino or st.st_size < offset:
+            offset = 0
+        elif st.st_size == offset:
+            continue
+        with open(fname, 'r') as f:
+            f.seek(offset)
+            s = f.read()
+        # The last line may still be being written.
+        n = s.rfind('\n') + 1
+        for line in s[:n].splitlines():
+            v = line.split('\t', 3)
+            if len(v) != 4 or v[2] not in ledger_events:
+                continue
+            _apply_event(ledger, v[2], v[3], v[1])
+            if fname == ledger['fname'] and offset == 0:
+                ledger['n_lines_own'] += 1
+        ledger['offsets'][fname] = (st.st_ino, offset + n)
+    return
+
+
+def compact_ledger(ledger, max_lines=10000):
+    '''
+    Rewrite the ledger file of this host with only the last event of each
+    of its tasks, if it has more than max_lines lines.
+    '''
+    if ledger['n_lines_own'] <= max_lines:
+        return False
+    last = {}
+    with open(ledger['fname'], 'r') as f:
+        for line in f:
+            if not line.endswith('\n'):
+                continue
+            v = line.split('\t', 3)
+            if len(v) == 4:
+                last[v[3]] = line
+    lines = sorted(last.values())
+    fname_tmp = os.path.join(ledger['log_dir'], '.events.' + ledger['host'])
+    with open(fname_tmp, 'w') as f:
+        f.writelines(lines)
+    os.rename(fname_tmp, ledger['fname'])
+    ledger['n_lines_own'] = len(lines)
+    st = os.stat(ledger['fname'])
+    ledger['offsets'][ledger['fname']] = (st.st_ino, st.st_size)
+    return True
+
+
+def running_tasks(ledger):
+    return ledger['running'] - ledger['finished']
+
+
+def renew_lease(ledger):
+    fname = os.path.join(ledger['log_dir'], 'lease.' + ledger['host'])
+    with open(fname, 'w') as f:
+        f.write('{0:.3f}\n'.format(time.time()))
+    return
+
+
+def lease_age_seconds(ledger, host):
+    '''
+    The time since host last renewed its lease, or, for a host that has
+    never held one, since it last wrote to its ledger file.
+    '''
+    for name in ('lease.', 'events.'):
+        try:
+            return time.time() - os.path.getmtime(
+                os.path.join(ledger['log_dir'], name + host))
+        except OSError:
+            pass
+    return None
+
+
+def orphaned_tasks(ledger, lease_seconds, own=False):
+    '''
+    Return a list of (task, host) of the tasks running on the other hosts
+    whose leases have expired.  With own, return instead the tasks running
+    on this host, which are orphaned when its worker has just started.
+    '''
+    orphans = []
+    for task in running_tasks(ledger):
+        host = ledger['hosts'].get(task)
+        if own or host is None or host == ledger['host']:
+            if own and host == ledger['host']:
+                orphans.append((task, host))
+            continue
+        age = lease_age_seconds(ledger, host)
+        if age is None or age > lease_seconds:
+            orphans.append((task, host))
+    return sorted(orphans)
+
+
+def write_ledger_views(ledger, fname_running_all, fname_finished_all,
+                       min_interval_seconds=60.0, force=False):
+    '''
+    Write the sorted lists of running and finished tasks, if they have
+    changed and the last write is at least min_interval_seconds ago.
+    '''
+    t = time.time()
+    if not force and (not ledger['changed'] or
+                      t - ledger['t_views'] < min_interval_seconds):
+        return False
+    for fname, tasks in [(fname_running_all, running_tasks(ledger)),
+                         (fname_finished_all, ledger['finished'])]:
+        fname_tmp = fname + '.tmp.' + ledger['host']
+        with open(fname_tmp, 'w') as f:
+            f.write('\n'.join(sorted(tasks)))
+        os.rename(fname_tmp, fname)
+    ledger['changed'] = False
+    ledger['t_views'] = t
+    return True
@@ -3,6 +3,14 @@ import time
 import os
 
 worker_max_task = {'numenor': 6, 'moria':4, 'gondolin':4}
+# With autoscale, each host starts at worker_max_task and adjusts it within
+# these bounds from its throughput and load (see autoscale.py).
+autoscale = False
+worker_max_task_bounds = {'numenor': (2, 10), 'moria': (1, 6), 'gondolin': (1, 6)}
+# The number of cores each task is pinned to, with OMP_NUM_THREADS etc. set
+# to match (see cpu_affinity.py): 0 divides the cores of the host evenly
+# between its worker_max_task tasks; None leaves the tasks unpinned.
+worker_cores_per_task = {'numenor': 0, 'moria': 0, 'gondolin': 0}
 only_night = [False, False, True]
 
 dust_to_gas_mass_ratio_s = [1e-2]
@@ -16,10 +24,25 @@ config_file_template = ''
 
 lines_to_model = ['H2O ground', 'CO (6-5)', 'CO (10-9)']
 
+# The raytracing_configure values of each line.  With queue_line_tasks,
+# once a run has finished, a line task for each of lines_to_model is queued,
+# which only does the ray tracing of the line from the data dump of the run.
+# The line tasks read the dump through a_disk_iter_params%dump_sub_dir_in,
+# which has to be in the iteration template.
+queue_line_tasks = False
 config_file_lines = {
-    'H2O ground': '',
-    'CO (6-5)': '',
-    'CO (10-9)': '',
+    'H2O ground': {'raytracing_conf%fname_mol_data': 'oh2o@rovib.dat',
+                   'raytracing_conf%nfreq_window': 1,
+                   'raytracing_conf%freq_mins': [5.5690e11],
+                   'raytracing_conf%freq_maxs': [5.5697e11]},
+    'CO (6-5)':   {'raytracing_conf%fname_mol_data': 'co.dat',
+                   'raytracing_conf%nfreq_window': 1,
+                   'raytracing_conf%freq_mins': [6.9143e11],
+                   'raytracing_conf%freq_maxs': [6.9152e11]},
+    'CO (10-9)':  {'raytracing_conf%fname_mol_data': 'co.dat',
+                   'raytracing_conf%nfreq_window': 1,
+                   'raytracing_conf%freq_mins': [1.1519e12],
+                   'raytracing_conf%freq_maxs': [1.1521e12]},
 }
 
 param_collection = {'sptype': star_spectral_types,
@@ -41,6 +64,91 @@ storage_dir = os.path.join(working_dir, 'data_dump/')
 res_dir = os.path.join(working_dir, 'results/')
 fname_task = os.path.join(working_dir, 'config_files/', 'tasks')
 
+# Set this to use a SQLite task database instead of the task file, e.g.
+#   fname_task_db = os.path.join(working_dir, 'config_files/', 'tasks.sqlite')
+# task_queue.py can import/export the plain text task file.
+fname_task_db = None
+
+# Number of processes used to generate the config files.
+n_proc_generate = 4
+
+# Name the runs by a hash of their parameters instead of a counter, so that
+# the grid can be extended with
+#   python main.py extend
+# which only generates and queues the new grid points.
+stable_run_ids = True
+
+# Start the runs expected to take longest first (see runtime_model.py).
+order_by_expected_runtime = True
+
+# Shared cache of the results of finished runs, keyed by their configs, so
+# that identical runs in later grids are not computed again.  Each finished
+# run is copied into it by the worker, between two passes of its loop, e.g.
+#     os.path.join(base_dir, 'result_cache/')
+# None to disable.
+result_cache_dir = None
+result_cache_max_gb = 500.0
+
+# Queue only the parameters of each run, and let the worker that claims a
+# run render its config file into local_config_dir, instead of writing all
+# the config files into config_dir up front.  The config files of failed
+# runs are kept in config_dir.
+lazy_config_rendering = False
+local_config_dir = os.path.join('/tmp', os.environ.get('USER', 'rac'),
+                                models_dir, 'config_files/')
+
+# Let the runs write their dumps and iteration files into node-local scratch
+# space, copied to storage_dir and res_dir once they have succeeded, instead
+# of writing over NFS all along, e.g.
+#     os.path.join('/tmp', os.environ.get('USER', 'rac'), models_dir, 'scratch/')
+# None to disable.
+scratch_dir = None
+scratch_max_gb = 50.0
+
+# Copy the input files of the solver (./inp/, ./transitions/...) once to
+# this host-local directory, and let the runs read them from there.
+# Set to None to disable.
+input_cache_dir = os.path.join('/tmp', os.environ.get('USER', 'rac'),
+                               'rac_input_cache/')
+
+# Append the parameters and these outputs of each finished run to a
+# columnar store, for grid-wide analyses (see result_store.py):
+#   column name: (file name in the iter_files_dir of the run, column of its
+#                 last line)
+result_store_dir = os.path.join(working_dir, 'result_store/')
+result_store_columns = {
+    'line_flux': ('line_flux.dat', -1),
+}
+
+# Each worker can serve its status as JSON on this port (0 for any free
+# port; None to turn it off), of the address status_bind: 127.0.0.1 for
+# this host only, '' for all the interfaces (a trusted network only).
+# python status_server.py log_dir merges them.
+status_port = None
+status_bind = '127.0.0.1'
+
+# Start each new run from the data dump of the nearest finished run of the
+# grid, if there is one close enough (see warm_start.py).  The run reads the
+# dump through a_disk_iter_params%dump_sub_dir_in, which has to be in the
+# iteration template.
+warm_start = False
+warm_start_max_distance = 0.5
+
+# Adaptive sampling: param_collection is only the coarse grid to start
+# with.  Each
+#   python main.py adapt
+# reads the result below from the finished runs and adds runs halfway
+# between neighbouring runs whose results differ by more than
+# adaptive_threshold (in dex), up to adaptive_max_runs runs in total
+# (see adaptive_sampling.py).
+adaptive_result_fname = 'line_flux.dat'  # In the iter_files_dir of each run.
+adaptive_result_column = -1              # Of the last line.
+adaptive_threshold = 0.3
+adaptive_max_runs = 2000
+
+# Saved star luminosities, so that they are not integrated again.
+star_lumi_cache_fname = os.path.join(working_dir, 'star_lumi_cache.dat')
+
 templates_info = {
     'disk': {'fname': 'disk_configure_template.dat', 'data': None},
     'grid': {'fname': 'grid_configure_template.dat', 'data': None},
@@ -63,17 +171,73 @@ from functions import *
 if __name__ == '__main__':
 
     import socket
+    import sys
     hostname = socket.gethostname()
     hostname_short = hostname.split('.')[0]
 
-    if not master_already_exist(working_dir):
-        set_self_as_master(working_dir, hostname)
+    adapt_grid = len(sys.argv) > 1 and sys.argv[1] == 'adapt'
+    extend_grid = (len(sys.argv) > 1 and sys.argv[1] == 'extend') or adapt_grid
+
+    dump_in_key = 'a_disk_iter_params%dump_sub_dir_in'
+    if (queue_line_tasks or warm_start) and not template_declares(
+            load_templates(template_dir, templates_info), dump_in_key):
+        print 'The line tasks and warm start need ' + dump_in_key + \
+              ' in the iteration template; add it or set ' + \
+              'queue_line_tasks = warm_start = False.'
+        sys.exit(1)
+
+    warm_start_runs = None
+    if warm_start:
+        import warm_start as ws
+        warm_start_runs = ws.load_warm_start_runs(
+            os.path.join(config_dir, 'LUT.dat'),
+            ws.finished_run_ids(load_all_task_metrics(log_dir)),
+            os.path.join(base_dir, storage_dir),
+            max_distance = warm_start_max_distance)
+        print 'Warm start from {0:d} finished runs.'.format(
+            len(warm_start_runs['runs']))
+
+    # Whoever takes master.lockfile first generates the tasks; if the master
+    # died while doing so, the next one to start takes over.
+    fname_queue = fname_task if fname_task_db is None else fname_task_db
+    is_master, reason = become_master(working_dir,
+                                      fname_queue + '.generating')
+    if reason is not None:
+        print 'Taking over as the master: ' + reason
+        # Keep the runs already generated.
+        extend_grid = stable_run_ids
+
+    if is_master or extend_grid:
         templates = load_templates(template_dir, templates_info)
         
         if not os.access(config_dir, os.F_OK):
             os.mkdir(config_dir)
         
-        print 'Generating the config files...'
+        set_star_lumi_cache_file(star_lumi_cache_fname)
+        priority_fn = None
+        if order_by_expected_runtime:
+            import runtime_model as rm
+            runtime_model = rm.fit_runtime_model(rm.collect_runtime_samples(
+                rm.load_lut(os.path.join(config_dir, 'LUT.dat')),
+                load_all_task_metrics(log_dir)))
+            priority_fn = lambda p: rm.predict_runtime(runtime_model, p)
+        existing = None
+        if extend_grid:
+            existing = existing_grid_points(config_dir, 'LUT.dat',
+                known_task_lines(log_dir, fname_task = fname_task,
+                                 fname_task_db = fname_task_db))
+            print 'Extending the grid of {0:d} runs.'.format(len(existing))
+        param_points = None
+        if adapt_grid:
+            import adaptive_sampling as asmp
+            param_points = asmp.next_campaign_points(
+                os.path.join(config_dir, 'LUT.dat'), res_dir,
+                adaptive_result_fname,
+                result_column = adaptive_result_column,
+                threshold = adaptive_threshold,
+                max_runs = adaptive_max_runs)
+            print 'Adding {0:d} runs.'.format(len(param_points))
+        print 'Generating the config files and the task file...'
         cfiles = generate_config_files(templates,
                                        base_dir = base_dir,
                                        storage_dir = storage_dir,
@@ -81,19 +245,41 @@ if __name__ == '__main__':
                                        config_dir = config_dir,
                                        section_keys = section_keys,
                                        param_collection = param_collection,
-                                       lut_fname = 'LUT.dat')
+                                       lut_fname = 'LUT.dat',
+                                       n_proc = n_proc_generate,
+                                       fname_task = fname_task,
+                                       fname_task_db = fname_task_db,
+                                       executable = executable,
+                                       priority_fn = priority_fn,
+                                       result_cache = (None
+                                           if result_cache_dir is None else
+                                           rc.open_result_cache(result_cache_dir,
+                                               max_gb = result_cache_max_gb)),
+                                       stable_run_ids = stable_run_ids,
+                                       existing = existing,
+                                       lazy = lazy_config_rendering,
+                                       warm_start_runs = warm_start_runs,
+                                       param_points = param_points,
+                                       log_dir = log_dir)
 
         print 'Finish generating the config files...'
-        print 'Generating the task file...'
-        with open(fname_task, 'w') as f:
-            for c in cfiles:
-                f.write(executable + ' ' + \
-                        os.path.join(config_dir, c) + '\n')
+        print 'Star luminosity cache: ', star_lumi_cache_stats()
         print 'Number of tasks to do: {0:d}'.format(len(cfiles))
 
     for d in [log_dir, config_dir, storage_dir, res_dir]:
         if not os.path.exists(d):
             os.mkdir(d)
+    lazy_render = None
+    if lazy_config_rendering:
+        set_star_lumi_cache_file(star_lumi_cache_fname)
+        lazy_render = {'templates': load_templates(template_dir, templates_info),
+                       'base_dir': base_dir,
+                       'storage_dir': storage_dir,
+                       'res_dir': res_dir,
+                       'section_keys': section_keys,
+                       'local_dir': local_config_dir,
+                       'archive_dir': config_dir,
+                       'warm_start_runs': warm_start_runs}
     print 'Start running the tasks...'
     max_task_fname = hostname_short + '.maxtasknum'
     print 'To change the max num of allowed parallel tasks, edit the file ', max_task_fname
@@ -102,5 +288,23 @@ if __name__ == '__main__':
               log_dir = log_dir,
               max_task_fname = max_task_fname,
               fname_task = fname_task,
+              fname_task_db = fname_task_db,
+              fname_lut = os.path.join(config_dir, 'LUT.dat'),
+              result_cache_dir = result_cache_dir,
+              result_cache_max_gb = result_cache_max_gb,
+              lazy_render = lazy_render,
+              line_tasks = (dict([(_, config_file_lines[_])
+                                  for _ in lines_to_model])
+                            if queue_line_tasks else None),
+              scratch_dir = scratch_dir,
+              scratch_max_gb = scratch_max_gb,
+              input_cache_dir = input_cache_dir,
+              result_store_dir = result_store_dir,
+              result_store_columns = result_store_columns,
+              status_port = status_port,
+              status_bind = status_bind,
+              max_task_bounds = (worker_max_task_bounds[hostname_short]
+                                 if autoscale else None),
+              cores_per_task = worker_cores_per_task.get(hostname_short),
               t_wait_seconds=10,
               t_wait_seconds_long=60)
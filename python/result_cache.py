@@ -0,0 +1,153 @@
+'''
+A cache of the results of finished runs, addressed by the content of their
+config files, so that a run with the same physical config as an earlier one
+is not computed again.
+
+The key of a run is the SHA-1 of its rendered config file without the lines
+of path_keys, which only say where the outputs go.  The outputs of a
+finished run (its iter_files_dir and its dump directory) are stored under
+cache_dir/<key>/ as copies, and copied back when a run is restored, so
+that a run rewriting its outputs cannot change the cache (or the reverse).
+The index, cache_dir/index.sqlite, records the size and the last use of
+each entry; the least recently used entries are removed when the total size
+is above the cap.
+'''
+
+import hashlib
+import os
+import shutil
+import sqlite3
+import time
+
+path_keys = ('a_disk_iter_params%dump_common_dir',
+             'a_disk_iter_params%dump_sub_dir_in',
+             'a_disk_iter_params%dump_sub_dir_out',
+             'a_disk_iter_params%iter_files_dir')
+
+
+def config_hash(cf):
+    '''
+    cf is the content of a config file, as a string.
+    '''
+    h = hashlib.sha1()
+    for line in cf.splitlines(True):
+        s = line.split()
+        if len(s) > 0 and s[0] in path_keys:
+            continue
+        h.update(line)
+    return h.hexdigest()
+
+
+def open_result_cache(cache_dir, max_gb=500.0):
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    conn = sqlite3.connect(os.path.join(cache_dir, 'index.sqlite'),
+                           timeout=60.0, isolation_level=None)
+    # The cache is usually on a shared file system, where WAL does not work.
+    conn.execute('PRAGMA journal_mode = DELETE')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS results (
+            hash    TEXT PRIMARY KEY,
+            size    INTEGER NOT NULL,
+            t_added REAL NOT NULL,
+            t_used  REAL NOT NULL,
+            source  TEXT
+        )''')
+    return {'dir': cache_dir, 'conn': conn,
+            'max_bytes': int(max_gb * 1024**3),
+            'hits': 0, 'misses': 0}
+
+
+def copy_tree(src, dst):
+    '''
+    Recreate the tree src at dst.  Return the total size of the files.
+    '''
+    size = 0
+    for root, dirs, files in os.walk(src):
+        d = os.path.join(dst, os.path.relpath(root, src))
+        if not os.path.exists(d):
+            os.makedirs(d)
+        for fn in files:
+            s = os.path.join(root, fn)
+            t = os.path.join(d, fn)
+            if os.path.exists(t):
+                # It may be a hard link into the cache.
+                os.remove(t)
+            shutil.copy2(s, t)
+            size += os.path.getsize(s)
+    return size
+
+
+def lookup_result(cache, key):
+    '''
+    Return the cache directory of key, or None.
+    '''
+    conn = cache['conn']
+    r = conn.execute('SELECT hash FROM results WHERE hash = ?',
+                     (key,)).fetchone()
+    d = os.path.join(cache['dir'], key)
+    if r is None or not os.path.exists(d):
+        cache['misses'] += 1
+        return None
+    with conn:
+        conn.execute('UPDATE results SET t_used = ? WHERE hash = ?',
+                     (time.time(), key))
+    cache['hits'] += 1
+    return d
+
+
+def restore_result(cache, key, iter_dir, dump_dir):
+    '''
+    Put the cached outputs of key into iter_dir and dump_dir.
+    Return False if key is not in the cache.
+    '''
+    d = lookup_result(cache, key)
+    if d is None:
+        return False
+    copy_tree(os.path.join(d, 'iter'), iter_dir)
+    copy_tree(os.path.join(d, 'dump'), dump_dir)
+    return True
+
+
+def add_result(cache, key, iter_dir, dump_dir, source=''):
+    '''
+    Store the outputs of a finished run, then evict the least recently used
+    entries if the cache is over its size cap.
+    '''
+    conn = cache['conn']
+    d = os.path.join(cache['dir'], key)
+    if os.path.exists(d):
+        return False
+    d_tmp = d + '.tmp{0:d}'.format(os.getpid())
+    size = 0
+    for src, name in [(iter_dir, 'iter'), (dump_dir, 'dump')]:
+        if os.path.exists(src):
+            size += copy_tree(src, os.path.join(d_tmp, name))
+    try:
+        os.rename(d_tmp, d)
+    except OSError:
+        # Added by another host in the meantime.
+        shutil.rmtree(d_tmp, ignore_errors=True)
+        return False
+    t = time.time()
+    with conn:
+        conn.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)',
+                     (key, size, t, t, source))
+    evict_results(cache)
+    return True
+
+
+def evict_results(cache):
+    conn = cache['conn']
+    evicted = []
+    while True:
+        total = conn.execute('SELECT SUM(size) FROM results').fetchone()[0]
+        if total is None or total <= cache['max_bytes']:
+            break
+        key = conn.execute(
+            'SELECT hash FROM results ORDER BY t_used LIMIT 1').fetchone()[0]
+        with conn:
+            conn.execute('DELETE FROM results WHERE hash = ?', (key,))
+        shutil.rmtree(os.path.join(cache['dir'], key), ignore_errors=True)
+        evicted.append(str(key))
+    return evicted
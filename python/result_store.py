@@ -0,0 +1,154 @@
+'''
+A columnar store of the parameters and key outputs of the finished runs, so
+that grid-wide analyses do not have to walk the results directories and
+parse LUT.dat.
+
+The store is a directory with one file per column, <name>.col, holding the
+values of the rows back to back in a fixed-width binary type (schema.json
+gives the types), so that a column can be memory-mapped by numpy without
+reading the others:
+    run_id, line, sptype         fixed-width strings
+    rin, rout, d2g, mdust        float64
+    t_ingest                     float64, time of the ingest
+plus one float64 column for each key output, read from the iter_files_dir of
+the run as in adaptive_sampling.read_scalar_result (NaN if missing).
+main_loop appends one row for each successful run (see ingest_run); the
+writers of all the hosts take turns with store.lockfile.  A run that has
+been run again has several rows; query keeps the latest one.
+'''
+
+import json
+import os
+import struct
+import time
+
+param_columns = [('run_id', 'S24'), ('line', 'S16'), ('sptype', 'S4'),
+                 ('rin', '<f8'), ('rout', '<f8'), ('d2g', '<f8'),
+                 ('mdust', '<f8'), ('t_ingest', '<f8')]
+
+
+def item_size(dtype):
+    return int(dtype[2:]) if dtype[0] == '<' else int(dtype[1:])
+
+
+def pack_value(dtype, v):
+    if dtype[0] == 'S':
+        return str(v)[:item_size(dtype)].ljust(item_size(dtype), '\0')
+    return struct.pack('<d', float('nan') if v is None else v)
+
+
+def open_result_store(store_dir, output_columns):
+    '''
+    output_columns maps the names of the output columns to
+    (file name, column) in the iter_files_dir of a run.
+    '''
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+    schema = param_columns + [(k, '<f8') for k in sorted(output_columns)]
+    fname = os.path.join(store_dir, 'schema.json')
+    if os.path.exists(fname):
+        with open(fname, 'r') as f:
+            old = [tuple(_) for _ in json.load(f)]
+        if old != schema:
+            raise ValueError('The columns of the result store ' + store_dir +
+                             ' differ from ' + repr(schema))
+    else:
+        with open(fname + '.tmp', 'w') as f:
+            json.dump(schema, f)
+        os.rename(fname + '.tmp', fname)
+    return {'dir': store_dir, 'schema': schema, 'outputs': output_columns}
+
+
+def column_fname(store, name):
+    return os.path.join(store['dir'], name + '.col')
+
+
+def n_rows(store):
+    '''
+    The number of complete rows; a row is complete once it is in every
+    column.
+    '''
+    n = []
+    for name, dtype in store['schema']:
+        try:
+            n.append(os.path.getsize(column_fname(store, name)) //
+                     item_size(dtype))
+        except OSError:
+            n.append(0)
+    return min(n)
+
+
+def append_rows(store, rows, t_wait_seconds=0.2):
+    '''
+    rows is a list of dicts from the column names to the values.
+    '''
+    from functions import create_lock_file, break_stale_lock
+    fname_lock = os.path.join(store['dir'], 'store.lockfile')
+    while not create_lock_file(fname_lock):
+        break_stale_lock(fname_lock, stale_seconds = 600)
+        time.sleep(t_wait_seconds)
+    try:
+        # Drop the incomplete row left by a writer that died.
+        n = n_rows(store)
+        for name, dtype in store['schema']:
+            fname = column_fname(store, name)
+            with open(fname, 'ab') as f:
+                if f.tell() != n * item_size(dtype):
+                    f.truncate(n * item_size(dtype))
+                    f.seek(0, 2)
+                f.write(''.join([pack_value(dtype, r.get(name))
+                                 for r in rows]))
+    finally:
+        os.remove(fname_lock)
+    return n + len(rows)
+
+
+def ingest_run(store, run_id, p, iter_dir, line=''):
+    '''
+    Append the row of a finished run with parameters p.
+    '''
+    from adaptive_sampling import read_scalar_result
+    row = dict(p)
+    row.update({'run_id': run_id, 'line': line, 't_ingest': time.time()})
+    for k, (fname, column) in store['outputs'].items():
+        row[k] = read_scalar_result(iter_dir, fname, column = column)
+    return append_rows(store, [row])
+
+
+def load_columns(store_dir, names):
+    '''
+    Memory-map the columns names of the store.
+    '''
+    import numpy as np
+    with open(os.path.join(store_dir, 'schema.json'), 'r') as f:
+        schema = dict([tuple(_) for _ in json.load(f)])
+    store = {'dir': store_dir, 'schema': schema.items()}
+    n = n_rows(store)
+    columns = {}
+    for name in names:
+        if n == 0:
+            columns[name] = np.zeros(0, dtype=schema[name])
+        else:
+            columns[name] = np.memmap(column_fname(store, name), mode='r',
+                                      dtype=schema[name], shape=(n,))
+    return columns
+
+
+def query(store_dir, names, **where):
+    '''
+    Return the columns names of the latest rows of the runs whose columns
+    equal the values in where, e.g.
+        query(store_dir, ['rin', 'line_flux'], sptype='K', line='CO_6-5')
+    Only the columns in names and where, and run_id, are read.
+    '''
+    import numpy as np
+    c = load_columns(store_dir, set(names) | set(where) | set(['run_id']))
+    mask = np.ones(len(c['run_id']), dtype=bool)
+    for k, v in where.items():
+        mask &= (c[k] == v)
+    idx = np.nonzero(mask)[0]
+    # The latest row of each run.
+    ids = c['run_id'][idx][::-1]
+    u, first = np.unique(ids, return_index=True)
+    idx = np.sort(idx[::-1][first])
+    return dict([(k, np.asarray(c[k][idx])) for k in names])
@@ -0,0 +1,106 @@
+'''
+Predict the wall time of a run from its grid parameters, so that the tasks
+expected to take longest can be started first.
+
+The model is a least-squares fit of log10(wall time) against
+    log10(rin), log10(rout), log10(d2g), log10(mdust), log10(Tstar),
+using the runs that have finished (wall times from the metrics files,
+parameters from LUT.dat).  Before there are enough finished runs, a
+heuristic is used instead: runs with a small rin, a large dust mass and a
+hot star are expected to be slow.
+'''
+
+import os
+from math import log10
+
+
+def lut_key_of_task(s_task):
+    '''
+    'path/conf_run_001.dat' -> '001'
+    'exe lazy:001 rin=...' -> '001'
+    '''
+    s = s_task.split()
+    if len(s) > 1 and s[1].startswith('lazy:'):
+        return s[1][len('lazy:'):]
+    name = os.path.basename(s[-1])
+    if name.startswith('conf_run_') and name.endswith('.dat'):
+        return name[len('conf_run_'):-len('.dat')]
+    return None
+
+
+def load_lut(fname):
+    '''
+    Read the LUT written by generate_config_files into a dict of
+    parameters keyed by the run number.
+    '''
+    lut = {}
+    try:
+        with open(fname, 'r') as f:
+            lines = f.readlines()
+    except IOError:
+        return lut
+    names = {'rin': 'rin', 'rout': 'rout', 'd2g': 'd2g', 'mdust': 'mdust',
+             'spectralType': 'sptype'}
+    for line in lines[1:]:
+        if ':' not in line:
+            continue
+        key, s = line.split(':', 1)
+        p = {}
+        for item in s.split(','):
+            kv = item.split('=')
+            if len(kv) != 2 or kv[0].strip() not in names:
+                continue
+            k, v = names[kv[0].strip()], kv[1].strip()
+            p[k] = v if k == 'sptype' else float(v)
+        lut[key.strip()] = p
+    return lut
+
+
+def runtime_features(p):
+    from functions import spectral_to_temperature
+    return [1.0,
+            log10(p['rin']),
+            log10(p['rout']),
+            log10(p['d2g']),
+            log10(p['mdust']),
+            log10(spectral_to_temperature[p['sptype']])]
+
+
+def collect_runtime_samples(lut, metrics):
+    '''
+    Pair the parameters in lut with the wall times of the successful runs in
+    metrics (as from load_task_metrics).
+    '''
+    samples = []
+    for m in metrics:
+        if m.get('exitcode', 1) != 0:
+            continue
+        key = lut_key_of_task(m['task'])
+        if key in lut:
+            samples.append((lut[key], m['wall_seconds']))
+    return samples
+
+
+def fit_runtime_model(samples, min_samples=12):
+    '''
+    Return the fitted model, or None if there are too few samples.
+    '''
+    if len(samples) < min_samples:
+        return None
+    import numpy as np
+    x = np.array([runtime_features(p) for p, _ in samples])
+    y = np.array([log10(max(t, 1.0)) for _, t in samples])
+    coef = np.linalg.lstsq(x, y, rcond=-1)[0]
+    return {'coef': [float(_) for _ in coef], 'n_samples': len(samples)}
+
+
+def predict_runtime(model, p):
+    '''
+    Expected wall time in seconds.  Without a model, a nominal value that
+    only serves to order the runs.
+    '''
+    f = runtime_features(p)
+    if model is None:
+        # 1 hour for rin = 1 AU, mdust = 1e-4 Msun, Tstar = 5920 K
+        return 3600.0 * 10**(f[4] + 4.0 - f[1] + (f[5] - log10(5920.0)))
+    return 10**sum([c * _ for c, _ in zip(model['coef'], f)])
@@ -0,0 +1,170 @@
+'''
+The decisions main_loop makes on each pass, shared with the simulator
+(see simulator.py), which runs them on a virtual clock.
+
+A pass of schedule_pass
+    stops the worker if no task is running and none is left;
+    updates the number of tasks to run at once from the autoscaler (see
+        autoscale.py) and the override of max_task_fname, and divides the
+        cores between them again (see cpu_affinity.py);
+    waits if max_task tasks are running or the CPU load is above max_pcpu;
+    claims the tasks of the free slots; if there is none, it waits while
+        the tasks are still being generated, and otherwise drains;
+    starts the claimed tasks in order while they fit in memory (see
+        admission.py), each pinned to cores of its own if there is a core
+        pool;
+    gives the tasks that do not fit back to the queue, for any host to
+        take, and gives up on a task refused max_refusals times.
+It returns the sleep that ends the pass, as (reason, seconds, wakes),
+wakes telling whether the sleep ends when a running task exits.
+
+What the pass needs from the host and the queue comes from probes, a dict
+of functions:
+    now()               the time
+    n_running()         the number of running tasks
+    running_mem()       the (estimated, current) memory in MB of each
+    pcpu()              the CPU load, as a fraction
+    memory()            the total and available memory in MB
+    pressure()          the load, as functions.check_pressure returns it
+                        (only with an autoscaler)
+    max_task()          a number of tasks that overrides the target, or
+                        None (optional)
+    claim(n)            claim up to n tasks: return a list of dicts, each
+                        with the 'task' line and its 'footprint' key, or a
+                        sleep to end the pass with (e.g. the queue is
+                        locked), or None to stop the worker
+    generating()        whether the tasks are still being generated
+    start(t, est_mb, cores)
+                        start the task t; return False if it failed
+    fail(t)             record the task t as failed
+    give_back(ts)       put the tasks ts back at the head of the queue
+    log(s)              write a line to the log of the worker
+'''
+
+import admission as ad
+import autoscale as asc
+import cpu_affinity as ca
+
+
+def new_scheduler(max_task,
+                  max_pcpu = 0.6,
+                  t_wait_seconds = 10,
+                  t_wait_seconds_long = 60,
+                  max_pvmem = 0.9,
+                  mem_base_mb = 200.0,
+                  mem_per_cell_kb = 50.0,
+                  max_refusals = 1000,
+                  footprints = None,
+                  autoscaler = None,
+                  core_pool = None):
+    return {'max_task': max_task,
+            'max_pcpu': max_pcpu,
+            't_wait_seconds': t_wait_seconds,
+            't_wait_seconds_long': t_wait_seconds_long,
+            'max_pvmem': max_pvmem,
+            'mem_base_mb': mem_base_mb,
+            'mem_per_cell_kb': mem_per_cell_kb,
+            'max_refusals': max_refusals,
+            'footprints': (ad.new_footprint_history()
+                           if footprints is None else footprints),
+            'autoscaler': autoscaler,
+            'core_pool': core_pool,
+            'no_task_left': False,
+            'n_refused': {},
+            'last_refused': None}
+
+
+def schedule_pass(sched, probes):
+    '''
+    Run one pass with the state sched (from new_scheduler).  Return the
+    sleep (reason, seconds, wakes) that ends it, or None once the worker
+    is done.
+    '''
+    log = probes['log']
+    n_running = probes['n_running']()
+    if n_running == 0 and sched['no_task_left']:
+        return None
+    #
+    a = sched['autoscaler']
+    if a is not None:
+        asc.record_tick(a, probes['now'](), n_running)
+        sched['max_task'], reason = asc.update_target(a, probes['now'](),
+                                                      probes['pressure'])
+        if reason is not None:
+            log('Running up to {0:d} tasks: '.format(sched['max_task']) + \
+                reason)
+    if 'max_task' in probes:
+        n = probes['max_task']()
+        if n is not None:
+            sched['max_task'] = n
+    pool = sched['core_pool']
+    if pool is not None and ca.resize_core_pool(pool, sched['max_task']):
+        log('{0:d} cores per task'.format(pool['cores_per_task']))
+    #
+    if not (probes['pcpu']() < sched['max_pcpu'] and
+            n_running < sched['max_task']):
+        return 'busy', sched['t_wait_seconds_long'], True
+    #
+    claimed = probes['claim'](sched['max_task'] - n_running)
+    if claimed is None:
+        return None
+    if type(claimed) == tuple:
+        return claimed
+    if len(claimed) == 0:
+        if probes['generating']():
+            return 'generating', sched['t_wait_seconds'], False
+        sched['no_task_left'] = True
+        # Wait for the running tasks to finish, or for new tasks to come in.
+        return 'drain', (sched['t_wait_seconds_long']
+                         if n_running > 0 else 0.0), True
+    sched['no_task_left'] = False
+    #
+    pending = list(claimed)
+    n_refused = sched['n_refused']
+    mem_total_mb, mem_available_mb = probes['memory']()
+    running_mem = probes['running_mem']()
+    while len(pending) > 0:
+        t = pending[0]
+        est_mb, how = ad.estimate_task_memory_mb(t['footprint'],
+                                                 sched['footprints'],
+                                                 mem_base_mb = sched['mem_base_mb'],
+                                                 mem_per_cell_kb = sched['mem_per_cell_kb'])
+        admitted, reason = ad.admit_task(est_mb, running_mem,
+                                         mem_total_mb, mem_available_mb,
+                                         max_pvmem = sched['max_pvmem'])
+        if not admitted:
+            break
+        if len(reason) > 0:
+            log('Starting ' + t['task'] + ' with no task running, ' + \
+                'although ' + reason + ' (' + how + ' estimate)')
+        cores = None
+        if pool is not None:
+            cores = ca.allocate_cores(pool)
+            if cores is None:
+                log('Starting ' + t['task'] + ' unpinned, fewer than ' + \
+                    '{0:d} cores are free'.format(pool['cores_per_task']))
+        pending.pop(0)
+        n_refused.pop(t['task'], None)
+        if probes['start'](t, est_mb, cores):
+            running_mem.append((est_mb, 0.0))
+        elif cores is not None:
+            ca.release_cores(pool, cores)
+    #
+    if len(pending) > 0:
+        k = pending[0]['task']
+        if k != sched['last_refused']:
+            sched['last_refused'] = k
+            log('Not starting ' + k + ': ' + reason + \
+                (' (' + how + ' estimate)' if how else ''))
+        n_refused[k] = n_refused.get(k, 0) + 1
+        if sched['max_refusals'] is not None and \
+                n_refused[k] >= sched['max_refusals']:
+            del n_refused[k]
+            probes['fail'](pending.pop(0))
+            log('Giving up on ' + k + \
+                ' after {0:d} refusals: '.format(sched['max_refusals']) + \
+                reason)
+        # Let the other hosts take them.
+        probes['give_back'](pending)
+        return 'refused', sched['t_wait_seconds_long'], True
+    return 'launch', sched['t_wait_seconds'], True
@@ -0,0 +1,154 @@
+'''
+Run a task in node-local scratch space instead of writing its dump and
+iteration files straight to the shared file system.
+
+stage_run writes a copy of the config file of the task whose
+dump_common_dir and iter_files_dir point into scratch_dir/<run name>/, and
+copies there the dump the run reads, if any (dump_sub_dir_in).  Once the run
+has succeeded, sync_run copies its outputs to the shared directories of the
+original config file, checking the SHA-1 of each copied file, and the
+scratch directory is removed.  The scratch directories of failed runs are
+left for inspection, and removed oldest first by clean_scratch when the
+scratch space is over its cap.
+'''
+
+import hashlib
+import os
+import shutil
+
+chunk_size = 1024 * 1024
+
+
+def copy_file_checked(src, dst):
+    '''
+    Copy src to dst through dst.part, and check that dst reads back with
+    the same SHA-1 as src.  Return the size.
+    '''
+    h_src = hashlib.sha1()
+    with open(src, 'rb') as f_src:
+        with open(dst + '.part', 'wb') as f_dst:
+            while True:
+                b = f_src.read(chunk_size)
+                if len(b) == 0:
+                    break
+                h_src.update(b)
+                f_dst.write(b)
+    h_dst = hashlib.sha1()
+    with open(dst + '.part', 'rb') as f:
+        while True:
+            b = f.read(chunk_size)
+            if len(b) == 0:
+                break
+            h_dst.update(b)
+    if h_dst.hexdigest() != h_src.hexdigest():
+        os.remove(dst + '.part')
+        raise IOError('Checksum mismatch copying ' + src + ' to ' + dst)
+    shutil.copystat(src, dst + '.part')
+    os.rename(dst + '.part', dst)
+    return os.path.getsize(dst)
+
+
+def copy_tree_checked(src, dst):
+    size = 0
+    for root, dirs, files in os.walk(src):
+        d = os.path.join(dst, os.path.relpath(root, src))
+        if not os.path.exists(d):
+            os.makedirs(d)
+        for fn in files:
+            size += copy_file_checked(os.path.join(root, fn),
+                                      os.path.join(d, fn))
+    return size
+
+
+def stage_run(fname_config, scratch_dir):
+    '''
+    Prepare the scratch directory of the run of fname_config.
+    Return the staging record, whose 'config' is the config file to run.
+    '''
+    from functions import load_file_lines, parse_config_lines, \
+                          render_a_config
+    keys = ('a_disk_iter_params%dump_common_dir',
+            'a_disk_iter_params%dump_sub_dir_in',
+            'a_disk_iter_params%dump_sub_dir_out',
+            'a_disk_iter_params%iter_files_dir')
+    cf = ''.join(load_file_lines(fname_config))
+    values = parse_config_lines(cf.splitlines(), keys=keys)
+    name = os.path.splitext(os.path.basename(fname_config))[0]
+    d = os.path.join(scratch_dir, name)
+    if os.path.exists(d):
+        shutil.rmtree(d)
+    stage = {'dir': d,
+             'config': os.path.join(d, os.path.basename(fname_config)),
+             'iter_dir': values[keys[3]],
+             'dump_dir': os.path.join(values[keys[0]], values[keys[2]]),
+             'scratch_iter_dir': os.path.join(d, 'iter/'),
+             'scratch_dump_dir': os.path.join(d, 'dump', values[keys[2]])}
+    try:
+        for _ in (stage['scratch_iter_dir'], stage['scratch_dump_dir']):
+            os.makedirs(_)
+        if keys[1] in values:
+            src = os.path.join(values[keys[0]], values[keys[1]])
+            if os.path.isdir(src):
+                copy_tree_checked(src,
+                                  os.path.join(d, 'dump', values[keys[1]]))
+        with open(stage['config'], 'w') as f:
+            f.write(render_a_config(cf,
+                {keys[0]: os.path.join(d, 'dump/'),
+                 keys[3]: stage['scratch_iter_dir']},
+                comment = '  ! Staged'))
+    except (IOError, OSError):
+        # Do not leave a half staged run behind.
+        shutil.rmtree(d, ignore_errors=True)
+        raise
+    return stage
+
+
+def sync_run(stage):
+    '''
+    Copy the outputs of a finished run to the shared directories.
+    Return the number of bytes copied.
+    '''
+    return copy_tree_checked(stage['scratch_iter_dir'], stage['iter_dir']) + \
+           copy_tree_checked(stage['scratch_dump_dir'], stage['dump_dir'])
+
+
+def remove_run(stage):
+    shutil.rmtree(stage['dir'], ignore_errors=True)
+    return
+
+
+def tree_size(d):
+    size = 0
+    for root, dirs, files in os.walk(d):
+        for fn in files:
+            try:
+                size += os.path.getsize(os.path.join(root, fn))
+            except OSError:
+                pass
+    return size
+
+
+def clean_scratch(scratch_dir, max_gb=50.0, active=()):
+    '''
+    Remove the oldest run directories in scratch_dir, except those in
+    active, while their total size is above max_gb.
+    Return the removed directories.
+    '''
+    if not os.path.isdir(scratch_dir):
+        return []
+    runs = []
+    for name in os.listdir(scratch_dir):
+        d = os.path.join(scratch_dir, name)
+        if os.path.isdir(d):
+            runs.append((os.path.getmtime(d), d, tree_size(d)))
+    total = sum([_[2] for _ in runs])
+    removed = []
+    for t, d, size in sorted(runs):
+        if total <= max_gb * 1024**3:
+            break
+        if d in active:
+            continue
+        shutil.rmtree(d, ignore_errors=True)
+        total -= size
+        removed.append(d)
+    return removed
@@ -0,0 +1,324 @@
+'''
+Discrete-event simulation of main_loop running a campaign on several hosts,
+to choose worker_max_task, max_pcpu, t_wait_seconds and the mix of hosts
+before spending cluster time on it.
+
+Each host runs host_loop, which makes the decisions of main_loop by
+calling the same scheduling.schedule_pass on each pass (the checks of
+max_task, max_pcpu and the autoscaler, claiming the tasks of the free
+slots, the .generating wait, admission with admission.py, core pinning,
+and giving back the tasks it cannot start), on a virtual clock: a sleep
+only moves the host forward in time.  As in main_loop, the sleeps on the
+running tasks end early when one of them exits if wake_on_exit is set;
+the sleeps on the lock of the task file do not.  The hosts claim from one
+shared queue, holding its lock for lock_seconds per claim:
+    file    as from the task file: a host that finds it locked sleeps
+            t_wait_seconds and starts its pass again;
+    db      as from the task database: a host waits for the lock just as
+            long as it is held (the busy timeout of sqlite).
+The tasks are queued evenly over generation_seconds (all of them at once
+by default), and the hosts never fail.  The CPU load of a host is the
+number of cores its running tasks use over its n_cpu, its memory in use
+is mem_background_mb plus the peak memory of its running tasks, and its
+pressure for the autoscaler is made of these two.
+
+The runtimes and memory of the tasks are either synthetic (log-normal) or
+replayed from the metrics.<host> files of an earlier campaign.  Besides
+the makespan, the report gives the idle slot-seconds of each host (a slot
+is one of the max_task tasks a host may run), by the reason of the sleep
+during which the slot was idle:
+    launch      the sleep of t_wait_seconds after each launch
+    busy        max_task or max_pcpu reached
+    refused     a task did not fit in memory (it is still started when
+                nothing is running, and counted as failed once it has been
+                refused max_refusals times)
+    drain       no task left to claim
+    generating  no task left to claim yet, while they are being generated
+    locked      waiting for the lock of the queue
+A campaign of 10^4 tasks on three hosts takes a few seconds:
+    python simulator.py [n_tasks [log_dir [n_cpu]]]
+'''
+
+import heapq
+import math
+import random
+from collections import deque
+
+import admission as ad
+import autoscale as asc
+import cpu_affinity as ca
+import scheduling as sch
+
+
+def synthetic_tasks(n_tasks,
+                    median_seconds = 3600.0,
+                    sigma = 0.5,
+                    median_mem_mb = 1000.0,
+                    mem_sigma = 0.3,
+                    n_cells = 10000,
+                    seed = 0):
+    '''
+    Tasks with log-normal runtimes and peak memory, all with the footprint
+    key of n_cells cells.
+    '''
+    r = random.Random(seed)
+    return [{'task': 'task_{0:06d}'.format(i),
+             'seconds': median_seconds * math.exp(r.gauss(0.0, sigma)),
+             'mem_mb': median_mem_mb * math.exp(r.gauss(0.0, mem_sigma)),
+             'cpu': 1.0,
+             'footprint': (n_cells, None)}
+            for i in xrange(n_tasks)]
+
+
+def replayed_tasks(metrics, n_tasks = None, seed = 0):
+    '''
+    Tasks from the records of the successful runs in metrics (as from
+    load_all_task_metrics), resampled to n_tasks if it is given.
+    '''
+    tasks = [{'task': m['task'],
+              'seconds': m['wall_seconds'],
+              'mem_mb': m['maxrss_kb'] / 1024.0,
+              'cpu': min(1.0, (m['utime_seconds'] + m['stime_seconds']) /
+                              max(m['wall_seconds'], 1e-3)),
+              'footprint': tuple(m.get('footprint', (None, None)))}
+             for m in metrics if m.get('exitcode', 1) == 0]
+    if n_tasks is None or len(tasks) == 0:
+        return tasks
+    r = random.Random(seed)
+    return [dict(r.choice(tasks), task = 'task_{0:06d}'.format(i))
+            for i in xrange(n_tasks)]
+
+
+def new_host(name, max_task,
+             n_cpu = 16,
+             mem_total_mb = 64000.0,
+             mem_background_mb = 2000.0):
+    return {'name': name,
+            'max_task': max_task,
+            'n_cpu': n_cpu,
+            'mem_total_mb': mem_total_mb,
+            'mem_background_mb': mem_background_mb,
+            'running': [],
+            'footprints': ad.new_footprint_history(),
+            'n_run': 0,
+            'n_failed': 0,
+            'n_ticks': 0,
+            'busy_seconds': 0.0,
+            'idle_seconds': {},
+            't_done': None}
+
+
+def host_loop(sim, h):
+    '''
+    main_loop of host h; yields (reason, seconds, wake_on_exit) for each
+    sleep, wake_on_exit telling whether it ends when a task exits.
+    '''
+    p = sim['policy']
+    sched = h['sched']
+    #
+    def mem_in_use_mb():
+        return h['mem_background_mb'] + \
+               sum([_['mem_mb'] for _ in h['running']])
+    #
+    def pcpu():
+        return min(1.0, sum([_['cpu'] for _ in h['running']]) / h['n_cpu'])
+    #
+    def claim(n):
+        now = sim['now']
+        if sim['t_unlocked'] > now:
+            if p['claim'] == 'file':
+                return 'locked', p['t_wait_seconds'], False
+            return 'locked', sim['t_unlocked'] - now, False
+        sim['t_unlocked'] = now + p['lock_seconds']
+        q = sim['queue']
+        claimed = []
+        while len(claimed) < n and len(q) > 0 and q[0]['t_queued'] <= now:
+            claimed.append(q.popleft())
+        return claimed
+    #
+    def start(t, est_mb, cores):
+        h['running'].append(dict(t, est_mb = est_mb, cores = cores,
+                                 t_start = sim['now'],
+                                 t_end = sim['now'] + t['seconds']))
+        h['n_run'] += 1
+        return True
+    #
+    def fail(t):
+        h['n_failed'] += 1
+    #
+    probes = {'now': lambda: sim['now'],
+              'n_running': lambda: len(h['running']),
+              'running_mem': lambda: [(_['est_mb'], _['mem_mb'])
+                                      for _ in h['running']],
+              'pcpu': pcpu,
+              'memory': lambda: (h['mem_total_mb'],
+                                 h['mem_total_mb'] - mem_in_use_mb()),
+              'pressure': lambda: {'load': pcpu(),
+                                   'pvmem': mem_in_use_mb() / h['mem_total_mb']},
+              'claim': claim,
+              'generating': lambda: sim['now'] < sim['t_generated'],
+              'start': start,
+              'fail': fail,
+              # Released for the other hosts.
+              'give_back': lambda ts: sim['queue'].extendleft(reversed(ts)),
+              'log': lambda s: None}
+    while True:
+        h['n_ticks'] += 1
+        now = sim['now']
+        finished = [_ for _ in h['running'] if _['t_end'] <= now]
+        h['running'] = [_ for _ in h['running'] if _['t_end'] > now]
+        for t in finished:
+            ad.add_footprint(sched['footprints'], t['footprint'],
+                             t['mem_mb'] * 1024.0)
+            if sched['core_pool'] is not None:
+                ca.release_cores(sched['core_pool'], t['cores'])
+            if sched['autoscaler'] is not None:
+                asc.record_finished(sched['autoscaler'],
+                    {'utime_seconds': t['seconds'] * t['cpu'],
+                     'stime_seconds': 0.0})
+            sim['t_last_end'] = max(sim['t_last_end'], t['t_end'])
+        sleep = sch.schedule_pass(sched, probes)
+        if sleep is None:
+            h['t_done'] = now
+            return
+        yield sleep
+
+
+def account_sleep(h, reason, t0, t1):
+    '''
+    Add the busy and idle slot-seconds of host h between t0 and t1.
+    '''
+    busy = sum([max(0.0, min(t1, _['t_end']) - max(t0, _['t_start']))
+                for _ in h['running']])
+    h['busy_seconds'] += busy
+    h['idle_seconds'][reason] = h['idle_seconds'].get(reason, 0.0) + \
+        max(0.0, h['max_task'] * (t1 - t0) - busy)
+    return
+
+
+def simulate(tasks, hosts,
+             max_pcpu = 0.6,
+             t_wait_seconds = 10,
+             t_wait_seconds_long = 60,
+             max_pvmem = 0.9,
+             mem_base_mb = 200.0,
+             mem_per_cell_kb = 50.0,
+             max_refusals = 1000,
+             claim = 'file',
+             lock_seconds = 0.2,
+             wake_on_exit = True,
+             max_task_bounds = None,
+             autoscale_seconds = 1800,
+             cores_per_task = None,
+             generation_seconds = 0.0):
+    '''
+    Run tasks on hosts (from new_host) with the main_loop settings given,
+    claiming from the task file (claim='file') or the task database
+    (claim='db'), each claim holding the lock for lock_seconds.  The
+    tasks are queued evenly over generation_seconds.  With max_task_bounds
+    the idle slots are still counted from the max_task of the hosts.
+    Return the report.
+    '''
+    n = max(1, len(tasks))
+    sim = {'now': 0.0,
+           't_last_end': 0.0,
+           't_unlocked': 0.0,
+           't_generated': generation_seconds,
+           'queue': deque([dict(t, t_queued = generation_seconds * (i + 1) / n)
+                           for i, t in enumerate(tasks)]),
+           'policy': {'claim': claim,
+                      'lock_seconds': lock_seconds,
+                      't_wait_seconds': t_wait_seconds}}
+    for h in hosts:
+        h['sched'] = sch.new_scheduler(h['max_task'],
+            max_pcpu = max_pcpu,
+            t_wait_seconds = t_wait_seconds,
+            t_wait_seconds_long = t_wait_seconds_long,
+            max_pvmem = max_pvmem,
+            mem_base_mb = mem_base_mb,
+            mem_per_cell_kb = mem_per_cell_kb,
+            max_refusals = max_refusals,
+            footprints = h['footprints'],
+            autoscaler = (None if max_task_bounds is None else
+                asc.new_autoscaler(h['max_task'], max_task_bounds[0],
+                                   max_task_bounds[1],
+                                   interval_seconds = autoscale_seconds)),
+            core_pool = (None if cores_per_task is None else
+                ca.new_core_pool(cores_per_task, h['max_task'],
+                                 nodes = [range(h['n_cpu'])])))
+    loops = [host_loop(sim, h) for h in hosts]
+    # (wake-up time, host index, time the sleep began, reason)
+    events = [(0.0, i, 0.0, None) for i in xrange(len(hosts))]
+    while len(events) > 0:
+        t, i, t_sleep, reason = heapq.heappop(events)
+        if reason is not None:
+            account_sleep(hosts[i], reason, t_sleep, t)
+        sim['now'] = t
+        try:
+            reason, seconds, wakes = next(loops[i])
+        except StopIteration:
+            continue
+        if wake_on_exit and wakes and len(hosts[i]['running']) > 0:
+            seconds = min(seconds,
+                max(0.0, min([_['t_end'] for _ in hosts[i]['running']]) - t))
+        heapq.heappush(events, (t + seconds, i, t, reason))
+    makespan = max(sim['t_last_end'], 1e-9)
+    slots = sum([_['max_task'] for _ in hosts])
+    report = {'makespan_hours': makespan / 3600.0,
+              'n_tasks': len(tasks),
+              'utilization': sum([_['busy_seconds'] for _ in hosts]) / \
+                             (slots * makespan),
+              'idle_slot_hours': {},
+              'hosts': []}
+    for h in hosts:
+        for k, v in h['idle_seconds'].items():
+            report['idle_slot_hours'][k] = \
+                report['idle_slot_hours'].get(k, 0.0) + v / 3600.0
+        report['hosts'].append({
+            'name': h['name'],
+            'n_run': h['n_run'],
+            'n_failed': h['n_failed'],
+            'n_ticks': h['n_ticks'],
+            'busy_slot_hours': h['busy_seconds'] / 3600.0,
+            'idle_slot_hours': dict([(k, v / 3600.0)
+                                     for k, v in h['idle_seconds'].items()]),
+            'done_hours': (h['t_done'] or 0.0) / 3600.0})
+    return report
+
+
+def print_report(report, title = ''):
+    print '{0:s}: makespan {1:.2f} h, utilization {2:.1%}'.format(
+        title, report['makespan_hours'], report['utilization'])
+    print '    idle slot-hours: ' + ', '.join(
+        ['{0:s} {1:.1f}'.format(k, v)
+         for k, v in sorted(report['idle_slot_hours'].items())])
+    for h in report['hosts']:
+        print '    {0:12s} {1:6d} tasks {2:6d} failed {3:8d} ticks'.format(
+            h['name'], h['n_run'], h['n_failed'], h['n_ticks'])
+    return
+
+
+if __name__ == '__main__':
+    import sys
+    import time
+    import main as M
+    n_tasks = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    if len(sys.argv) > 2:
+        from functions import load_all_task_metrics
+        tasks = replayed_tasks(load_all_task_metrics(sys.argv[2]), n_tasks)
+        if len(tasks) == 0:
+            print 'No successful run in the metrics of ' + sys.argv[2]
+            sys.exit(1)
+    else:
+        tasks = synthetic_tasks(n_tasks)
+    n_cpu = int(sys.argv[3]) if len(sys.argv) > 3 else 16
+    for claim in ('file', 'db'):
+        for wake_on_exit in (False, True):
+            hosts = [new_host(k, v, n_cpu = n_cpu)
+                     for k, v in sorted(M.worker_max_task.items())]
+            t0 = time.time()
+            report = simulate(tasks, hosts, claim = claim,
+                              wake_on_exit = wake_on_exit)
+            print_report(report,
+                '{0:s} claims, wake_on_exit = {1:s} ({2:.1f} s)'.format(
+                    claim, str(wake_on_exit), time.time() - t0))
@@ -0,0 +1,226 @@
+'''
+A live HTTP/JSON status endpoint for each main_loop, and an aggregator of
+the endpoints of all the hosts.
+
+main_loop publishes a small dict each pass (publish_status): the running
+tasks with their start times, the numbers of tasks in the ledger, the
+queue depth (counted at most every count_seconds) and the CPU and memory
+load of the host.  Publishing only replaces a reference, so the loop never
+waits for a client; the JSON is built by the server thread when the
+endpoint is read:
+    host, time, queued, running (task, elapsed_seconds),
+    finished_per_hour and failure_rate over the last window_seconds,
+    pcpu, pvmem, and the campaign counts and ETA.
+The address of the endpoint is written to log_dir/endpoint.<host>, and
+    python status_server.py log_dir
+prints the merged status of all the hosts whose endpoints answer.  The
+endpoint has no authentication, and only listens on 127.0.0.1 unless it
+is bound to another address; bind it to all the interfaces ('') only on a
+trusted network, for the aggregator to reach the other hosts.
+'''
+
+import BaseHTTPServer
+import json
+import os
+import socket
+import threading
+import time
+from collections import deque
+
+
+def new_status(host, window_seconds = 3600.0):
+    return {'host': host,
+            't_start': time.time(),
+            'window_seconds': window_seconds,
+            'finished': deque(),
+            'n_failed': 0,
+            'published': {},
+            'server': None,
+            'fname_endpoint': None}
+
+
+def record_finished(status, t_end, exitcode):
+    status['finished'].append((t_end, exitcode))
+    status['n_failed'] += (exitcode != 0)
+    return
+
+
+def count_queued_tasks(fname_task = None, task_db = None, n_bytes = 65536):
+    '''
+    The number of tasks waiting in the task database or the task file.
+    Only the first n_bytes of the task file are read: a longer file is
+    taken to hold lines of the same mean length.
+    '''
+    if task_db is not None:
+        import task_queue as tq
+        return tq.count_tasks(task_db)['queued']
+    try:
+        size = os.path.getsize(fname_task)
+        with open(fname_task, 'r') as f:
+            head = f.read(n_bytes)
+    except (IOError, OSError):
+        return None
+    if len(head) == size:
+        return len([_ for _ in head.splitlines() if len(_.strip()) > 0])
+    # Without the last line, which may be cut.
+    lines = head.splitlines(True)[:-1]
+    n_chars = sum([len(_) for _ in lines])
+    if n_chars == 0:
+        return None
+    return int(round(size * len(lines) / float(n_chars)))
+
+
+def publish_status(status, running, queued, ledger, pcpu, pvmem):
+    '''
+    running is a list of (task, start time).
+    '''
+    t = time.time()
+    finished = status['finished']
+    while len(finished) > 0 and t - finished[0][0] > status['window_seconds']:
+        status['n_failed'] -= (finished.popleft()[1] != 0)
+    status['published'] = {'t': t,
+                           'running': running,
+                           'queued': queued,
+                           'n_window': len(finished),
+                           'n_window_failed': status['n_failed'],
+                           'n_finished_all': len(ledger['finished']),
+                           'n_failed_all': len(ledger['failed']),
+                           'n_running_all': len(ledger['running'] -
+                                                ledger['finished']),
+                           'pcpu': pcpu,
+                           'pvmem': pvmem}
+    return
+
+
+def eta_seconds(queued, running, finished_per_hour):
+    if queued is None or finished_per_hour <= 0.0:
+        return None
+    return 3600.0 * (queued + running) / finished_per_hour
+
+
+def status_report(status):
+    p = status['published']
+    t = time.time()
+    # Over the time since the start until a whole window has passed.
+    window_hours = max(1.0, min(status['window_seconds'],
+                                t - status['t_start'])) / 3600.0
+    finished_per_hour = p.get('n_window', 0) / window_hours
+    report = {'host': status['host'],
+              'time': t,
+              't_published': p.get('t'),
+              'queued': p.get('queued'),
+              'running': [{'task': s_task, 'elapsed_seconds': t - t_start}
+                          for s_task, t_start in p.get('running', [])],
+              'finished_per_hour': finished_per_hour,
+              'failure_rate': (float(p['n_window_failed']) / p['n_window']
+                               if p.get('n_window', 0) > 0 else 0.0),
+              'pcpu': p.get('pcpu'),
+              'pvmem': p.get('pvmem'),
+              'campaign': {'finished': p.get('n_finished_all'),
+                           'failed': p.get('n_failed_all'),
+                           'running': p.get('n_running_all')}}
+    report['campaign']['eta_seconds'] = eta_seconds(p.get('queued'),
+        p.get('n_running_all') or 0, finished_per_hour)
+    return report
+
+
+class StatusHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        body = json.dumps(status_report(self.server.status))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        return
+
+    def log_message(self, format, *args):
+        return
+
+
+def start_status_server(status, log_dir, port = 0, bind = '127.0.0.1'):
+    '''
+    Serve status on port (any free port if 0) of the address bind ('' for
+    all the interfaces) in a daemon thread, and write the address to
+    log_dir/endpoint.<host>.
+    '''
+    server = BaseHTTPServer.HTTPServer((bind, port), StatusHandler)
+    server.status = status
+    thread = threading.Thread(target = server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    status['server'] = server
+    status['fname_endpoint'] = os.path.join(log_dir,
+                                            'endpoint.' + status['host'])
+    with open(status['fname_endpoint'] + '.tmp', 'w') as f:
+        f.write('http://{0:s}:{1:d}/\n'.format(
+            bind if bind not in ('', '0.0.0.0') else socket.getfqdn(),
+            server.server_address[1]))
+    os.rename(status['fname_endpoint'] + '.tmp', status['fname_endpoint'])
+    return server
+
+
+def stop_status_server(status):
+    if status['server'] is not None:
+        status['server'].shutdown()
+        status['server'].server_close()
+        status['server'] = None
+    if status['fname_endpoint'] is not None and \
+            os.path.exists(status['fname_endpoint']):
+        os.remove(status['fname_endpoint'])
+    return
+
+
+def read_endpoints(log_dir, timeout = 2.0):
+    '''
+    Return the reports of the endpoints in log_dir, and the hosts whose
+    endpoints did not answer.
+    '''
+    import glob
+    import urllib2
+    reports = []
+    unreachable = []
+    for fname in sorted(glob.glob(os.path.join(log_dir, 'endpoint.*'))):
+        host = os.path.basename(fname)[len('endpoint.'):]
+        try:
+            with open(fname, 'r') as f:
+                url = f.read().strip()
+            reports.append(json.load(urllib2.urlopen(url, timeout = timeout)))
+        except (IOError, ValueError, socket.error):
+            unreachable.append(host)
+    return reports, unreachable
+
+
+def merge_reports(reports, unreachable = ()):
+    '''
+    The status of the campaign from the reports of all the hosts.  The
+    queue and the ledger are shared, so their counts are taken from the
+    latest report.
+    '''
+    merged = {'hosts': reports,
+              'unreachable': list(unreachable),
+              'running': sum([len(_['running']) for _ in reports]),
+              'finished_per_hour': sum([_['finished_per_hour']
+                                        for _ in reports])}
+    if len(reports) == 0:
+        return merged
+    latest = max(reports, key = lambda _: _['t_published'])
+    merged['queued'] = latest['queued']
+    merged['campaign'] = dict(latest['campaign'])
+    merged['campaign']['eta_seconds'] = eta_seconds(latest['queued'],
+        latest['campaign']['running'] or 0, merged['finished_per_hour'])
+    n = sum([_['finished_per_hour'] for _ in reports])
+    merged['failure_rate'] = (sum([_['failure_rate'] * _['finished_per_hour']
+                                   for _ in reports]) / n if n > 0 else 0.0)
+    return merged
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) != 2:
+        print 'Usage: python status_server.py log_dir'
+        sys.exit(1)
+    reports, unreachable = read_endpoints(sys.argv[1])
+    print json.dumps(merge_reports(reports, unreachable), indent=1,
+                     sort_keys=True)
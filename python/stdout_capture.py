@@ -0,0 +1,101 @@
+'''
+Capture the stdout of a task through a pipe, keeping only its last lines in
+memory.
+
+A thread reads the pipe line by line into a buffer of at most nline lines.
+The buffer is written to the stdout file when there is new output and the
+last write is at least flush_seconds ago, and when the task closes its
+stdout.  flush_stdout_capture can be called from time to time so that the
+last lines of a task that has stopped printing also reach the file.
+If fname_full is given, the whole output is also written there, compressed
+with gzip.
+'''
+
+import gzip
+import os
+import threading
+import time
+from collections import deque
+
+
+def _load_tail(fname, nline):
+    try:
+        with open(fname, 'r') as f:
+            return deque(f, maxlen=nline)
+    except IOError:
+        return deque(maxlen=nline)
+
+
+def _flush_tail(c):
+    with c['flush_lock']:
+        with c['lock']:
+            lines = list(c['tail'])
+            c['dirty'] = False
+            c['t_flush'] = time.time()
+        fname_tmp = c['fname'] + '.tmp'
+        with open(fname_tmp, 'w') as f:
+            f.writelines(lines)
+        os.rename(fname_tmp, c['fname'])
+    return
+
+
+def _capture(c, pipe):
+    f_full = None
+    if c['fname_full'] is not None:
+        f_full = gzip.open(c['fname_full'], 'ab')
+    try:
+        for line in iter(pipe.readline, ''):
+            with c['lock']:
+                c['tail'].append(line)
+                c['dirty'] = True
+            if f_full is not None:
+                f_full.write(line)
+            if time.time() - c['t_flush'] >= c['flush_seconds']:
+                _flush_tail(c)
+    finally:
+        pipe.close()
+        if f_full is not None:
+            f_full.close()
+        _flush_tail(c)
+    return
+
+
+def start_stdout_capture(pipe, fname, nline=2000, flush_seconds=180,
+                         fname_full=None):
+    '''
+    Start reading pipe in a thread.  The last nline lines already in fname,
+    if any, are kept at the head of the buffer.
+    '''
+    c = {'fname': fname,
+         'fname_full': fname_full,
+         'tail': _load_tail(fname, nline),
+         'flush_seconds': flush_seconds,
+         't_flush': time.time(),
+         'dirty': False,
+         'lock': threading.Lock(),
+         'flush_lock': threading.Lock(),
+         'thread': None}
+    c['thread'] = threading.Thread(target=_capture, args=(c, pipe))
+    c['thread'].daemon = True
+    c['thread'].start()
+    return c
+
+
+def flush_stdout_capture(c):
+    '''
+    Write the buffer to the file if it has new lines and the last write is
+    at least flush_seconds ago.
+    '''
+    if c['dirty'] and time.time() - c['t_flush'] >= c['flush_seconds']:
+        _flush_tail(c)
+        return True
+    return False
+
+
+def finish_stdout_capture(c, timeout=10.0):
+    '''
+    Wait for the capture to reach the end of the pipe, which has been
+    flushed to the file once this returns True.
+    '''
+    c['thread'].join(timeout)
+    return not c['thread'].is_alive()
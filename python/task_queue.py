@@ -0,0 +1,240 @@
+'''
+A task queue kept in a SQLite database, as an alternative to the plain text
+task file.
+
+Each task is one row with a state, which is one of
+    queued, claimed, running, done, failed.
+A worker claims tasks in one transaction, so no lock file is needed and the
+cost of a claim does not depend on the length of the queue.
+Tasks with a higher priority are claimed first; tasks of the same priority
+are claimed in the order they were added.
+A claim can hold a lease, which the worker renews while the task is claimed
+or running.  The tasks whose leases have expired, e.g. because their host
+died, are put back in the queue by requeue_expired.
+
+The database is opened with journal_mode = 'DELETE' by default, which works
+on a file system shared by several hosts (such as the working_dir of
+main.py) as long as its locks work.  WAL mode is faster, but needs all the
+processes using the database to be on the same host.
+'''
+
+import os
+import sqlite3
+import time
+
+task_states = ('queued', 'claimed', 'running', 'done', 'failed')
+
+
+def open_task_db(fname, journal_mode='DELETE', timeout=60.0):
+    conn = sqlite3.connect(fname, timeout=timeout, isolation_level=None)
+    conn.execute('PRAGMA journal_mode = {0:s}'.format(journal_mode))
+    # NORMAL is only safe against power loss in WAL mode.
+    conn.execute('PRAGMA synchronous = {0:s}'.format(
+        'NORMAL' if journal_mode.upper() == 'WAL' else 'FULL'))
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS tasks (
+            id         INTEGER PRIMARY KEY AUTOINCREMENT,
+            task       TEXT NOT NULL,
+            state      TEXT NOT NULL DEFAULT 'queued',
+            host       TEXT,
+            t_claimed  REAL,
+            t_started  REAL,
+            t_finished REAL,
+            exitcode   INTEGER,
+            priority   REAL NOT NULL DEFAULT 0,
+            t_lease    REAL
+        )''')
+    columns = [str(_[1]) for _ in conn.execute('PRAGMA table_info(tasks)')]
+    if 'priority' not in columns:
+        conn.execute('ALTER TABLE tasks ADD COLUMN ' +
+                     'priority REAL NOT NULL DEFAULT 0')
+    if 't_lease' not in columns:
+        conn.execute('ALTER TABLE tasks ADD COLUMN t_lease REAL')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state, id)''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS tasks_claim
+            ON tasks (state, priority DESC, id)''')
+    return conn
+
+
+def add_tasks(conn, tasks):
+    '''
+    Append the tasks to the queue.  Each task is a command line, or a tuple
+    (command line, priority).
+    '''
+    rows = []
+    for t in tasks:
+        if type(t) == tuple:
+            t, priority = t
+        else:
+            priority = 0.0
+        if len(t.strip()) > 0:
+            rows.append((t.strip(), priority))
+    with conn:
+        conn.execute('BEGIN IMMEDIATE')
+        conn.executemany('INSERT INTO tasks (task, priority) VALUES (?, ?)',
+                         rows)
+    return len(rows)
+
+
+def claim_tasks(conn, host, n=1, lease_seconds=None):
+    '''
+    Claim at most n queued tasks for host, highest priority first, with a
+    lease of lease_seconds if it is given.
+    Return a list of (task_id, task).
+    '''
+    if n <= 0:
+        return []
+    t = time.time()
+    t_lease = None if lease_seconds is None else t + lease_seconds
+    with conn:
+        conn.execute('BEGIN IMMEDIATE')
+        claimed = conn.execute(
+            'SELECT id, task FROM tasks WHERE state = ? ' +
+            'ORDER BY priority DESC, id LIMIT ?',
+            ('queued', n)).fetchall()
+        conn.executemany(
+            'UPDATE tasks SET state = ?, host = ?, t_claimed = ?, ' +
+            't_lease = ? WHERE id = ?',
+            [('claimed', host, t, t_lease, i) for i, _ in claimed])
+    return [(i, str(t)) for i, t in claimed]
+
+
+def release_tasks(conn, task_ids):
+    '''
+    Put claimed tasks that have not been started back in the queue.
+    '''
+    with conn:
+        conn.execute('BEGIN IMMEDIATE')
+        conn.executemany(
+            'UPDATE tasks SET state = ?, host = NULL, t_claimed = NULL, ' +
+            't_lease = NULL WHERE id = ? AND state = ?',
+            [('queued', i, 'claimed') for i in task_ids])
+    return
+
+
+def renew_leases(conn, host, lease_seconds):
+    '''
+    Extend the leases of the tasks claimed or running on host.
+    Return the number of tasks that still hold a lease.
+    '''
+    with conn:
+        return conn.execute(
+            'UPDATE tasks SET t_lease = ? WHERE host = ? AND ' +
+            'state IN (?, ?) AND t_lease IS NOT NULL',
+            (time.time() + lease_seconds, host,
+             'claimed', 'running')).rowcount
+
+
+def requeue_expired(conn, host=None):
+    '''
+    Put the claimed or running tasks whose leases have expired back in the
+    queue; with host, all the claimed or running tasks of that host (e.g.
+    when it restarts).  Return a list of (task_id, task, host).
+    '''
+    if host is None:
+        where, args = 't_lease IS NOT NULL AND t_lease < ?', (time.time(),)
+    else:
+        where, args = 'host = ?', (host,)
+    with conn:
+        conn.execute('BEGIN IMMEDIATE')
+        expired = conn.execute(
+            'SELECT id, task, host FROM tasks WHERE state IN (?, ?) AND ' +
+            where, ('claimed', 'running') + args).fetchall()
+        conn.executemany(
+            'UPDATE tasks SET state = ?, host = NULL, t_claimed = NULL, ' +
+            't_started = NULL, t_lease = NULL WHERE id = ?',
+            [('queued', i) for i, _, _ in expired])
+    return [(i, str(t), str(h)) for i, t, h in expired]
+
+
+def set_task_state(conn, task_id, state, exitcode=None):
+    if state not in task_states:
+        raise ValueError('Unknown task state: ' + state)
+    t = time.time()
+    with conn:
+        if state == 'running':
+            conn.execute(
+                'UPDATE tasks SET state = ?, t_started = ? WHERE id = ?',
+                (state, t, task_id))
+        elif state in ('done', 'failed'):
+            conn.execute(
+                'UPDATE tasks SET state = ?, t_finished = ?, exitcode = ? ' +
+                'WHERE id = ?', (state, t, exitcode, task_id))
+        else:
+            conn.execute('UPDATE tasks SET state = ? WHERE id = ?',
+                         (state, task_id))
+    return
+
+
+def queued_tasks(conn):
+    '''
+    Return a list of (task_id, task) of the queued tasks.
+    '''
+    return [(i, str(t)) for i, t in conn.execute(
+        'SELECT id, task FROM tasks WHERE state = ? ORDER BY id', ('queued',))]
+
+
+def set_priorities(conn, priorities):
+    '''
+    priorities is a list of (task_id, priority).
+    '''
+    with conn:
+        conn.execute('BEGIN IMMEDIATE')
+        conn.executemany('UPDATE tasks SET priority = ? WHERE id = ?',
+                         [(p, i) for i, p in priorities])
+    return
+
+
+def count_tasks(conn):
+    '''
+    Return a dict with the number of tasks in each state.
+    '''
+    n = dict([(s, 0) for s in task_states])
+    for s, c in conn.execute(
+            'SELECT state, COUNT(*) FROM tasks GROUP BY state'):
+        n[str(s)] = c
+    return n
+
+
+def import_task_file(conn, fname_task):
+    '''
+    Add the tasks in a plain text task file (one command line per line).
+    '''
+    with open(fname_task, 'r') as f:
+        return add_tasks(conn, f.readlines())
+
+
+def export_task_file(conn, fname_task, states=('queued',)):
+    '''
+    Write the tasks in the given states to a plain text task file, in the
+    order they would be claimed.
+    '''
+    tasks = conn.execute(
+        ('SELECT task FROM tasks WHERE state IN ({0:s}) ' +
+         'ORDER BY priority DESC, id').format(
+            ', '.join(['?'] * len(states))), tuple(states)).fetchall()
+    with open(fname_task, 'w') as f:
+        f.writelines([str(t) + '\n' for (t,) in tasks])
+    return len(tasks)
+
+
+if __name__ == '__main__':
+    import sys
+    usage = 'Usage: python task_queue.py import|export|count ' + \
+            'db_file [task_file]'
+    if len(sys.argv) < 3:
+        print usage
+        sys.exit(1)
+    cmd, fname_db = sys.argv[1], sys.argv[2]
+    conn = open_task_db(fname_db)
+    if cmd == 'import' and len(sys.argv) == 4:
+        print 'Imported {0:d} tasks.'.format(import_task_file(conn, sys.argv[3]))
+    elif cmd == 'export' and len(sys.argv) == 4:
+        print 'Exported {0:d} tasks.'.format(export_task_file(conn, sys.argv[3]))
+    elif cmd == 'count':
+        print count_tasks(conn)
+    else:
+        print usage
+        sys.exit(1)
@@ -0,0 +1,4 @@
+'''
+Unit tests of the scheduling helpers.  From this directory's parent:
+    python -m unittest discover -s tests -t .
+'''
@@ -0,0 +1,43 @@
+import unittest
+
+import admission as ad
+
+
+class AdmitTaskTest(unittest.TestCase):
+
+    def test_fits(self):
+        admitted, reason = ad.admit_task(1000.0, [(1000.0, 500.0)],
+                                         10000.0, 8000.0, max_pvmem = 0.9)
+        self.assertTrue(admitted)
+        self.assertEqual(reason, '')
+
+    def test_refused_while_others_run(self):
+        # 2000 in use + 500 growth + 7000 > 9000.
+        admitted, reason = ad.admit_task(7000.0, [(1000.0, 500.0)],
+                                         10000.0, 8000.0, max_pvmem = 0.9)
+        self.assertFalse(admitted)
+        self.assertIn('> limit 9000 MB', reason)
+
+    def test_admitted_over_limit_when_idle(self):
+        admitted, reason = ad.admit_task(20000.0, [],
+                                         10000.0, 8000.0, max_pvmem = 0.9)
+        self.assertTrue(admitted)
+        self.assertIn('> limit', reason)
+
+
+class EstimateTaskMemoryTest(unittest.TestCase):
+
+    def test_heuristic_then_measured(self):
+        history = ad.new_footprint_history()
+        key = ad.footprint_key({'a_disk_iter_params%max_num_of_cells': 1024})
+        mb, how = ad.estimate_task_memory_mb(key, history, mem_base_mb = 100.0,
+                                             mem_per_cell_kb = 10.0)
+        self.assertEqual((mb, how), (110.0, 'heuristic'))
+        ad.add_footprint(history, key, 2048.0 * 1024)
+        ad.add_footprint(history, key, 1024.0 * 1024)
+        mb, how = ad.estimate_task_memory_mb(key, history, margin = 1.5)
+        self.assertEqual((mb, how), (3072.0, 'measured'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import unittest
+
+import cpu_affinity as ca
+
+
+class CorePoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.numa_nodes = ca.numa_nodes
+        ca.numa_nodes = lambda: [range(0, 8), range(8, 16)]
+
+    def tearDown(self):
+        ca.numa_nodes = self.numa_nodes
+
+    def test_parse_cpu_list(self):
+        self.assertEqual(ca.parse_cpu_list('0-3,8,10-11\n'),
+                         [0, 1, 2, 3, 8, 10, 11])
+
+    def test_allocate_release(self):
+        pool = ca.new_core_pool(3)
+        a = ca.allocate_cores(pool)
+        b = ca.allocate_cores(pool)
+        self.assertEqual(a, [0, 1, 2])
+        self.assertEqual(b, [3, 4, 5])
+        # Across the two nodes once neither has enough free.
+        self.assertEqual(len(set(sum([ca.allocate_cores(pool)
+                                      for _ in xrange(3)], []))), 9)
+        self.assertEqual(len(pool['free']), 1)
+        self.assertEqual(ca.allocate_cores(pool), None)
+        ca.release_cores(pool, a)
+        ca.release_cores(pool, None)
+        self.assertEqual(len(pool['free']), 4)
+        self.assertEqual(len(ca.allocate_cores(pool)), 3)
+
+    def test_auto_resize(self):
+        pool = ca.new_core_pool(0, 4)
+        self.assertEqual(pool['cores_per_task'], 4)
+        self.assertTrue(ca.resize_core_pool(pool, 8))
+        self.assertEqual(pool['cores_per_task'], 2)
+        self.assertFalse(ca.resize_core_pool(pool, 8))
+        fixed = ca.new_core_pool(3)
+        self.assertFalse(ca.resize_core_pool(fixed, 8))
+        self.assertEqual(fixed['cores_per_task'], 3)
+
+    def test_thread_env(self):
+        env = ca.thread_env([4, 5])
+        self.assertEqual(env['OMP_NUM_THREADS'], '2')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import unittest
+
+import admission as ad
+import scheduling as sch
+
+
+class SchedulePassTest(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = []
+        self.running = []
+        self.given_back = []
+        self.failed = []
+        self.generating = False
+        self.sched = sch.new_scheduler(3, max_pcpu = 0.9,
+                                       t_wait_seconds = 1,
+                                       t_wait_seconds_long = 5,
+                                       max_pvmem = 0.9,
+                                       mem_base_mb = 1000.0,
+                                       mem_per_cell_kb = 0.0,
+                                       max_refusals = 2)
+        self.probes = {
+            'now': lambda: 0.0,
+            'n_running': lambda: len(self.running),
+            'running_mem': lambda: [(_, _) for _ in self.running],
+            'pcpu': lambda: 0.1,
+            'memory': lambda: (10000.0, 10000.0 - sum(self.running)),
+            'claim': self.claim,
+            'generating': lambda: self.generating,
+            'start': lambda t, est_mb, cores:
+                self.running.append(est_mb) is None,
+            'fail': self.failed.append,
+            'give_back': self.give_back,
+            'log': lambda s: None}
+
+    def claim(self, n):
+        claimed = self.queue[:n]
+        del self.queue[:n]
+        return claimed
+
+    def give_back(self, ts):
+        self.given_back.extend([_['task'] for _ in ts])
+        self.queue[:0] = ts
+
+    def task(self, name, mb):
+        key = (name, None)
+        ad.add_footprint(self.sched['footprints'], key, mb * 1024.0)
+        return {'task': name, 'footprint': key}
+
+    def test_fills_the_free_slots(self):
+        self.queue = [self.task(_, 1000.0) for _ in 'abcd']
+        self.assertEqual(sch.schedule_pass(self.sched, self.probes),
+                         ('launch', 1, True))
+        self.assertEqual(len(self.running), 3)
+        self.assertEqual(sch.schedule_pass(self.sched, self.probes),
+                         ('busy', 5, True))
+
+    def test_gives_back_and_gives_up(self):
+        self.queue = [self.task('a', 4000.0), self.task('b', 6000.0),
+                      self.task('c', 1000.0)]
+        self.assertEqual(sch.schedule_pass(self.sched, self.probes),
+                         ('refused', 5, True))
+        self.assertEqual(len(self.running), 1)
+        self.assertEqual(self.given_back, ['b', 'c'])
+        sch.schedule_pass(self.sched, self.probes)
+        self.assertEqual([_['task'] for _ in self.failed], ['b'])
+        self.assertEqual([_['task'] for _ in self.queue], ['c'])
+
+    def test_waits_for_generation_then_stops(self):
+        self.generating = True
+        self.assertEqual(sch.schedule_pass(self.sched, self.probes),
+                         ('generating', 1, False))
+        self.generating = False
+        self.assertEqual(sch.schedule_pass(self.sched, self.probes)[0],
+                         'drain')
+        self.assertTrue(sch.schedule_pass(self.sched, self.probes) is None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import functions as fn
+
+
+class TaskFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.dir, 'tasks')
+        with open(self.fname, 'w') as f:
+            f.writelines(['rac {0:d}\n'.format(i) for i in xrange(5)])
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def claim(self, n):
+        sfopen, f = fn.open_and_lock_file(self.fname)
+        self.assertEqual(sfopen, 'success')
+        try:
+            s_tasks = fn.check_tasks_todo(f, n = n)
+            fn.update_task_file(f, n = len(s_tasks))
+        finally:
+            f.close()
+            fn.unlock_file(self.fname)
+        return s_tasks
+
+    def test_claim_n(self):
+        self.assertEqual(self.claim(2), ['rac 0', 'rac 1'])
+        self.assertEqual(self.claim(10), ['rac 2', 'rac 3', 'rac 4'])
+        self.assertEqual(self.claim(1), [])
+        self.assertEqual(fn.load_file_lines(self.fname), [])
+
+    def test_blank_lines(self):
+        with open(self.fname, 'w') as f:
+            f.writelines(['\n', 'rac 0\n', '  \n', 'rac 1\n', '\n', 'rac 2\n'])
+        self.assertEqual(self.claim(2), ['rac 0', 'rac 1'])
+        self.assertEqual(fn.load_file_lines(self.fname), ['\n', 'rac 2\n'])
+        self.assertEqual(self.claim(2), ['rac 2'])
+        self.assertEqual(self.claim(2), [])
+
+    def test_locked(self):
+        sfopen, f = fn.open_and_lock_file(self.fname)
+        try:
+            self.assertEqual(fn.open_and_lock_file(self.fname),
+                             ('locked', None))
+        finally:
+            f.close()
+            fn.unlock_file(self.fname)
+
+    def test_prepend_append(self):
+        s_tasks = self.claim(3)
+        fn.prepend_to_task_file(self.fname, [_ + '\n' for _ in s_tasks[1:]])
+        fn.append_to_task_file(self.fname, ['rac 5\n'])
+        self.assertEqual(self.claim(10),
+                         ['rac 1', 'rac 2', 'rac 3', 'rac 4', 'rac 5'])
+
+
+if __name__ == '__main__':
+    unittest.main()
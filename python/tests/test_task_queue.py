@@ -0,0 +1,51 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import task_queue as tq
+
+
+class ClaimReleaseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.conn = tq.open_task_db(os.path.join(self.dir, 'tasks.sqlite'))
+        tq.add_tasks(self.conn, ['rac a', ('rac b', 2.0), 'rac c', '  '])
+
+    def tearDown(self):
+        self.conn.close()
+        shutil.rmtree(self.dir)
+
+    def test_claim_by_priority(self):
+        claimed = tq.claim_tasks(self.conn, 'h1', n = 2)
+        self.assertEqual([_[1] for _ in claimed], ['rac b', 'rac a'])
+        self.assertEqual(tq.count_tasks(self.conn)['queued'], 1)
+        self.assertEqual(tq.claim_tasks(self.conn, 'h2', n = 5)[0][1], 'rac c')
+        self.assertEqual(tq.claim_tasks(self.conn, 'h2', n = 5), [])
+        self.assertEqual(tq.claim_tasks(self.conn, 'h2', n = 0), [])
+
+    def test_release(self):
+        claimed = tq.claim_tasks(self.conn, 'h1', n = 3)
+        tq.set_task_state(self.conn, claimed[0][0], 'running')
+        tq.release_tasks(self.conn, [_[0] for _ in claimed])
+        # Only the tasks not started go back.
+        self.assertEqual([_[1] for _ in tq.queued_tasks(self.conn)],
+                         ['rac a', 'rac c'])
+        self.assertEqual([_[1] for _ in tq.claim_tasks(self.conn, 'h2', n = 1)],
+                         ['rac a'])
+
+    def test_requeue_expired(self):
+        tq.claim_tasks(self.conn, 'h1', n = 1, lease_seconds = -1.0)
+        tq.claim_tasks(self.conn, 'h2', n = 1, lease_seconds = 3600.0)
+        requeued = tq.requeue_expired(self.conn)
+        self.assertEqual([(_[1], _[2]) for _ in requeued], [('rac b', 'h1')])
+        self.assertEqual(tq.count_tasks(self.conn)['queued'], 2)
+
+    def test_journal_mode(self):
+        mode = self.conn.execute('PRAGMA journal_mode').fetchone()[0]
+        self.assertEqual(mode.lower(), 'delete')
+
+
+if __name__ == '__main__':
+    unittest.main()
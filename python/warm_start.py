@@ -0,0 +1,79 @@
+'''
+Start a new run from the saved state of the nearest finished run, instead
+of from scratch.
+
+Runs with the same spectral type are compared by their distance in
+    log10(rin), log10(rout), log10(d2g), log10(mdust),
+each normalized by its span over the finished runs (or by one dex).  The
+nearest finished run within max_distance is used: the new run reads its
+data dump as the initial state (a_disk_iter_params%dump_sub_dir_in).  If
+there is none, the new run starts cold, as before.  The solver has to read
+that key: it must be assigned in the iteration template (see main.py).
+'''
+
+import os
+from math import log10, sqrt
+
+neighbour_keys = ('rin', 'rout', 'd2g', 'mdust')
+
+
+def finished_run_ids(metrics):
+    '''
+    The run IDs of the successful runs in metrics (as from
+    load_task_metrics), without the line tasks.
+    '''
+    import runtime_model as rm
+    ids = set()
+    for m in metrics:
+        if m.get('exitcode', 1) != 0:
+            continue
+        key = rm.lut_key_of_task(m['task'])
+        if key is not None and '.' not in key:
+            ids.add(key)
+    return ids
+
+
+def load_warm_start_runs(fname_lut, finished_ids, dump_dir,
+                         max_distance = 0.5):
+    '''
+    Collect the finished runs in the LUT whose dumps are still in dump_dir.
+    '''
+    import runtime_model as rm
+    runs = {}
+    for run_id, p in rm.load_lut(fname_lut).items():
+        d = os.path.join(dump_dir, 'run_' + run_id)
+        if run_id in finished_ids and os.path.isdir(d) and \
+                len(os.listdir(d)) > 0:
+            runs[run_id] = p
+    scales = {}
+    for k in neighbour_keys:
+        v = [log10(p[k]) for p in runs.values()]
+        # One dex for a parameter that all the finished runs share.
+        scales[k] = max(v) - min(v) \
+                    if len(v) > 0 and max(v) > min(v) else 1.0
+    return {'runs': runs, 'scales': scales, 'max_distance': max_distance}
+
+
+def run_distance(warm_start_runs, p, q):
+    s = 0.0
+    for k, scale in warm_start_runs['scales'].items():
+        s += ((log10(p[k]) - log10(q[k])) / scale)**2
+    return sqrt(s)
+
+
+def nearest_run(warm_start_runs, p, exclude=None):
+    '''
+    Return the ID of the nearest finished run to the grid point p, or None.
+    The run exclude (that of p itself, when it is run again) is skipped.
+    '''
+    best, d_best = None, warm_start_runs['max_distance']
+    for run_id in sorted(warm_start_runs['runs'].keys()):
+        if run_id == exclude:
+            continue
+        q = warm_start_runs['runs'][run_id]
+        if q['sptype'] != p['sptype']:
+            continue
+        d = run_distance(warm_start_runs, p, q)
+        if d <= d_best:
+            best, d_best = run_id, d
+    return best